@@ -20,6 +20,8 @@ import os
 
 MAIL_USERNAME = os.getenv('MAIL_USERNAME')
 MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+# Evaluation uploads are spooled to disk and parsed as a stream, so this mostly bounds disk use and upload time
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', '10'))
 # Create a new Flask application instance.
 app = Flask(__name__)
 # Set the secret key for session management. Used for securely signing the session cookie.
@@ -37,8 +39,8 @@ app.config['MAIL_USE_TLS'] = True
 # TODO: Add Admin email and app password using environment variables 
 app.config['MAIL_USERNAME'] = MAIL_USERNAME
 app.config['MAIL_PASSWORD'] = MAIL_PASSWORD 
-# Set the maximum file size for file uploads to 10MB.
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+# Set the maximum file size for file uploads, 10MB unless MAX_UPLOAD_MB is set.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
 
 # Initialize session handling for the app.
 Session(app)
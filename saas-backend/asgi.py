@@ -0,0 +1,31 @@
+'''
+ASGI entry point for serving the backend with an async server such as uvicorn.
+
+The streaming ask routes (see controller/asyncRoutes.py) run natively on the event loop.
+All other routes, and SSE requests to the ask routes, are passed through to the Flask app from app.py.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 2
+'''
+from asgiref.wsgi import WsgiToAsgi
+from app import app as flask_app
+from controller import asyncRoutes
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] == "http" and scope["path"] in asyncRoutes.ASYNC_ROUTES:
+        await asyncRoutes.handle(scope, receive, send, flask_asgi)
+        return
+
+    await flask_asgi(scope, receive, send)
@@ -0,0 +1,359 @@
+'''
+@file asyncRoutes.py
+This file contains async versions of the streaming ask routes, served by the ASGI entry point (asgi.py).
+
+The routes keep the JSON contract of chatRoutes.ask, chatRoutes.ask_guest and courseEvaluationRoutes.ask, but
+MongoDB access (Motor), retrieval and the LLM stream (rag_chain.astream) are awaited. An open token stream then
+only costs a coroutine instead of a worker thread, so one process can hold hundreds of streams during peak hours.
+
+'''
+import asyncio
+import json
+import os
+import secrets
+import time
+from datetime import datetime
+from json import JSONDecodeError
+
+from dotenv import load_dotenv
+
+import vectorsMongoDB.queryManager as queryManager
+from repository.mongo_connection import mongo
+import vectorsMongoDB.CEqueryManager as CEqueryManager
+from controller import chatRoutes
+from service.conversation_history import HISTORY_MAX_MESSAGES, guest_history, with_token_count
+from service.generation_registry import generation_registry
+from service.upload_jobs import pending_jobs
+from service.session_retention import now_utc, session_retention
+
+# Load environment variables
+load_dotenv()
+MONGODB_URI = os.getenv('MONGODB_URI')
+MONGODB_USERS = os.getenv('MONGODB_USERS')
+MONGODB_DB = os.getenv('MONGODB_DATABASE')
+MONGODB_TEMPUSER = os.getenv('MONGODB_TEMPUSER')
+
+_database = None
+
+
+def get_database():
+    """
+    Create the Motor client of the connection manager on first use, inside the server's event loop.
+    The vector searches of both query managers are switched to Motor at the same time.
+    """
+    global _database
+    if _database is None:
+        _database = mongo.async_database(MONGODB_DB)
+        queryManager.atlas_index.async_collection = _database[queryManager.collection_name]
+        CEqueryManager.eval_atlas.async_collection = _database[CEqueryManager.collection_name_eval]
+        CEqueryManager.textbook_atlas.async_collection = _database[CEqueryManager.collection_name_textbook]
+        CEqueryManager.website_atlas.async_collection = _database[CEqueryManager.collection_name_website]
+    return _database
+
+
+class AsyncRequest:
+    """The parts of an ASGI http request the ask routes need."""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        self._body = None
+
+    async def body(self):
+        """Read the whole request body once, returning None if the client disconnected."""
+        if self._body is None:
+            body = b""
+            while True:
+                message = await self.receive()
+                if message["type"] == "http.disconnect":
+                    return None
+                body += message.get("body", b"")
+                if not message.get("more_body"):
+                    break
+            self._body = body
+        return self._body
+
+    async def json(self):
+        body = await self.body()
+        try:
+            return json.loads(body) if body else None
+        except (JSONDecodeError, UnicodeDecodeError):
+            return None
+
+    def replay_receive(self):
+        """Return an ASGI receive callable that hands the already read body to another app."""
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": self._body or b"", "more_body": False}
+            return await self.receive()
+
+        return receive
+
+    async def wants_sse(self):
+        if "text/event-stream" in self.headers.get("accept", ""):
+            return True
+        input_data = await self.json() if self.method == "POST" else None
+        return isinstance(input_data, dict) and input_data.get("stream") == "sse"
+
+
+def _cors_headers(request):
+    headers = [(b"access-control-allow-origin", b"*")]
+    if request.method == "OPTIONS":
+        requested = request.headers.get("access-control-request-headers", "*")
+        headers.append((b"access-control-allow-methods", b"POST, OPTIONS"))
+        headers.append((b"access-control-allow-headers", requested.encode("latin-1")))
+    return headers
+
+
+class JSONResponse:
+    def __init__(self, payload, status=200):
+        self.body = json.dumps(payload).encode("utf-8")
+        self.status = status
+
+    async def __call__(self, request, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status,
+            "headers": [(b"content-type", b"application/json")] + _cors_headers(request),
+        })
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class EmptyResponse:
+    def __init__(self, status=200):
+        self.status = status
+
+    async def __call__(self, request, send):
+        await send({"type": "http.response.start", "status": self.status, "headers": _cors_headers(request)})
+        await send({"type": "http.response.body", "body": b""})
+
+
+class StreamingResponse:
+    """
+    Streams text chunks from an async generator. Generation stops as soon as the client disconnects.
+    """
+
+    def __init__(self, chunks, content_type="text/plain"):
+        self.chunks = chunks
+        self.content_type = content_type
+
+    async def __call__(self, request, send):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", self.content_type.encode("latin-1"))] + _cors_headers(request),
+        })
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await request.receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            async for chunk in self.chunks:
+                if disconnected.is_set():
+                    break
+                await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+            await self.chunks.aclose()
+
+
+def chunk_texts(chunk):
+    """Return the text pieces of one streamed chunk, unwrapping completion style JSON chunks."""
+    try:
+        chunk_data = json.loads(chunk)
+    except (JSONDecodeError, TypeError):
+        chunk_data = chunk
+
+    if isinstance(chunk_data, dict) and "choices" in chunk_data:
+        return [choice["text"] for choice in chunk_data["choices"] if "text" in choice]
+    return [chunk]
+
+
+async def ask(request):
+    if request.method == 'OPTIONS':
+        return EmptyResponse(200)
+
+    input_data = await request.json()
+    if not input_data or 'email' not in input_data or 'question' not in input_data:
+        return JSONResponse({"error": "Required data is missing"}, 400)
+
+    email = input_data['email']
+    session_key = input_data.get('sessionKey')
+    question = input_data['question']
+
+    user_collection = get_database()[MONGODB_USERS]
+    checked_at = chatRoutes.known_users.get(email)
+    if checked_at is None or time.monotonic() - checked_at >= chatRoutes.KNOWN_USER_SECONDS:
+        if not await user_collection.find_one({"email": email}, {"_id": 1}):
+            return JSONResponse({"error": "User not found"}, 404)
+        chatRoutes.known_users[email] = time.monotonic()
+
+    if not session_key:
+        # Generate a new session key and initialize the chat session
+        session_key = secrets.token_urlsafe(16)
+        await asyncio.to_thread(chatRoutes.chat_repository.create_chat, email, session_key, question)
+        return JSONResponse({"sessionKey": session_key})
+
+    # The conversation so far is read from the server, any history sent by the client is ignored
+    await asyncio.to_thread(chatRoutes.message_writer.wait_for, email)
+    history = await asyncio.to_thread(chatRoutes.chat_repository.recent_history, email, session_key)
+    if not history:
+        # Keys handed out before /createSession stored the chat have no chat document, the messages need one
+        await asyncio.to_thread(chatRoutes.chat_repository.create_chat, email, session_key, "")
+
+    # Add the user's message to the session
+    user_message = {
+        "sender": "user",
+        "text": question,
+        "timestamp": datetime.now().isoformat()
+    }
+    # Messages go through the same write-behind queue as the Flask routes; put() only blocks when it is full
+    await asyncio.to_thread(chatRoutes.message_writer.push, email, session_key, user_message)
+
+    generation = generation_registry.start(email, session_key)
+
+    async def generate_response():
+        full_response = ""
+        failed = False
+        query = queryManager.amake_query(question, history)
+        try:
+            async for chunk in query:
+                if generation.cancelled:
+                    break
+                for text in chunk_texts(chunk):
+                    yield text
+                    full_response += text
+        except Exception as e:
+            failed = True
+            yield f"Error: {str(e)}"
+            return
+        finally:
+            # Closing the query closes the upstream LLM stream, on pause and on client disconnect alike
+            await query.aclose()
+            if not failed:
+                bot_response = {
+                    "sender": "bot",
+                    "text": generation.final_text if generation.final_text is not None else full_response,
+                    "timestamp": datetime.now().isoformat()
+                }
+                await asyncio.to_thread(chatRoutes.message_writer.push, email, session_key, bot_response)
+            generation_registry.finish(generation)
+
+    return StreamingResponse(generate_response())
+
+
+async def ask_guest(request):
+    if request.method == 'OPTIONS':
+        return EmptyResponse(200)
+
+    input_data = await request.json()
+    if not input_data or 'question' not in input_data:
+        return JSONResponse({"error": "Required data is missing"}, 400)
+
+    session_key = input_data.get('sessionKey')
+    question = input_data['question']
+
+    if not session_key:
+        return JSONResponse({"sessionKey": secrets.token_urlsafe(16)})
+
+    user_message = {"sender": "user", "text": question, "timestamp": datetime.now().isoformat()}
+    history = guest_history.get(session_key)
+
+    async def generate_response():
+        full_response = ""
+        try:
+            async for chunk in queryManager.amake_query(question, history):
+                for text in chunk_texts(chunk):
+                    yield text
+                    full_response += text
+        except Exception as e:
+            yield f"Error: {str(e)}"
+            return
+        guest_history.append(session_key, user_message,
+                             {"sender": "bot", "text": full_response, "timestamp": datetime.now().isoformat()})
+
+    return StreamingResponse(generate_response())
+
+
+async def course_evaluation_ask(request):
+    if request.method == 'OPTIONS':
+        return EmptyResponse(200)
+
+    input_data = await request.json()
+    if not input_data or 'question' not in input_data:
+        return JSONResponse({"error": "Required data is missing"}, 400)
+
+    question = input_data.get('question')
+    session_id = input_data.get('session_id')
+
+    if not session_id:
+        return JSONResponse({"error": "Session ID is required"}, 400)
+
+    session_retention.ensure_started()
+    sessions = get_database()[MONGODB_TEMPUSER]
+    session_data = await sessions.find_one(
+        {'session_id': session_id}, {'chat_history': {'$slice': -HISTORY_MAX_MESSAGES}, 'embeddings': 0}
+    )
+    if not session_data:
+        return JSONResponse({"error": "Session not found or has expired"}, 404)
+    pending = pending_jobs(session_data)
+    if pending:
+        return JSONResponse({"error": "The uploaded evaluation is still being processed", "jobs": pending}, 409)
+    history = session_data.get('chat_history', [])
+    user_message = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'sender': 'user', 'text': question}
+
+    async def generate_response():
+        full_response = ""
+        try:
+            async for chunk in CEqueryManager.amake_query(question, session_id, history,
+                                                          session_data.get('evaluation_version')):
+                for text in chunk_texts(chunk):
+                    yield text
+                    full_response += text
+        except Exception as e:
+            yield f"Error: {str(e)}"
+        finally:
+            bot_message = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'sender': 'bot', 'text': full_response}
+            await sessions.update_one(
+                {'_id': session_data['_id']},
+                {'$push': {'chat_history': {'$each': [with_token_count(user_message), with_token_count(bot_message)]}},
+                 '$set': {'lastActiveAt': now_utc()}}
+            )
+
+    return StreamingResponse(generate_response())
+
+
+# Paths served natively by asgi.py, every other route goes to the Flask app
+ASYNC_ROUTES = {
+    '/chat/ask': ask,
+    '/chat/askGuest': ask_guest,
+    '/courseEvaluation/ask': course_evaluation_ask,
+}
+
+
+async def handle(scope, receive, send, fallback):
+    """
+    Dispatch an ASGI http request to one of the ASYNC_ROUTES.
+    SSE requests go to fallback (the Flask app), which owns the resumable replay buffers.
+    """
+    request = AsyncRequest(scope, receive)
+    if request.method not in ('POST', 'OPTIONS'):
+        await JSONResponse({"error": "Method not allowed"}, 405)(request, send)
+        return
+    if await request.wants_sse():
+        await fallback(scope, request.replay_receive(), send)
+        return
+    response = await ASYNC_ROUTES[scope["path"]](request)
+    await response(request, send)
@@ -9,13 +9,22 @@ from flask import Blueprint, request, jsonify, send_file, stream_with_context, R
 import json
 from json import JSONDecodeError 
 from datetime import datetime
-from pymongo import MongoClient, ReturnDocument
+from pymongo import ReturnDocument
+from repository.mongo_connection import get_database, mongo
 from dotenv import load_dotenv
 import os
 import secrets
 import io
 from flask_cors import CORS
 import vectorsMongoDB.queryManager as queryManager
+from vectorsMongoDB.retrievalCache import retrieval_cache
+from vectorsMongoDB.sessionIndex import session_index_cache
+from service.session_retention import session_retention
+from repository.chat_repository import ChatRepository, MONGODB_CHATS, MONGODB_MESSAGES
+from repository.chat_message_writer import ChatMessageWriter, register_shutdown_flush
+from service.generation_registry import generation_registry
+from service.conversation_history import guest_history
+from service.stream_replay import stream_registry, wants_sse, sse_response, resume_response, parse_last_event_id
 import time
 from langfuse.decorators import observe, langfuse_context
 from reportlab.lib.pagesizes import letter
@@ -40,19 +49,47 @@ MONGODB_SUGGESTIONS = os.getenv('MONGODB_SUGGESTIONS')
 if MONGODB_URI is None or MONGODB_USERS is None or MONGODB_DB is None or MONGODB_SUGGESTIONS is None:
     raise ValueError("MongoDB URI, database name, or collection name is not set.")
 
-# Connect to MongoDB
-client = MongoClient(MONGODB_URI)
-db = client[MONGODB_DB]
+# Connections come from the process wide manager, see repository/mongo_connection.py
+db = get_database(MONGODB_DB)
 user_collection = db[MONGODB_USERS]
 suggestions_collection = db[MONGODB_SUGGESTIONS]
 
+# Chats and their messages live in their own collections, see repository/chat_repository.py
+# Creates its indexes on first use, so importing this module does not connect
+chat_repository = ChatRepository(db[MONGODB_CHATS], db[MONGODB_MESSAGES], user_collection)
+
+# Chat messages are written behind the stream in batches, see repository/chat_message_writer.py
+message_writer = ChatMessageWriter(chat_repository)
+register_shutdown_flush(message_writer)
+
+# Emails recently confirmed to exist, so asking a question does not read the user document every time
+KNOWN_USER_SECONDS = float(os.getenv('CHAT_KNOWN_USER_SECONDS', '300'))
+known_users = {}
+
+def user_exists(email):
+    """Check that a user exists, answering from known_users while the last check is recent."""
+    checked_at = known_users.get(email)
+    if checked_at is not None and time.monotonic() - checked_at < KNOWN_USER_SECONDS:
+        return True
+    if user_collection.find_one({"email": email}, {"_id": 1}) is None:
+        known_users.pop(email, None)
+        return False
+    known_users[email] = time.monotonic()
+    return True
+
+# How long pause_stream waits for a cancelled answer to be stored before answering 202
+PAUSE_FINALIZE_SECONDS = float(os.getenv('CHAT_PAUSE_FINALIZE_SECONDS', '2'))
+SAVED_CHATS_PAGE_SIZE = int(os.getenv('SAVED_CHATS_PAGE_SIZE', '50'))
+SAVED_CHATS_MAX_PAGE_SIZE = 200
+
 chatReset = False
 
 @chat_bp.route('/createSession', methods=['POST'])
 def new_chat():
     """
     This method creates a new chat session for a user.
-    Generates a secure random session key and initializes the chat session in the user's savedChats.
+    Generates a secure random session key, removes the user's empty chats that never got a title and creates the new
+    chat.
     """
     input_data = request.get_json()
     if input_data is None or 'email' not in input_data:
@@ -63,22 +100,12 @@ def new_chat():
     session_key = secrets.token_urlsafe(16) 
 
 
-    user_document = user_collection.find_one({"email": email})
-    if not user_document:
+    if not user_exists(email):
         return jsonify({"error": "User not found"}), 404
-    
-
-    if 'savedChats' in user_document:
-        updates = {}
-        for key, value in user_document['savedChats'].items():
-            if value.get('chatTitle') == '':
-                updates[f"savedChats.{key}"] = ""
 
-        if updates:
-            user_collection.update_one(
-                {"email": email},
-                {"$unset": updates}
-            )
+    message_writer.wait_for(email)
+    chat_repository.delete_untitled_chats(email)
+    chat_repository.create_chat(email, session_key, chat_title)
 
     return jsonify({"sessionKey": session_key})
 
@@ -89,31 +116,34 @@ def ask():
         return '', 200
     
     input_data = request.json
+    if wants_sse(request, input_data):
+        # A reconnect carrying Last-Event-ID continues the existing answer instead of generating a new one
+        resumed = resume_response(request)
+        if resumed is not None:
+            return resumed
+
     if not input_data or 'email' not in input_data or 'question' not in input_data:
         return jsonify({"error": "Required data is missing"}), 400
 
     email = input_data['email']
     session_key = input_data.get('sessionKey')
     question = input_data['question']
-    history = input_data.get('history', [])
 
-    user = user_collection.find_one({"email": email})
-    if not user:
+    if not user_exists(email):
         return jsonify({"error": "User not found"}), 404
 
     if not session_key:
         # Generate a new session key and initialize the chat session
         session_key = secrets.token_urlsafe(16)
-        user_collection.update_one(
-            {"email": email},
-            {"$set": {f"savedChats.{session_key}": {
-                "chatTitle": question,
-                "messages": []
-            }}}
-        )
+        chat_repository.create_chat(email, session_key, question)
         return jsonify({"sessionKey": session_key})
 
-    chat_session = user.get('savedChats', {}).get(session_key)
+    # The conversation so far is read from the server, any history sent by the client is ignored
+    message_writer.wait_for(email)
+    history = chat_repository.recent_history(email, session_key)
+    if not history:
+        # Keys handed out before /createSession stored the chat have no chat document, the messages need one
+        chat_repository.create_chat(email, session_key, "")
 
     # Add the user's message to the session
     user_message = {
@@ -121,15 +151,19 @@ def ask():
         "text": question,
         "timestamp": datetime.now().isoformat()
     }
-    user_collection.update_one(
-        {"email": email},
-        {"$push": {f"savedChats.{session_key}.messages": user_message}}
-    )
+    message_writer.push(email, session_key, user_message)
+
+    metadata = {}
+    generation = generation_registry.start(email, session_key)
 
     def generate_response():
         full_response = "" 
+        failed = False
+        query = queryManager.make_query(question, history, metadata)
         try:
-            for chunk in queryManager.make_query(question, history):
+            for chunk in query:
+                if generation.cancelled:
+                    break
                 try:
                     chunk_data = json.loads(chunk)
                 except JSONDecodeError:
@@ -149,20 +183,23 @@ def ask():
 
 
         except Exception as e:
+            failed = True
             yield f"Error: {str(e)}"
             return
-        
-        bot_response = {
-            "sender": "bot",
-            "text": full_response,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        user_collection.update_one(
-            {"email": email},
-            {"$push": {f"savedChats.{session_key}.messages": bot_response}}
-        )
-    
+        finally:
+            # Closing the query closes the upstream LLM stream, on pause and on client disconnect alike
+            query.close()
+            if not failed:
+                bot_response = {
+                    "sender": "bot",
+                    "text": generation.final_text if generation.final_text is not None else full_response,
+                    "timestamp": datetime.now().isoformat()
+                }
+                message_writer.push(email, session_key, bot_response)
+            generation_registry.finish(generation)
+
+    if wants_sse(request, input_data):
+        return sse_response(stream_registry.start(generate_response(), metadata))
     return Response(stream_with_context(generate_response()), content_type='text/plain')
 
 
@@ -177,40 +214,29 @@ def pause_stream():
     if not all([email, session_key, last_message]):
         return jsonify({"error": "Missing required fields"}), 400
 
-    try:
-        max_attempts = 10
-        attempt = 0
-        while attempt < max_attempts:
-            user = user_collection.find_one({"email": email})
-            if not user or session_key not in user.get('savedChats', {}):
-                return jsonify({"error": "User or session not found"}), 404
-
-            chat_messages = user['savedChats'][session_key].get('messages', [])
-            if chat_messages and chat_messages[-1]['sender'] == 'bot':
-                # Remove the last bot message
-                user_collection.update_one(
-                    {"email": email},
-                    {"$pop": {f"savedChats.{session_key}.messages": 1}}
-                )
-
-                # Add the new bot message
-                bot_response = {
-                    "sender": "bot",
-                    "text": last_message['text'],
-                    "timestamp": datetime.now().isoformat()
-                }
-                user_collection.update_one(
-                    {"email": email},
-                    {"$push": {f"savedChats.{session_key}.messages": bot_response}}
-                )
-                return jsonify({"message": "Stream paused and message updated successfully"}), 200
-
-            # If last message is not from bot, wait and try again
-            time.sleep(0.5)
-            attempt += 1 
+    generation = generation_registry.cancel(email, session_key, last_message.get('text'))
+    if generation is not None:
+        # The ask route stops the LLM and stores the paused text as the answer as soon as it sees the cancellation
+        if not generation.wait_finished(PAUSE_FINALIZE_SECONDS):
+            return jsonify({"message": "Stream pause requested"}), 202
+        return jsonify({"message": "Stream paused and message updated successfully"}), 200
 
+    try:
+        # The answer was already stored, replace it with the text the client displayed
+        message_writer.wait_for(email)
+        if not chat_repository.chat_exists(email, session_key):
+            return jsonify({"error": "User or session not found"}), 404
+
+        last = chat_repository.last_message(email, session_key)
+        if last and last['sender'] == 'bot':
+            bot_response = {
+                "sender": "bot",
+                "text": last_message['text'],
+                "timestamp": datetime.now().isoformat()
+            }
+            message_writer.replace_last(email, session_key, bot_response)
         return jsonify({"message": "Stream paused and message updated successfully"}), 200
-    
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -220,12 +246,16 @@ def ask_guest():
         return '', 200
 
     input_data = request.json
+    if wants_sse(request, input_data):
+        resumed = resume_response(request)
+        if resumed is not None:
+            return resumed
+
     if not input_data or 'question' not in input_data:
         return jsonify({"error": "Required data is missing"}), 400
 
     session_key = input_data.get('sessionKey')
     question = input_data['question']
-    history = input_data.get('history', [])
 
     if not session_key:
         # Generate a new session key
@@ -237,12 +267,15 @@ def ask_guest():
         "text": question,
         "timestamp": datetime.now().isoformat()
     }
-    # Normally save the user_message to a session in a database, but skipping this step
+    # Guest chats are not saved to the database, their recent messages are kept in memory for the prompt history
+    history = guest_history.get(session_key)
+
+    metadata = {}
 
     def generate_response():
         full_response = "" 
         try:
-            for chunk in queryManager.make_query(question, history):  # Replace with actual query manager
+            for chunk in queryManager.make_query(question, history, metadata):  # Replace with actual query manager
                 try:
                     chunk_data = json.loads(chunk)
                 except json.JSONDecodeError:
@@ -261,8 +294,29 @@ def ask_guest():
             yield f"Error: {str(e)}"
             return
 
+        guest_history.append(session_key, user_message, {
+            "sender": "bot",
+            "text": full_response,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    if wants_sse(request, input_data):
+        return sse_response(stream_registry.start(generate_response(), metadata))
     return Response(stream_with_context(generate_response()), content_type='text/plain')
 
+@chat_bp.route('/stream/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    """
+    Resume an SSE answer after a dropped connection.
+    Replays every event after the Last-Event-ID header (or lastEventId query parameter), or the whole answer without one.
+    """
+    stream = stream_registry.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "Stream not found or has expired"}), 404
+    last_stream_id, last_seq = parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+    return sse_response(stream, last_seq if last_stream_id == stream_id else -1)
+
 @chat_bp.route('/update_chat_title', methods=['POST'])
 def update_chat_title():
     input_data = request.json
@@ -273,22 +327,12 @@ def update_chat_title():
     session_key = input_data['sessionKey']
     new_title = input_data['newTitle']
 
-    user = user_collection.find_one({"email": email})
-    if not user:
+    if not user_exists(email):
         return jsonify({"error": "User not found"}), 404
 
-    chat_session = user.get('savedChats', {}).get(session_key)
-    if not chat_session:
+    if not chat_repository.update_title(email, session_key, new_title):
         return jsonify({"error": "Session key not found"}), 404
 
-    result = user_collection.update_one(
-        {"email": email, f"savedChats.{session_key}": {"$exists": True}},
-        {"$set": {f"savedChats.{session_key}.chatTitle": new_title}}
-    )
-
-    if result.modified_count == 0:
-        return jsonify({"error": "Failed to update chat title"}), 500
-
     return jsonify({"message": "Chat title updated successfully", "sessionKey": session_key}), 200
 
 @chat_bp.route('/clear_chat', methods=['POST'])
@@ -304,26 +348,34 @@ def clear_chat():
 @chat_bp.route('/get_saved_chats', methods=['GET'])
 def get_saved_chats():
     """
-    This method gets the list off all saved chat sessions for a user.
+    This method gets one page of the saved chat sessions for a user, newest first.
+    Pass the returned nextCursor as cursor to get the next page.
     """
     email = request.args.get('email')
     if not email:
         return jsonify({"error": "Required data (email) is missing"}), 400
-    user = user_collection.find_one({"email": email}, {"_id": 0, "savedChats": 1})
-    if user and 'savedChats' in user:
-        saved_chats = user['savedChats']
-        sorted_sessions = sorted(
-            saved_chats.items(),
-            key=lambda item: datetime.strptime(
-                item[1]['messages'][0]['timestamp'], '%Y-%m-%dT%H:%M:%S.%f'
-            ) if item[1]['messages'] else datetime.min,
-            reverse=True
-        )
-        # get the sesison title for each key
-        sessions_info = [{"sessionKey": key, "chatTitle": value.get("chatTitle", "Untitled Chat")} for key, value in sorted_sessions]
-        return jsonify({"savedChatSessions": sessions_info}), 200
-    else:
+    try:
+        limit = min(max(int(request.args.get('limit', SAVED_CHATS_PAGE_SIZE)), 1), SAVED_CHATS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+
+    if not user_exists(email):
         return jsonify({"error": "User not found or no saved chats"}), 404
+    # Message counts are kept by the write-behind writer, let this user's queued messages land first
+    message_writer.wait_for(email)
+    try:
+        chats, next_cursor = chat_repository.list_chat_summaries(email, limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    sessions_info = [{
+        "sessionKey": chat["sessionKey"],
+        "chatTitle": chat.get("chatTitle", "Untitled Chat"),
+        "createdAt": chat["createdAt"].isoformat(),
+        "lastMessageAt": chat["lastMessageAt"].isoformat() if chat.get("lastMessageAt") else None,
+        "messageCount": chat.get("messageCount", 0)
+    } for chat in chats]
+    return jsonify({"savedChatSessions": sessions_info, "nextCursor": next_cursor}), 200
     
 
 @chat_bp.route('/delete_chat', methods=['POST'])
@@ -338,13 +390,11 @@ def delete_chat():
     email = input_data['email']
     session_key = input_data['sessionKey']
 
-    # Find and update the user's saved chats by removing the specific chat using the session key
-    result = user_collection.update_one(
-        {"email": email},
-        {"$unset": {f"savedChats.{session_key}": ""}} 
-    )
-    if result.matched_count == 0:
+    if not user_exists(email):
         return jsonify({"error": "User or session key not found"}), 404
+    # Let queued messages land first so they cannot outlive the chat
+    message_writer.wait_for(email)
+    chat_repository.delete_chat(email, session_key)
     return jsonify({"success": True, "message": f"Chat with session key '{session_key}' deleted"}), 200
 
 @chat_bp.route('/get_chat_by_session', methods=['POST'])
@@ -362,9 +412,9 @@ def get_chat_by_session_key():
     session_key = input_data['sessionKey']
 
     # Find the user and specific chat by session key
-    user = user_collection.find_one({"email": email}, {"_id": 0, f"savedChats.{session_key}": 1})
-    if user:
-        chat_data = user.get('savedChats', {}).get(session_key, None)
+    message_writer.wait_for(email)
+    if user_exists(email):
+        chat_data = chat_repository.get_chat(email, session_key)
         if chat_data:
             return jsonify({"email": email, "sessionKey": session_key, "messages": chat_data['messages']}), 200
         else:
@@ -486,12 +536,12 @@ def export_single_chat_to_pdf():
     session_key = input_data['sessionKey']
 
     # Fetch the user and t chat sessio
-    user = user_collection.find_one({"email": email}, {"_id": 0, f"savedChats.{session_key}": 1})
-    if not user:
+    message_writer.wait_for(email)
+    if not user_exists(email):
         return jsonify({"error": "User not found or no saved chats"}), 404
 
     # retrieve the specific chat session
-    chat_session = user.get('savedChats', {}).get(session_key, None)
+    chat_session = chat_repository.get_chat(email, session_key)
     if not chat_session:
         return jsonify({"error": "Session key not found"}), 404
 
@@ -508,6 +558,24 @@ def export_single_chat_to_pdf():
     # Send the pdf as a response
     return send_file(pdf_buffer, as_attachment=True, download_name=f"{chat_sessions[0]['chatTitle']}.pdf", mimetype='application/pdf')
 
+@chat_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Report cache and vector index counters for the TA chatbot query path.
+    """
+    return jsonify({
+        "answerCache": queryManager.answer_cache.stats(),
+        "embeddingCache": queryManager.embeddings.stats(),
+        "vectorIndex": queryManager.text_index.stats(),
+        "retrievalCache": retrieval_cache.stats(),
+        "sessionIndex": session_index_cache.stats(),
+        "retention": session_retention.stats(),
+        "mongo": mongo.stats(),
+        "sseStreams": stream_registry.stats(),
+        "chatWriter": message_writer.stats(),
+        "generations": generation_registry.stats()
+    }), 200
+
 @chat_bp.route('/suggestions', methods=['GET'])
 def get_suggestions():
     """
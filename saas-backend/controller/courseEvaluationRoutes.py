@@ -18,10 +18,14 @@ from langchain.chains import ConversationalRetrievalChain
 from vectorsMongoDB.loadEvaluation import LoadEvaluation
 from vectorsMongoDB.generateEvaluationEmbedding import GenerateEvaluation
 import vectorsMongoDB.CEqueryManager as queryManager 
+from service.conversation_history import HISTORY_MAX_MESSAGES, with_token_count
+from service.stream_replay import stream_registry, wants_sse, sse_response, resume_response, parse_last_event_id
+from service.upload_jobs import MONGODB_UPLOAD_JOBS, UploadJobs, pending_jobs
+from service.session_retention import now_utc, session_retention
 import time
 from dotenv import load_dotenv
 import os
-from pymongo import MongoClient
+from repository.mongo_connection import get_database
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -31,6 +35,8 @@ import io
 from werkzeug.utils import secure_filename
 import mimetypes
 import chardet
+import shutil
+import tempfile
 
 # Load environment variables
 load_dotenv()
@@ -39,10 +45,11 @@ MONGODB_TEMPUSER = os.getenv('MONGODB_TEMPUSER')
 MONGODB_DB = os.getenv('MONGODB_DATABASE')
 from bson import ObjectId
 
-# Connect to MongoDB
-client = MongoClient(MONGODB_URI)
-db = client[MONGODB_DB]
+# Connections come from the process wide manager, see repository/mongo_connection.py
+db = get_database(MONGODB_DB)
 user_collection = db[MONGODB_TEMPUSER]
+# Creates its indexes with the first upload
+upload_jobs = UploadJobs(db[MONGODB_UPLOAD_JOBS], user_collection)
 eval_bp = Blueprint('courseEvaluation', __name__)
 CORS(eval_bp, resources={r"/*": {"origins": "*"}})
 
@@ -70,11 +77,14 @@ class Document:
 
 @eval_bp.route('/start_session', methods=['GET'])
 def start_session():
+    session_retention.ensure_started()
     session_id = secrets.token_urlsafe(16)
     user = {
         '_id': ObjectId(),
         'session_id': session_id,
-        'embeddings': []  
+        'embeddings': [],
+        # Sessions are removed CE_SESSION_RETENTION_SECONDS after their last use, see service/session_retention.py
+        'lastActiveAt': now_utc()
     }
     user_collection.insert_one(user)
     
@@ -117,56 +127,102 @@ def upload_file():
         encoding = result['encoding'] if result['encoding'] else 'utf-8'
         file.stream.seek(0)
 
-        loader = LoadEvaluation()
-        try:
-            documents = loader.load_from_stream(file.stream, file_type, encoding=encoding)
-        except ValueError as ve:
-            return jsonify({"error": str(ve)}), 400
-        except Exception as e:
-            return jsonify({"error": f"Error processing file: {str(e)}"}), 500
-
-        if not documents:
-            return jsonify({"error": "No content could be extracted from the file"}), 400
-
         if not session_id:
             session_id = secrets.token_urlsafe(16)
 
-        generator = GenerateEvaluation()
-        success = generator.generate_embeddings(session_id, documents)
-
-        if success:
-            return jsonify({"message": "File processed successfully", "session_id": session_id}), 200
-        else:
-            return jsonify({"error": "Failed to process file"}), 500
+        # The request's stream is closed once the response is sent, the job reads its own copy
+        upload = tempfile.TemporaryFile()
+        shutil.copyfileobj(file.stream, upload)
+        upload.seek(0)
+
+        def process(report):
+            report(state="parsing")
+            # Chunks are embedded while the rest of the file is still being read
+            documents = LoadEvaluation().iter_from_stream(upload, file_type, encoding=encoding)
+            counts = {}
+
+            def progress(parsed, embedded, stored):
+                counts.update(chunksParsed=parsed, chunksEmbedded=embedded, chunksStored=stored)
+                report(state="embedding", **counts)
+
+            try:
+                stored = GenerateEvaluation().generate_embeddings(session_id, documents, progress)
+            finally:
+                # A failed upload removes its chunks again, a new version still makes every worker reload the index
+                evaluation_version = secrets.token_hex(8)
+                user_collection.update_one({'session_id': session_id},
+                                           {'$set': {'evaluation_version': evaluation_version,
+                                                     'lastActiveAt': now_utc()}})
+            if not stored:
+                if not counts:
+                    raise ValueError("No content could be extracted from the file")
+                raise RuntimeError("Failed to process file")
+            # The first question in this worker is then answered without reading the chunks
+            queryManager.eval_index.preload(session_id, evaluation_version)
+
+        job = upload_jobs.submit(session_id, filename, process, cleanup=upload.close)
+        body = {
+            "session_id": session_id,
+            "job_id": job["jobId"],
+            "state": job["state"],
+            "status_url": f"/courseEvaluation/upload/{job['jobId']}",
+        }
+        if job["state"] == "ready":
+            return jsonify({"message": "File processed successfully", **body}), 200
+        if job["state"] == "failed":
+            return jsonify({"error": job.get("error") or "Failed to process file", **body}), 400
+        # Parsing and embedding go on in the background, poll status_url until the job is ready
+        return jsonify({"message": "File accepted for processing", **body}), 202
 
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
 
+@eval_bp.route('/upload/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    """
+    Report the progress of an upload: its state and the number of chunks parsed, embedded and stored.
+    """
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Upload job not found or has expired"}), 404
+    return jsonify(job), 200
+
+
 @eval_bp.route('/ask', methods=['POST', 'OPTIONS'])
 def ask():
     if request.method == 'OPTIONS':
         return '', 200
     
     input_data = request.json
+    if wants_sse(request, input_data):
+        # A reconnect carrying Last-Event-ID continues the existing answer instead of generating a new one
+        resumed = resume_response(request)
+        if resumed is not None:
+            return resumed
+
     if not input_data or 'question' not in input_data:
         return jsonify({"error": "Required data is missing"}), 400
 
     question = input_data.get('question')
     session_id = input_data.get('session_id') 
-    history = input_data.get('history', [])
 
     if not session_id:
         return jsonify({"error": "Session ID is required"}), 400
 
-    session_data = user_collection.find_one({'session_id': session_id})
+    session_retention.ensure_started()
+    # The history of the session is kept on the server, only its latest messages are read
+    session_data = user_collection.find_one(
+        {'session_id': session_id},
+        {'chat_history': {'$slice': -HISTORY_MAX_MESSAGES}, 'embeddings': 0}
+    )
 
     if not session_data:
         return jsonify({"error": "Session not found or has expired"}), 404
-    
-    # Initialize chat_history in session if not present
-    if 'chat_history' not in session_data:
-        session_data['chat_history'] = []
+    pending = pending_jobs(session_data)
+    if pending:
+        return jsonify({"error": "The uploaded evaluation is still being processed", "jobs": pending}), 409
+    history = session_data.get('chat_history', [])
 
     # Store the user's question
     user_message = {
@@ -174,12 +230,14 @@ def ask():
         'sender': 'user',
         'text': question
     }
-    session_data['chat_history'].append(user_message)
+
+    metadata = {}
 
     def generate_response():
         full_response = "" 
         try:
-            for chunk in queryManager.make_query(question, session_id, history):
+            for chunk in queryManager.make_query(question, session_id, history, metadata,
+                                                 session_data.get('evaluation_version')):
                 try:
                     chunk_data = json.loads(chunk)
                 except JSONDecodeError:
@@ -199,16 +257,34 @@ def ask():
             yield f"Error: {str(e)}"
             return
         finally:
-            # After the response is fully generated, store it in the session
+            # After the response is fully generated, store the question and answer with their token counts
             bot_message = {
                 'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
                 'sender': 'bot',
                 'text': full_response
             }
-            session_data['chat_history'].append(bot_message)
-    
+            user_collection.update_one(
+                {'_id': session_data['_id']},
+                {'$push': {'chat_history': {'$each': [with_token_count(user_message), with_token_count(bot_message)]}},
+                 '$set': {'lastActiveAt': now_utc()}}
+            )
+
+    if wants_sse(request, input_data):
+        return sse_response(stream_registry.start(generate_response(), metadata))
     return Response(stream_with_context(generate_response()), content_type='text/plain')
 
+@eval_bp.route('/stream/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    """
+    Resume an SSE answer after a dropped connection, replaying every event after Last-Event-ID.
+    """
+    stream = stream_registry.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "Stream not found or has expired"}), 404
+    last_stream_id, last_seq = parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+    return sse_response(stream, last_seq if last_stream_id == stream_id else -1)
+
 def generate_pdf(chat_sessions):
     """
     Generate a PDF file containing the chat history.
@@ -4,7 +4,7 @@ This file contains the routes for the user API.
 @author Sanjit Verma (skverma) and Dinesh Kannan
 '''
 from flask import Blueprint, request, jsonify, session
-from pymongo import MongoClient
+from repository.mongo_connection import get_database
 from flask_jwt_extended import create_access_token, unset_jwt_cookies
 from flask_mail import Message
 from service.user_service import UserService
@@ -22,9 +22,8 @@ MONGODB_DB = os.getenv('MONGODB_DATABASE')
 MONGODB_WHITELIST = os.getenv('MONGODB_WHITELIST_USERS')
 MONGODB_ACCESSCODES = os.getenv('MONGODB_ACCESSCODES')
 
-# Connect to MongoDB
-client = MongoClient(MONGODB_URI)
-db = client[MONGODB_DB]
+# Connections come from the process wide manager, see repository/mongo_connection.py
+db = get_database(MONGODB_DB)
 user_collection = db[MONGODB_USERS]
 whitelist_collection = db[MONGODB_WHITELIST]
 access_codes_collection = db[MONGODB_ACCESSCODES]
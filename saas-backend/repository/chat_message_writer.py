@@ -0,0 +1,182 @@
+'''
+This module contains the ChatMessageWriter class, a write-behind persistence layer for chat messages.
+
+The ask routes used to do one MongoDB round trip for the user's message and another for the bot's answer while the
+answer was streaming. Messages are now put on a bounded in-process queue and a background thread writes them in
+batches through the ChatRepository: the messages of every chat in a batch are sent as a single ordered bulk_write.
+Each queued write returns a Future that resolves once the batch containing it is acknowledged by MongoDB, and the
+queue is flushed when the process exits.
+'''
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from dotenv import load_dotenv
+from repository.chat_repository import ChatRepository, next_seq
+
+load_dotenv()
+logger = logging.getLogger()
+
+CHAT_WRITE_BEHIND_ENABLED = os.getenv('CHAT_WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+CHAT_WRITE_QUEUE_SIZE = int(os.getenv('CHAT_WRITE_QUEUE_SIZE', '10000'))
+CHAT_WRITE_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BATCH_SIZE', '500'))
+CHAT_WRITE_FLUSH_SECONDS = float(os.getenv('CHAT_WRITE_FLUSH_SECONDS', '0.05'))
+
+
+class _Write:
+    """One queued update: a message to append or the removal of the last message of a chat."""
+
+    def __init__(self, email, session_key, operation, message=None):
+        self.email = email
+        self.session_key = session_key
+        self.operation = operation
+        self.message = message
+        # Taken when the write is queued so messages keep the order they were produced in
+        self.seq = next_seq() if operation == "push" else None
+        self.future = Future()
+
+
+class ChatMessageWriter:
+    def __init__(self, repository: ChatRepository, max_queue=CHAT_WRITE_QUEUE_SIZE, batch_size=CHAT_WRITE_BATCH_SIZE,
+                 flush_seconds=CHAT_WRITE_FLUSH_SECONDS, enabled=CHAT_WRITE_BEHIND_ENABLED):
+        """Initialize the writer for a chat repository. With enabled=False every write goes to MongoDB directly."""
+        self.repository = repository
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.enabled = enabled
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.batches = 0
+        self.writes = 0
+        self.failures = 0
+
+    def _ensure_started(self):
+        # Started on first use so a worker forked after import gets its own thread
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="chat-message-writer", daemon=True)
+                    self._thread.start()
+
+    def _enqueue(self, write: _Write):
+        with self._lock:
+            self._latest[write.email] = write.future
+        if not self.enabled or self._closed:
+            self._write_batch([write])
+            return write.future
+        self._ensure_started()
+        # Blocks when the queue is full, which pushes back on the ask routes instead of growing without bound
+        self._queue.put(write)
+        return write.future
+
+    def push(self, email, session_key, message) -> Future:
+        """Queue a message to be appended to a chat."""
+        return self._enqueue(_Write(email, session_key, "push", message))
+
+    def replace_last(self, email, session_key, message) -> Future:
+        """Queue the replacement of the last message of a chat, as written by pause_stream."""
+        self._enqueue(_Write(email, session_key, "pop"))
+        return self.push(email, session_key, message)
+
+    def wait_for(self, email, timeout=5.0):
+        """
+        Wait until every write queued so far for a user is in MongoDB, so a following read sees them.
+        Returns False if the writes did not finish within the timeout.
+        """
+        with self._lock:
+            pending = self._latest.get(email)
+        if pending is None:
+            return True
+        try:
+            pending.result(timeout)
+        except Exception:
+            # The failure was already logged by the writer thread, the read goes ahead with what is stored
+            pass
+        return pending.done()
+
+    def flush(self, timeout=10.0):
+        """Wait until the queue is drained. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=10.0):
+        """Flush the queue and stop accepting write-behind writes; later writes go to MongoDB directly."""
+        flushed = self.flush(timeout)
+        self._closed = True
+        if not flushed:
+            logger.warning(f"Chat message writer closed with {self._queue.qsize()} unwritten messages")
+        return flushed
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _apply(self, batch):
+        """Insert runs of messages with one bulk_write each; removals are applied in order between them."""
+        inserts = []
+        for write in batch:
+            if write.operation == "push":
+                inserts.append((write.email, write.session_key, write.seq, write.message))
+                continue
+            self.repository.write_messages(inserts)
+            inserts = []
+            self.repository.pop_last_message(write.email, write.session_key)
+        self.repository.write_messages(inserts)
+
+    def _write_batch(self, batch):
+        try:
+            self._apply(batch)
+        except Exception as e:
+            self.failures += len(batch)
+            logger.error(f"Failed to write {len(batch)} chat messages: {e}")
+            for write in batch:
+                write.future.set_exception(e)
+        else:
+            self.batches += 1
+            self.writes += len(batch)
+            for write in batch:
+                write.future.set_result(True)
+        finally:
+            with self._lock:
+                for write in batch:
+                    if self._latest.get(write.email) is write.future:
+                        del self._latest[write.email]
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "writes": self.writes,
+            "failures": self.failures,
+        }
+
+
+def register_shutdown_flush(writer: ChatMessageWriter):
+    """Flush queued messages when the interpreter exits."""
+    atexit.register(writer.close)
@@ -0,0 +1,308 @@
+'''
+This module contains the ChatRepository class, which stores TA chat sessions outside of the user document.
+
+Each chat is one document in the chats collection and each message one document in the messages collection, indexed
+on (email, sessionKey, seq). A question therefore never loads a user's whole history, and the user document no
+longer grows towards the 16MB BSON limit. Users whose chats still live under savedChats are moved over online, the
+first time one of their chats is touched or with the migration command:
+
+    python repository/chat_repository.py
+'''
+import base64
+import binascii
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.collection import Collection
+
+if __name__ == '__main__':
+    # Make the service package importable when this file is run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from service.conversation_history import HISTORY_MAX_MESSAGES, HISTORY_TOKEN_BUDGET, budget_window, with_token_count
+
+load_dotenv()
+logger = logging.getLogger()
+
+MONGODB_CHATS = os.getenv('MONGODB_CHATS', 'MONGODB_CHATS')
+MONGODB_MESSAGES = os.getenv('MONGODB_MESSAGES', 'MONGODB_MESSAGES')
+
+# Fields of the per chat summary served to the sidebar
+SUMMARY_FIELDS = {"_id": 0, "sessionKey": 1, "chatTitle": 1, "createdAt": 1, "lastMessageAt": 1, "messageCount": 1}
+
+_seq_lock = threading.Lock()
+_last_seq = 0
+
+
+def next_seq():
+    """
+    Return a message sequence number that is larger than every earlier one of this process.
+    Based on the clock so that numbers from different workers interleave in time order.
+    """
+    global _last_seq
+    with _seq_lock:
+        _last_seq = max(_last_seq + 1, time.time_ns())
+        return _last_seq
+
+
+def _parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_cursor(chat):
+    """Encode the sort position of a chat summary as an opaque pagination cursor."""
+    position = {"createdAt": chat["createdAt"].isoformat(), "sessionKey": chat["sessionKey"]}
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor(). Raises ValueError when it is malformed."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(position["createdAt"]), position["sessionKey"]
+    except (KeyError, TypeError, UnicodeError, json.JSONDecodeError, binascii.Error) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+class ChatRepository:
+    def __init__(self, chats: Collection, messages: Collection, users: Collection):
+        """Initialize the ChatRepository with the chats, messages and users collections."""
+        self.chats = chats
+        self.messages = messages
+        self.users = users
+        self._migrated = set()
+        self._migrated_lock = threading.Lock()
+        self._indexes_ready = False
+
+    def ensure_indexes(self):
+        """Create the indexes the chat routes query by. Safe to call on every start."""
+        self._indexes_ready = True
+        self.chats.create_index([("email", ASCENDING), ("sessionKey", ASCENDING)], unique=True)
+        # Serves the sidebar: newest chats of a user first, sessionKey breaks ties between equal timestamps
+        self.chats.create_index([("email", ASCENDING), ("createdAt", DESCENDING), ("sessionKey", DESCENDING)])
+        self.messages.create_index([("email", ASCENDING), ("sessionKey", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+    # Migration from savedChats
+
+    def ensure_migrated(self, email):
+        """Move a user's savedChats into the chat collections if that has not happened yet."""
+        if not self._indexes_ready:
+            # On first use rather than at import, which would connect before a pre-fork server forks its workers
+            self.ensure_indexes()
+        if email in self._migrated:
+            return
+        legacy = self.users.find_one({"email": email, "savedChats": {"$exists": True, "$ne": {}}}, {"_id": 1})
+        if legacy is not None:
+            self.migrate_user(email)
+        with self._migrated_lock:
+            self._migrated.add(email)
+
+    def migrate_user(self, email):
+        """
+        Copy every chat under savedChats into the chat collections and remove it from the user document.
+        Copies are idempotent upserts and a chat is only unset while its message count is unchanged, so the
+        migration can run while old workers are still writing to savedChats. Returns the number of chats moved.
+        """
+        moved = 0
+        while True:
+            user = self.users.find_one({"email": email}, {"_id": 0, "savedChats": 1})
+            saved_chats = (user or {}).get("savedChats") or {}
+            if not saved_chats:
+                return moved
+            for session_key, chat in saved_chats.items():
+                if not isinstance(chat, dict):
+                    self.users.update_one({"email": email}, {"$unset": {f"savedChats.{session_key}": ""}})
+                    continue
+                messages = chat.get("messages", [])
+                self._copy_chat(email, session_key, chat.get("chatTitle", ""), messages)
+                unchanged = {"$size": len(messages)} if "messages" in chat else {"$exists": False}
+                result = self.users.update_one(
+                    {"email": email, f"savedChats.{session_key}.messages": unchanged},
+                    {"$unset": {f"savedChats.{session_key}": ""}}
+                )
+                moved += result.modified_count
+
+    def _copy_chat(self, email, session_key, title, messages):
+        created_at = (_parse_timestamp(messages[0].get("timestamp")) if messages else None) or datetime.now()
+        last_message_at = _parse_timestamp(messages[-1].get("timestamp")) if messages else None
+        self.chats.update_one(
+            {"email": email, "sessionKey": session_key},
+            {"$setOnInsert": {"chatTitle": title, "createdAt": created_at,
+                              "lastMessageAt": last_message_at, "messageCount": len(messages)}},
+            upsert=True
+        )
+        if messages:
+            # Legacy messages get small sequence numbers, so they sort before everything written since
+            self.messages.bulk_write([
+                UpdateOne(
+                    {"email": email, "sessionKey": session_key, "seq": seq},
+                    {"$setOnInsert": dict(message)},
+                    upsert=True
+                )
+                for seq, message in enumerate(messages)
+            ], ordered=False)
+
+    # Chats
+
+    def create_chat(self, email, session_key, title):
+        self.ensure_migrated(email)
+        self.chats.update_one(
+            {"email": email, "sessionKey": session_key},
+            {"$setOnInsert": {"chatTitle": title, "createdAt": datetime.now(), "lastMessageAt": None, "messageCount": 0}},
+            upsert=True
+        )
+
+    def chat_exists(self, email, session_key):
+        self.ensure_migrated(email)
+        return self.chats.find_one({"email": email, "sessionKey": session_key}, {"_id": 1}) is not None
+
+    def list_chat_summaries(self, email, limit, cursor=None):
+        """
+        Return one page of a user's chat summaries, newest first, and the cursor of the next page (None on the last).
+        The page is read from the (email, createdAt, sessionKey) index, so its cost does not depend on how many chats
+        or messages the user has.
+        """
+        self.ensure_migrated(email)
+        query = {"email": email}
+        if cursor:
+            created_at, session_key = decode_cursor(cursor)
+            query["$or"] = [
+                {"createdAt": {"$lt": created_at}},
+                {"createdAt": created_at, "sessionKey": {"$lt": session_key}},
+            ]
+        chats = list(self.chats.find(query, SUMMARY_FIELDS)
+                     .sort([("createdAt", DESCENDING), ("sessionKey", DESCENDING)])
+                     .limit(limit + 1))
+        for chat in chats:
+            if "messageCount" not in chat:
+                self._backfill_summary(email, chat)
+        next_cursor = encode_cursor(chats[limit - 1]) if len(chats) > limit else None
+        return chats[:limit], next_cursor
+
+    def _backfill_summary(self, email, chat):
+        # Chats written before summaries existed get them the first time they are listed
+        last = self.messages.find_one(
+            {"email": email, "sessionKey": chat["sessionKey"]}, {"timestamp": 1}, sort=[("seq", DESCENDING)]
+        )
+        chat["messageCount"] = self.messages.count_documents({"email": email, "sessionKey": chat["sessionKey"]})
+        chat["lastMessageAt"] = _parse_timestamp(last.get("timestamp")) if last else None
+        self.chats.update_one(
+            {"email": email, "sessionKey": chat["sessionKey"], "messageCount": {"$exists": False}},
+            {"$set": {"messageCount": chat["messageCount"], "lastMessageAt": chat["lastMessageAt"]}}
+        )
+
+    def get_chat(self, email, session_key):
+        """Return a chat with its messages in order, or None if it does not exist."""
+        self.ensure_migrated(email)
+        chat = self.chats.find_one({"email": email, "sessionKey": session_key}, {"_id": 0})
+        if chat is None:
+            return None
+        chat["messages"] = list(self.messages.find(
+            {"email": email, "sessionKey": session_key}, {"_id": 0, "email": 0, "sessionKey": 0, "seq": 0}
+        ).sort("seq", ASCENDING))
+        return chat
+
+    def update_title(self, email, session_key, title):
+        """Set the title of a chat. Returns False if the chat does not exist."""
+        self.ensure_migrated(email)
+        result = self.chats.update_one({"email": email, "sessionKey": session_key}, {"$set": {"chatTitle": title}})
+        return result.matched_count > 0
+
+    def delete_chat(self, email, session_key):
+        """Delete a chat and its messages. Returns False if the chat does not exist."""
+        self.ensure_migrated(email)
+        result = self.chats.delete_one({"email": email, "sessionKey": session_key})
+        self.messages.delete_many({"email": email, "sessionKey": session_key})
+        return result.deleted_count > 0
+
+    def delete_untitled_chats(self, email):
+        """
+        Delete the chats of a user that were never given a title and have no messages. A chat whose first answer was
+        stopped or failed never gets a title from the frontend, but its messages are kept.
+        """
+        self.ensure_migrated(email)
+        for chat in self.chats.find({"email": email, "chatTitle": "", "messageCount": 0}, {"sessionKey": 1}):
+            self.delete_chat(email, chat["sessionKey"])
+
+    # Messages
+
+    def last_message(self, email, session_key):
+        self.ensure_migrated(email)
+        return self.messages.find_one(
+            {"email": email, "sessionKey": session_key}, {"_id": 0}, sort=[("seq", DESCENDING)]
+        )
+
+    def recent_history(self, email, session_key, budget=HISTORY_TOKEN_BUDGET, max_messages=HISTORY_MAX_MESSAGES):
+        """Return the latest messages of a chat that fit in the token budget, oldest first."""
+        self.ensure_migrated(email)
+        latest = list(self.messages.find(
+            {"email": email, "sessionKey": session_key}, {"_id": 0, "sender": 1, "text": 1, "tokens": 1}
+        ).sort("seq", DESCENDING).limit(max_messages))
+        latest.reverse()
+        return budget_window(latest, budget)
+
+    def write_messages(self, messages):
+        """
+        Store a batch of (email, session_key, seq, message) tuples with one bulk_write, then update the summary
+        of every chat they belong to with one more.
+        """
+        if not self._indexes_ready:
+            self.ensure_indexes()
+        if not messages:
+            return
+        # Token counts are stored with the message so the prompt history never has to tokenize it again
+        self.messages.bulk_write([
+            InsertOne({**with_token_count(message), "email": email, "sessionKey": session_key, "seq": seq})
+            for email, session_key, seq, message in messages
+        ], ordered=True)
+
+        summaries = {}
+        for email, session_key, _, message in messages:
+            count, last_at = summaries.get((email, session_key), (0, None))
+            timestamp = _parse_timestamp(message.get("timestamp"))
+            if timestamp is not None and (last_at is None or timestamp > last_at):
+                last_at = timestamp
+            summaries[(email, session_key)] = (count + 1, last_at)
+        self.chats.bulk_write([
+            # Chats without a summary yet are left to _backfill_summary, which counts from scratch
+            UpdateOne(
+                {"email": email, "sessionKey": session_key, "messageCount": {"$exists": True}},
+                {"$inc": {"messageCount": count}, "$max": {"lastMessageAt": last_at}}
+                if last_at is not None else {"$inc": {"messageCount": count}}
+            )
+            for (email, session_key), (count, last_at) in summaries.items()
+        ], ordered=False)
+
+    def pop_last_message(self, email, session_key):
+        last = self.messages.find_one(
+            {"email": email, "sessionKey": session_key}, {"_id": 1}, sort=[("seq", DESCENDING)]
+        )
+        if last is not None:
+            self.messages.delete_one({"_id": last["_id"]})
+            self.chats.update_one(
+                {"email": email, "sessionKey": session_key, "messageCount": {"$gt": 0}},
+                {"$inc": {"messageCount": -1}}
+            )
+
+
+if __name__ == '__main__':
+    from repository.mongo_connection import get_database
+
+    logging.basicConfig(level=logging.INFO)
+    db = get_database()
+    repository = ChatRepository(db[MONGODB_CHATS], db[MONGODB_MESSAGES], db[os.getenv('MONGODB_USERS')])
+    repository.ensure_indexes()
+    users = repository.users.find({"savedChats": {"$exists": True, "$ne": {}}}, {"email": 1})
+    for count, user in enumerate(users, start=1):
+        moved = repository.migrate_user(user["email"])
+        logger.info(f"Migrated {moved} chats of user {count}")
+    logger.info("Chat migration finished")
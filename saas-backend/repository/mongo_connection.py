@@ -0,0 +1,217 @@
+'''
+This module contains the MongoConnectionManager class, the one place the backend gets MongoDB connections from.
+
+Every route module and query manager used to build its own MongoClient at import, each with its own connection pool
+and monitoring threads, and every evaluation upload built another one. The manager owns a single MongoClient (and a
+single Motor client for asgi.py) per process with the pool sizes configured below. Modules get LazyDatabase and
+LazyCollection handles from it: they can be created at import, but the client is only created on first use, and it is
+created again in a child process after a fork, so pre-fork servers never share sockets between workers. Pool events
+are counted for /chat/metrics.
+'''
+import os
+import threading
+
+import pymongo
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+load_dotenv()
+
+MONGODB_URI = os.getenv('MONGODB_URI')
+MONGODB_DATABASE = os.getenv('MONGODB_DATABASE')
+MONGODB_MAX_POOL_SIZE = int(os.getenv('MONGODB_MAX_POOL_SIZE', '50'))
+MONGODB_MIN_POOL_SIZE = int(os.getenv('MONGODB_MIN_POOL_SIZE', '0'))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000'))
+# How long a request waits for a free connection before failing instead of queueing forever
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '10000'))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '10000'))
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts the connection pool events of the clients of one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.created = 0
+            self.closed = 0
+            self.checked_out = 0
+            self.check_outs = 0
+            self.check_out_failures = 0
+            self.pools_cleared = 0
+
+    def _count(self, **changes):
+        with self._lock:
+            for name, change in changes.items():
+                setattr(self, name, getattr(self, name) + change)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count(pools_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count(created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count(closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count(check_out_failures=1)
+
+    def connection_checked_out(self, event):
+        self._count(checked_out=1, check_outs=1)
+
+    def connection_checked_in(self, event):
+        self._count(checked_out=-1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open": self.created - self.closed,
+                "inUse": self.checked_out,
+                "created": self.created,
+                "closed": self.closed,
+                "checkOuts": self.check_outs,
+                "checkOutFailures": self.check_out_failures,
+                "poolsCleared": self.pools_cleared,
+            }
+
+
+class MongoConnectionManager:
+    def __init__(self, uri=MONGODB_URI, database=MONGODB_DATABASE, max_pool_size=MONGODB_MAX_POOL_SIZE,
+                 min_pool_size=MONGODB_MIN_POOL_SIZE, max_idle_time_ms=MONGODB_MAX_IDLE_TIME_MS,
+                 wait_queue_timeout_ms=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                 server_selection_timeout_ms=MONGODB_SERVER_SELECTION_TIMEOUT_MS):
+        """Initialize the manager; no connection is made until a collection is used."""
+        self.uri = uri
+        self.database_name = database
+        self.options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "maxIdleTimeMS": max_idle_time_ms,
+            "waitQueueTimeoutMS": wait_queue_timeout_ms,
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+        }
+        self.metrics = PoolMetrics()
+        self._client = None
+        self._async_client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.clients_created = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's sockets and monitor threads are unusable here; the next use opens a client for this process.
+        # The lock may have been held by another thread at fork time, so it is replaced rather than acquired.
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._pid = None
+        self.metrics = PoolMetrics()
+
+    def client(self):
+        """Return the MongoClient of this process, creating it on first use."""
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                # Looked up on the module at call time, so test/loadTest.py can swap in mongomock
+                self._client = pymongo.MongoClient(self.uri, event_listeners=[self.metrics], **self.options)
+                self._pid = os.getpid()
+                self.clients_created += 1
+            return self._client
+
+    def async_client(self):
+        """Return the Motor client of this process. Call it from inside the event loop that will use it."""
+        with self._lock:
+            if self._async_client is None:
+                from motor.motor_asyncio import AsyncIOMotorClient
+                self._async_client = AsyncIOMotorClient(self.uri, event_listeners=[self.metrics], **self.options)
+            return self._async_client
+
+    def database(self, name=None):
+        """Return a handle on a database that connects on first use."""
+        return LazyDatabase(self, name or self.database_name)
+
+    def collection(self, name, database=None):
+        return LazyCollection(self, database or self.database_name, name)
+
+    def async_database(self, name=None):
+        return self.async_client()[name or self.database_name]
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "connected": self._client is not None,
+            "clientsCreated": self.clients_created,
+            "maxPoolSize": self.options["maxPoolSize"],
+            **self.metrics.stats(),
+        }
+
+
+class LazyDatabase:
+    """Stands in for a pymongo Database; resolves the current client of the manager on every use."""
+
+    def __init__(self, manager, name):
+        self._manager = manager
+        self.name = name
+
+    def _database(self):
+        return self._manager.client()[self.name]
+
+    def __getitem__(self, collection_name):
+        return LazyCollection(self._manager, self.name, collection_name)
+
+    def __getattr__(self, attribute):
+        return getattr(self._database(), attribute)
+
+    def __repr__(self):
+        return f"LazyDatabase({self.name!r})"
+
+
+class LazyCollection:
+    """Stands in for a pymongo Collection; resolves the current client of the manager on every use."""
+
+    def __init__(self, manager, database_name, name):
+        self._manager = manager
+        self._database_name = database_name
+        self.name = name
+
+    def _collection(self):
+        return self._manager.client()[self._database_name][self.name]
+
+    def __getitem__(self, name):
+        return LazyCollection(self._manager, self._database_name, f"{self.name}.{name}")
+
+    def __getattr__(self, attribute):
+        return getattr(self._collection(), attribute)
+
+    def __repr__(self):
+        return f"LazyCollection({self._database_name!r}, {self.name!r})"
+
+
+mongo = MongoConnectionManager()
+
+
+def get_database(name=None):
+    """The database of MONGODB_DATABASE (or name) on the process wide connection."""
+    return mongo.database(name)
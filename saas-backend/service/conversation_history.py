@@ -0,0 +1,103 @@
+'''
+This module builds the conversation history that goes into the RAG prompts.
+
+History is owned by the server: TA chats read it from the messages collection, course evaluation sessions from their
+session document and guest chats from an in-process store. Every message carries its token count from the time it
+was written, so the prompt gets the most recent messages that fit in HISTORY_TOKEN_BUDGET without re-tokenizing the
+conversation on every question.
+'''
+import os
+import threading
+from collections import OrderedDict, deque
+
+from dotenv import load_dotenv
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken ships with langchain_openai, fall back to an estimate without it
+    tiktoken = None
+
+load_dotenv()
+
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '1500'))
+# Upper bound on the messages read per question, whatever their size
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', '40'))
+GUEST_HISTORY_MAX_SESSIONS = int(os.getenv('GUEST_HISTORY_MAX_SESSIONS', '10000'))
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Return the number of tokens of a text in the encoding of the OpenAI chat models."""
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def with_token_count(message):
+    """Return the message with its "tokens" field set, counting only if it is missing."""
+    if "tokens" in message:
+        return message
+    return {**message, "tokens": count_tokens(message.get("text", ""))}
+
+
+def budget_window(messages, budget=HISTORY_TOKEN_BUDGET):
+    """
+    Return the most recent messages whose tokens add up to at most budget, oldest first.
+    messages is in chronological order; messages without a stored count are counted here.
+    """
+    window = []
+    used = 0
+    for message in reversed(messages):
+        tokens = message.get("tokens")
+        if tokens is None:
+            tokens = count_tokens(message.get("text", ""))
+        if used + tokens > budget:
+            break
+        used += tokens
+        window.append(message)
+    window.reverse()
+    return window
+
+
+def format_history(messages):
+    """Format messages as "sender: text" lines for the prompt."""
+    return "".join(f"{message.get('sender', 'User')}: {message.get('text', '-')}\n" for message in messages)
+
+
+class GuestHistoryStore:
+    """
+    Recent messages of guest chats, which are not stored in MongoDB. Least recently used sessions are dropped first.
+    """
+
+    def __init__(self, max_sessions=GUEST_HISTORY_MAX_SESSIONS, max_messages=HISTORY_MAX_MESSAGES):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key):
+        with self._lock:
+            messages = self._sessions.get(session_key)
+            if messages is None:
+                return []
+            self._sessions.move_to_end(session_key)
+            return list(messages)
+
+    def append(self, session_key, *messages):
+        with self._lock:
+            history = self._sessions.get(session_key)
+            if history is None:
+                history = self._sessions[session_key] = deque(maxlen=self.max_messages)
+            history.extend(with_token_count(message) for message in messages)
+            self._sessions.move_to_end(session_key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+guest_history = GuestHistoryStore()
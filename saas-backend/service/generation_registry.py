@@ -0,0 +1,82 @@
+'''
+This module contains the GenerationRegistry class, which tracks the answers that are being generated per chat.
+
+Every /chat/ask answer registers itself under (email, sessionKey) with a cancellation token. Pausing a chat cancels
+the token: the ask route stops reading from the query manager and closes it, which closes the upstream LLM stream so
+no further tokens are generated or billed. Whatever was generated so far is stored as the bot message with a single
+write when the generation ends, whether it completed, was paused or lost its client.
+'''
+import threading
+
+
+class Generation:
+    """One answer being generated for a chat."""
+
+    def __init__(self, email, session_key):
+        self.email = email
+        self.session_key = session_key
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self.final_text = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self, final_text=None):
+        """
+        Stop the generation. final_text replaces the partial answer when it is stored, so the saved message matches
+        what the client displayed when it paused.
+        """
+        if final_text is not None:
+            self.final_text = final_text
+        self._cancelled.set()
+
+    def wait_finished(self, timeout):
+        return self._finished.wait(timeout)
+
+
+class GenerationRegistry:
+    def __init__(self):
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.cancelled = 0
+
+    def start(self, email, session_key):
+        """Register a new generation for a chat, cancelling one that is still running for it."""
+        generation = Generation(email, session_key)
+        with self._lock:
+            previous = self._generations.get((email, session_key))
+            self._generations[(email, session_key)] = generation
+            self.started += 1
+        if previous is not None:
+            previous.cancel()
+        return generation
+
+    def get(self, email, session_key):
+        with self._lock:
+            return self._generations.get((email, session_key))
+
+    def cancel(self, email, session_key, final_text=None):
+        """Cancel the running generation of a chat. Returns it, or None when nothing is running."""
+        generation = self.get(email, session_key)
+        if generation is not None:
+            generation.cancel(final_text)
+            with self._lock:
+                self.cancelled += 1
+        return generation
+
+    def finish(self, generation):
+        """Remove a generation once its answer has been stored."""
+        with self._lock:
+            if self._generations.get((generation.email, generation.session_key)) is generation:
+                del self._generations[(generation.email, generation.session_key)]
+        generation._finished.set()
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._generations), "started": self.started, "cancelled": self.cancelled}
+
+
+generation_registry = GenerationRegistry()
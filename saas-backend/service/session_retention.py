@@ -0,0 +1,204 @@
+'''
+This module contains the SessionRetention class, which expires temporary course evaluation sessions and their vectors.
+
+/courseEvaluation/start_session inserts a session document on every visit and every upload adds its chunks to
+MONGODB_VECTORS_COURSEEVALUATION_DOCS, and nothing removed either, so both collections (and the vector index that
+every evaluation question searches) grew forever. Session documents now carry lastActiveAt, which the routes set on
+every start, upload and question, and a TTL index removes them CE_SESSION_RETENTION_SECONDS after their last use.
+The vectors of a session cannot follow through a TTL index of their own, since an active session keeps using chunks
+uploaded long ago, so a background sweep deletes the chunks whose session document is gone. The sweep also gives
+lastActiveAt to sessions created before it existed. Only one worker sweeps at a time, holding a lease document in
+MongoDB, and the sizes of both collections and the documents removed are kept for /chat/metrics.
+'''
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from repository.mongo_connection import get_database
+
+load_dotenv()
+logger = logging.getLogger()
+
+MONGODB_TEMPUSER = os.getenv('MONGODB_TEMPUSER')
+MONGODB_VECTORS_COURSEEVALUATION_DOCS = os.getenv('MONGODB_VECTORS_COURSEEVALUATION_DOCS')
+MONGODB_RETENTION_LEASES = os.getenv('MONGODB_RETENTION_LEASES', 'MONGODB_RETENTION_LEASES')
+CE_RETENTION_ENABLED = os.getenv('CE_RETENTION_ENABLED', 'true').lower() == 'true'
+CE_SESSION_RETENTION_SECONDS = int(os.getenv('CE_SESSION_RETENTION_SECONDS', str(7 * 24 * 60 * 60)))
+CE_RETENTION_SWEEP_SECONDS = float(os.getenv('CE_RETENTION_SWEEP_SECONDS', '3600'))
+# Chunks younger than this are never swept, an upload may still be writing them for a session being created
+CE_ORPHAN_VECTOR_GRACE_SECONDS = float(os.getenv('CE_ORPHAN_VECTOR_GRACE_SECONDS', '3600'))
+# Sessions looked up and chunks deleted per round trip
+CE_RETENTION_BATCH_SIZE = int(os.getenv('CE_RETENTION_BATCH_SIZE', '500'))
+
+LEASE_ID = "course-evaluation-retention"
+
+
+def now_utc():
+    return datetime.now(timezone.utc)
+
+
+class SessionRetention:
+    def __init__(self, sessions_collection, vectors_collection, leases_collection,
+                 retention_seconds=CE_SESSION_RETENTION_SECONDS, sweep_seconds=CE_RETENTION_SWEEP_SECONDS,
+                 grace_seconds=CE_ORPHAN_VECTOR_GRACE_SECONDS, batch_size=CE_RETENTION_BATCH_SIZE,
+                 enabled=CE_RETENTION_ENABLED):
+        """Initialize the retention of the course evaluation sessions. With enabled=False nothing is ever removed."""
+        self.sessions = sessions_collection
+        self.vectors = vectors_collection
+        self.leases = leases_collection
+        self.retention_seconds = retention_seconds
+        self.sweep_seconds = sweep_seconds
+        self.grace_seconds = grace_seconds
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._thread = None
+        self._indexes_ready = False
+        self.sweeps = 0
+        self.failures = 0
+        self.sessions_backfilled = 0
+        self.vectors_deleted = 0
+        self.last_sweep = None
+        self.sizes = {}
+
+    def ensure_indexes(self):
+        """Create the TTL index of the sessions and the indexes the sweep reads the vectors through."""
+        try:
+            self.sessions.create_index("lastActiveAt", expireAfterSeconds=self.retention_seconds)
+        except OperationFailure:
+            # The index exists with another retention window, change it in place
+            self.sessions.database.command("collMod", self.sessions.name, index={
+                "keyPattern": {"lastActiveAt": 1},
+                "expireAfterSeconds": self.retention_seconds,
+            })
+        self.sessions.create_index("session_id")
+        self.vectors.create_index("source")
+        # Covers the sweep's $match on createdAt and $group on source, so it never fetches the chunks themselves
+        self.vectors.create_index([("createdAt", 1), ("source", 1)])
+
+    def ensure_started(self):
+        """Start the sweep thread of this process. Called on use so a worker forked after import gets its own."""
+        if not self.enabled:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self.owner = f"{socket.gethostname()}:{os.getpid()}"
+                    self._thread = threading.Thread(target=self._run, name="ce-retention", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if not self._indexes_ready:
+                    self.ensure_indexes()
+                    self._indexes_ready = True
+                if self._acquire_lease():
+                    self.sweep()
+                else:
+                    # Another worker sweeps, the sizes are still reported by this one
+                    self.measure()
+            except Exception as e:
+                self.failures += 1
+                logger.exception(f"Course evaluation retention sweep failed: {e}")
+            time.sleep(self.sweep_seconds)
+
+    def _acquire_lease(self):
+        """Take the sweep lease for one interval, or return False if another worker holds it."""
+        now = now_utc()
+        try:
+            self.leases.update_one(
+                {"_id": LEASE_ID, "leaseUntil": {"$lte": now}},
+                {"$set": {"leaseUntil": now + timedelta(seconds=self.sweep_seconds * 0.9), "owner": self.owner}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease document exists and has not expired, the upsert tried to insert a second one
+            return False
+
+    def sweep(self):
+        """Give lastActiveAt to sessions without one and delete the chunks of sessions that no longer exist."""
+        started = time.monotonic()
+        backfilled = self.sessions.update_many(
+            {"lastActiveAt": {"$exists": False}},
+            [{"$set": {"lastActiveAt": {"$toDate": "$_id"}}}]
+        ).modified_count
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.grace_seconds)
+        sources = self.vectors.aggregate([
+            {"$match": {"createdAt": {"$lt": cutoff}}},
+            {"$group": {"_id": "$source"}},
+        ], allowDiskUse=True)
+        deleted = 0
+        batch = []
+        for group in sources:
+            batch.append(group["_id"])
+            if len(batch) >= self.batch_size:
+                deleted += self._delete_orphans(batch, cutoff)
+                batch = []
+        if batch:
+            deleted += self._delete_orphans(batch, cutoff)
+
+        with self._lock:
+            self.sweeps += 1
+            self.sessions_backfilled += backfilled
+            self.vectors_deleted += deleted
+            self.last_sweep = {
+                "at": now_utc().isoformat(),
+                "owner": self.owner,
+                "seconds": round(time.monotonic() - started, 2),
+                "sessionsBackfilled": backfilled,
+                "vectorsDeleted": deleted,
+            }
+        if deleted or backfilled:
+            logger.info(f"Course evaluation retention: deleted {deleted} orphaned chunks, "
+                        f"backfilled {backfilled} sessions")
+        self.measure()
+
+    def _delete_orphans(self, sources, cutoff):
+        live = {document["session_id"] for document in
+                self.sessions.find({"session_id": {"$in": sources}}, {"_id": 0, "session_id": 1})}
+        orphans = [source for source in sources if source not in live]
+        if not orphans:
+            return 0
+        return self.vectors.delete_many({"source": {"$in": orphans}, "createdAt": {"$lt": cutoff}}).deleted_count
+
+    def measure(self):
+        """Read the document counts and sizes of both collections."""
+        sizes = {}
+        for name, collection in (("sessions", self.sessions), ("vectors", self.vectors)):
+            sizes[name] = {"documents": collection.estimated_document_count()}
+            try:
+                stats = next(collection.aggregate([{"$collStats": {"storageStats": {}}}]))["storageStats"]
+                sizes[name].update(bytes=stats.get("size"), storageBytes=stats.get("storageSize"))
+            except (OperationFailure, StopIteration, KeyError):
+                # $collStats needs the clusterMonitor role on some tiers, the count is enough then
+                pass
+        with self._lock:
+            self.sizes = sizes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "retentionSeconds": self.retention_seconds,
+                "sweeps": self.sweeps,
+                "failures": self.failures,
+                "sessionsBackfilled": self.sessions_backfilled,
+                "vectorsDeleted": self.vectors_deleted,
+                "lastSweep": self.last_sweep,
+                **self.sizes,
+            }
+
+
+db = get_database()
+session_retention = SessionRetention(db[MONGODB_TEMPUSER], db[MONGODB_VECTORS_COURSEEVALUATION_DOCS],
+                                     db[MONGODB_RETENTION_LEASES])
@@ -0,0 +1,186 @@
+'''
+This module contains the StreamReplayRegistry class, which backs the opt-in Server-Sent Events mode of the ask routes.
+
+An SSE answer is generated on a background thread into a bounded per-stream replay buffer. The HTTP response only
+reads from that buffer, so a dropped connection does not stop or lose the answer: a reconnect that sends
+Last-Event-ID resumes right after the last event the client saw instead of running the RAG pipeline again.
+Buffers live in the memory of one worker, so resumes have to reach the same worker (sticky sessions).
+'''
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+from flask import Response
+
+load_dotenv()
+
+SSE_REPLAY_BUFFER_EVENTS = int(os.getenv('SSE_REPLAY_BUFFER_EVENTS', '4096'))
+SSE_REPLAY_RETENTION_SECONDS = float(os.getenv('SSE_REPLAY_RETENTION_SECONDS', '300'))
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+
+
+def wants_sse(request, input_data=None):
+    """The SSE mode is opt-in through the Accept header or "stream": "sse" in the JSON body."""
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return True
+    return bool(input_data) and input_data.get('stream') == 'sse'
+
+
+def parse_last_event_id(value):
+    """Split a Last-Event-ID of the form <streamId>:<seq>, returning (None, None) when it is malformed."""
+    if not value or ':' not in value:
+        return None, None
+    stream_id, _, seq = value.rpartition(':')
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return None, None
+
+
+def format_event(stream_id, seq, event, data):
+    """Format one SSE frame. Data is JSON encoded so tokens containing newlines survive the framing."""
+    return f"id: {stream_id}:{seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ReplayStream:
+    """
+    The events of one generated answer: a "stream" event with the id, a "metadata" event, "token" events
+    and a final "done" event.
+    """
+
+    def __init__(self, stream_id, max_events=SSE_REPLAY_BUFFER_EVENTS):
+        self.id = stream_id
+        self.events = deque(maxlen=max_events)
+        self.next_seq = 0
+        self.finished_at = None
+        self.condition = threading.Condition()
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def append(self, event, data):
+        with self.condition:
+            self.events.append((self.next_seq, event, data))
+            self.next_seq += 1
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.finished_at = time.monotonic()
+            self.condition.notify_all()
+
+    def frames(self, after_seq=-1, keepalive_seconds=SSE_KEEPALIVE_SECONDS):
+        """
+        Yield SSE frames for every event after after_seq, waiting for new events until the stream is done.
+        """
+        position = after_seq
+        while True:
+            with self.condition:
+                pending = [event for event in self.events if event[0] > position]
+                if not pending and not self.done:
+                    self.condition.wait(keepalive_seconds)
+                    pending = [event for event in self.events if event[0] > position]
+                done = self.done
+                oldest = self.events[0][0] if self.events else 0
+
+            if position + 1 < oldest:
+                # The client is further behind than the replay buffer reaches
+                yield format_event(self.id, position, "error", {"error": "Replay window exceeded, ask again"})
+                return
+            if not pending and not done:
+                yield ": keep-alive\n\n"
+                continue
+            for seq, event, data in pending:
+                yield format_event(self.id, seq, event, data)
+                position = seq
+            if done and not pending:
+                return
+
+
+class StreamReplayRegistry:
+    """
+    Starts background generations and keeps their replay buffers until they expire.
+    """
+
+    def __init__(self, retention_seconds=SSE_REPLAY_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [stream_id for stream_id, stream in self._streams.items()
+                       if stream.done and now - stream.finished_at > self.retention_seconds]
+            for stream_id in expired:
+                del self._streams[stream_id]
+
+    def get(self, stream_id):
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def start(self, chunks, metadata):
+        """
+        Generate an answer in the background.
+        chunks is the text generator of an ask route; metadata is the dict the query manager fills while it
+        retrieves, and is sent as a "metadata" event right before the first token.
+        """
+        self._expire()
+        stream = ReplayStream(secrets.token_urlsafe(16))
+        with self._lock:
+            self._streams[stream.id] = stream
+        stream.append("stream", {"streamId": stream.id})
+
+        def produce():
+            metadata_sent = False
+            try:
+                for chunk in chunks:
+                    if not metadata_sent:
+                        stream.append("metadata", metadata)
+                        metadata_sent = True
+                    stream.append("token", chunk)
+                if not metadata_sent:
+                    stream.append("metadata", metadata)
+                stream.append("done", {})
+            except Exception as e:
+                stream.append("error", {"error": str(e)})
+            finally:
+                stream.finish()
+
+        threading.Thread(target=produce, name=f"sse-{stream.id}", daemon=True).start()
+        return stream
+
+    def stats(self):
+        with self._lock:
+            return {
+                "streams": len(self._streams),
+                "active": sum(1 for stream in self._streams.values() if not stream.done),
+            }
+
+
+stream_registry = StreamReplayRegistry()
+
+
+def sse_response(stream, after_seq=-1):
+    """Wrap the frames of a stream in a Flask response with headers that disable proxy buffering."""
+    return Response(
+        stream.frames(after_seq),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def resume_response(request):
+    """
+    Return an SSE response that resumes the stream named by the Last-Event-ID header (or lastEventId query
+    parameter), or None when there is no such stream on this worker.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    stream_id, last_seq = parse_last_event_id(last_event_id)
+    stream = stream_registry.get(stream_id) if stream_id else None
+    return sse_response(stream, last_seq) if stream else None
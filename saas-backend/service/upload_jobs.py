@@ -0,0 +1,144 @@
+'''
+This module contains the UploadJobs class, which runs course evaluation uploads in the background.
+
+/courseEvaluation/upload used to parse the file and embed every chunk inside the HTTP request, so large evaluation
+exports ran into proxy timeouts and held a worker for minutes. The route now copies the upload to a temporary file,
+registers a job and returns its id; a thread pool parses and embeds the file. Job documents in MongoDB hold the state
+(queued, parsing, embedding, ready or failed) and the number of chunks parsed, embedded and stored, so any worker can
+answer GET /courseEvaluation/upload/<job_id>. While a job runs its id is listed under pending_uploads in the session
+document, which /ask reads anyway, so questions wait for the evaluation without an extra query.
+'''
+import logging
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger()
+
+MONGODB_UPLOAD_JOBS = os.getenv('MONGODB_UPLOAD_JOBS', 'MONGODB_UPLOAD_JOBS')
+UPLOAD_JOBS_ENABLED = os.getenv('UPLOAD_JOBS_ENABLED', 'true').lower() == 'true'
+UPLOAD_JOB_WORKERS = int(os.getenv('UPLOAD_JOB_WORKERS', '2'))
+# A pending job older than this is assumed lost (its worker was restarted) and no longer holds up /ask
+UPLOAD_JOB_TIMEOUT_SECONDS = float(os.getenv('UPLOAD_JOB_TIMEOUT_SECONDS', '1800'))
+UPLOAD_JOB_RETENTION_SECONDS = int(os.getenv('UPLOAD_JOB_RETENTION_SECONDS', str(24 * 60 * 60)))
+
+PENDING_STATES = ("queued", "parsing", "embedding")
+JOB_FIELDS = {"_id": 0, "jobId": 1, "sessionId": 1, "filename": 1, "state": 1, "chunksParsed": 1,
+              "chunksEmbedded": 1, "chunksStored": 1, "error": 1, "createdAt": 1, "updatedAt": 1}
+
+
+def pending_jobs(session_document, now=None):
+    """Return the ids of the upload jobs that are still running for a session document."""
+    now = now or datetime.now(timezone.utc)
+    timeout = timedelta(seconds=UPLOAD_JOB_TIMEOUT_SECONDS)
+    pending = []
+    for job in session_document.get("pending_uploads", []):
+        started = job.get("startedAt")
+        if started is not None and started.tzinfo is None:
+            started = started.replace(tzinfo=timezone.utc)
+        if started is None or now - started < timeout:
+            pending.append(job.get("jobId"))
+    return pending
+
+
+class UploadJobs:
+    def __init__(self, jobs_collection, sessions_collection, workers=UPLOAD_JOB_WORKERS, enabled=UPLOAD_JOBS_ENABLED):
+        """
+        Initialize the job runner. sessions_collection holds the course evaluation session documents.
+        With enabled=False jobs run in the calling thread and submit returns once they are finished.
+        """
+        self.jobs = jobs_collection
+        self.sessions = sessions_collection
+        self.workers = workers
+        self.enabled = enabled
+        self._executor = None
+        self._lock = threading.Lock()
+        self._running = 0
+        self._indexes_ready = False
+        self.completed = 0
+        self.failed = 0
+
+    def ensure_indexes(self):
+        self._indexes_ready = True
+        self.jobs.create_index("jobId", unique=True)
+        # Finished and abandoned jobs are removed by MongoDB after the retention period
+        self.jobs.create_index("createdAt", expireAfterSeconds=UPLOAD_JOB_RETENTION_SECONDS)
+
+    def _get_executor(self):
+        # Created on first use so a worker forked after import gets its own threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload-job")
+            return self._executor
+
+    def submit(self, session_id, filename, work, cleanup=None):
+        """
+        Register a job and run work(report) for it. work parses and embeds the upload, calling
+        report(state=..., chunksParsed=..., ...) as it goes, and raises on failure. cleanup runs after it either way.
+        Returns the job document.
+        """
+        if not self._indexes_ready:
+            # On first use rather than at import, which would connect before a pre-fork server forks its workers
+            self.ensure_indexes()
+        now = datetime.now(timezone.utc)
+        job = {
+            "jobId": secrets.token_urlsafe(16),
+            "sessionId": session_id,
+            "filename": filename,
+            "state": "queued",
+            "chunksParsed": 0,
+            "chunksEmbedded": 0,
+            "chunksStored": 0,
+            "error": None,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        self.jobs.insert_one(dict(job))
+        self.sessions.update_one(
+            {"session_id": session_id},
+            {"$push": {"pending_uploads": {"jobId": job["jobId"], "startedAt": now}}}
+        )
+        if self.enabled:
+            self._get_executor().submit(self._run, job["jobId"], session_id, work, cleanup)
+        else:
+            self._run(job["jobId"], session_id, work, cleanup)
+        return self.get(job["jobId"]) or job
+
+    def _report(self, job_id, **fields):
+        fields["updatedAt"] = datetime.now(timezone.utc)
+        self.jobs.update_one({"jobId": job_id}, {"$set": fields})
+
+    def _run(self, job_id, session_id, work, cleanup):
+        with self._lock:
+            self._running += 1
+        try:
+            work(lambda **fields: self._report(job_id, **fields))
+            self._report(job_id, state="ready")
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            logger.exception(f"Upload job {job_id} failed: {e}")
+            self._report(job_id, state="failed", error=str(e))
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._running -= 1
+            try:
+                self.sessions.update_one({"session_id": session_id}, {"$pull": {"pending_uploads": {"jobId": job_id}}})
+            finally:
+                if cleanup is not None:
+                    cleanup()
+
+    def get(self, job_id):
+        return self.jobs.find_one({"jobId": job_id}, JOB_FIELDS)
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "running": self._running, "completed": self.completed,
+                    "failed": self.failed}
@@ -0,0 +1,77 @@
+'''
+This file tests the TA chat session flow of the frontend's "Start New Chat" button against the Flask app:
+/chat/createSession, /chat/ask with the returned key, /chat/update_chat_title and /chat/get_saved_chats.
+
+OpenAI and Atlas are replaced by the stand-ins of loadTest.py and MongoDB by mongomock. Run from the saas-backend
+directory (requires `pip install pytest mongomock`):
+
+    python -m pytest test/chatSessionTest.py
+'''
+import argparse
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TEST_DIR)
+
+import loadTest
+
+ARGS = argparse.Namespace(mongo_uri=None, no_answer_cache=True, tokens=5, first_token_latency=0.0,
+                          token_latency=0.0, embedding_latency=0.0, search_latency=0.0)
+EMAIL = "chatsession@example.com"
+
+
+def make_client():
+    loadTest.configure_environment(ARGS)
+    from app import app as flask_app
+    import controller.chatRoutes as chat_routes
+    loadTest.install_stand_ins(ARGS)
+    chat_routes.user_collection.update_one({"email": EMAIL}, {"$set": {"email": EMAIL}}, upsert=True)
+    return flask_app.test_client()
+
+
+def test_create_session_ask_and_rename():
+    client = make_client()
+
+    response = client.post('/chat/createSession', json={"email": EMAIL})
+    assert response.status_code == 200
+    session_key = response.get_json()["sessionKey"]
+
+    response = client.post('/chat/ask', json={"email": EMAIL, "sessionKey": session_key,
+                                              "question": "What is the observer pattern?"})
+    assert response.status_code == 200
+    assert response.get_data(as_text=True)
+
+    response = client.post('/chat/update_chat_title', json={"email": EMAIL, "sessionKey": session_key,
+                                                            "newTitle": "Observer pattern"})
+    assert response.status_code == 200
+
+    response = client.get('/chat/get_saved_chats', query_string={"email": EMAIL})
+    assert response.status_code == 200
+    chats = {chat["sessionKey"]: chat for chat in response.get_json()["savedChatSessions"]}
+    assert chats[session_key]["chatTitle"] == "Observer pattern"
+    assert chats[session_key]["messageCount"] == 2
+
+    # Another new chat only removes chats that never got a title
+    response = client.post('/chat/createSession', json={"email": EMAIL})
+    assert response.status_code == 200
+    response = client.get('/chat/get_saved_chats', query_string={"email": EMAIL})
+    assert session_key in {chat["sessionKey"] for chat in response.get_json()["savedChatSessions"]}
+
+
+def test_new_chat_keeps_untitled_chats_with_messages():
+    client = make_client()
+
+    # The frontend names a chat after its first answer, a stopped answer leaves it without a title
+    answered_key = client.post('/chat/createSession', json={"email": EMAIL}).get_json()["sessionKey"]
+    response = client.post('/chat/ask', json={"email": EMAIL, "sessionKey": answered_key,
+                                              "question": "What is a singleton?"})
+    assert response.status_code == 200
+    response.get_data(as_text=True)
+    empty_key = client.post('/chat/createSession', json={"email": EMAIL}).get_json()["sessionKey"]
+
+    client.post('/chat/createSession', json={"email": EMAIL})
+    response = client.get('/chat/get_saved_chats', query_string={"email": EMAIL})
+    session_keys = {chat["sessionKey"] for chat in response.get_json()["savedChatSessions"]}
+    assert answered_key in session_keys
+    assert empty_key not in session_keys
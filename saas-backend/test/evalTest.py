@@ -3,8 +3,17 @@ This file tests the course evaluation API by uploading files and asking a questi
 
 @author Sanjit Verma (skverma)
 '''
+import time
 import requests
 
+def wait_for_upload(upload_response, base_url='http://127.0.0.1:8000'):
+    """Uploads are processed in the background, poll the job until it is ready or failed."""
+    job = upload_response.json()
+    while job.get('state') not in ('ready', 'failed'):
+        time.sleep(1)
+        job = requests.get(base_url + upload_response.json()['status_url']).json()
+    return job
+
 def test_upload_and_ask():
     # URL of the upload endpoint
     upload_url = 'http://127.0.0.1:8000/courseEvaluation/upload'
@@ -25,7 +34,7 @@ def test_upload_and_ask():
         upload_response1 = requests.post(upload_url, files=files)
 
     # Check if the first upload was successful
-    if upload_response1.status_code == 200:
+    if upload_response1.status_code in (200, 202) and wait_for_upload(upload_response1)['state'] == 'ready':
         upload_data1 = upload_response1.json()
         session_id = upload_data1['session_id']
         print("Session ID:", session_id)
@@ -45,7 +54,7 @@ def test_upload_and_ask():
             upload_response2 = requests.post(upload_url, files=files, data=data)
         
         # Check if the second upload was successful
-        if upload_response2.status_code == 200:
+        if upload_response2.status_code in (200, 202) and wait_for_upload(upload_response2)['state'] == 'ready':
             upload_data2 = upload_response2.json()
             
             # Prepare data for asking a question
@@ -0,0 +1,72 @@
+'''
+This file tests the row chunker of uploaded course evaluation spreadsheets (vectorsMongoDB/evaluationChunker.py).
+
+Run from the saas-backend directory (requires `pip install pytest`):
+
+    python -m pytest test/evaluationChunkerTest.py
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from service.conversation_history import count_tokens
+from vectorsMongoDB.evaluationChunker import chunk_rows, format_cell
+
+BUDGET = 100
+
+
+def test_rows_are_packed_per_question():
+    columns = ["Question", "Instructor", "Comment"]
+    rows = [
+        ("What did you like?", "Smith", "Clear lectures"),
+        ("What did you like?", "Smith", "Good projects"),
+        ("What should change?", "Smith", "More office hours"),
+    ]
+    documents = list(chunk_rows(columns, rows, "uploaded.csv", token_budget=BUDGET))
+
+    assert len(documents) == 2
+    assert documents[0].page_content.splitlines()[0] == "Question: What did you like?"
+    assert "Clear lectures" in documents[0].page_content and "Good projects" in documents[0].page_content
+    assert (documents[0].metadata["firstRow"], documents[0].metadata["lastRow"]) == (1, 2)
+    assert documents[1].metadata["question"] == "What should change?"
+    assert documents[1].metadata["columns"] == ["Instructor", "Comment"]
+
+
+def test_wide_header_is_left_out_of_the_text():
+    columns = [f"How strongly do you agree that the instructor explained topic number {n} clearly" for n in range(20)]
+    rows = [tuple(str(value) for value in range(20)) for _ in range(30)]
+    documents = list(chunk_rows(columns, rows, "uploaded.xlsx", token_budget=BUDGET))
+
+    # One chunk per row at most, never one per word
+    assert 0 < len(documents) <= len(rows)
+    for document in documents:
+        assert not document.page_content.startswith("Columns:")
+        assert document.metadata["columns"] == columns
+        assert count_tokens(document.page_content) <= BUDGET + document.page_content.count("\n")
+
+
+def test_oversized_row_is_split_into_full_parts():
+    comment = " ".join(["The pace of the course was too fast for most of us."] * 60)
+    documents = list(chunk_rows(["Comment"], [(comment,)], "uploaded.csv", token_budget=BUDGET))
+
+    assert len(documents) > 1
+    # Parts use the room left next to the header instead of a single token each
+    assert len(documents) <= 2 * count_tokens(comment) // BUDGET + 1
+    for document in documents:
+        assert document.page_content.startswith("Columns: Comment")
+        assert count_tokens(document.page_content) <= BUDGET + document.page_content.count("\n")
+        assert (document.metadata["firstRow"], document.metadata["lastRow"]) == (1, 1)
+
+
+def test_short_rows_and_empty_cells():
+    # Read-only openpyxl rows stop at the last non-empty cell
+    columns = ["Comment", "Rating", "Question"]
+    rows = [("Great course",), ("", 4.0), (None, float("nan"), None)]
+    documents = list(chunk_rows(columns, rows, "uploaded.xlsx", token_budget=BUDGET))
+
+    assert len(documents) == 1
+    # Empty cells are left out of the line, not kept as empty separators
+    assert documents[0].page_content.splitlines()[1:] == ["Great course", "4"]
+    assert "question" not in documents[0].metadata
+    assert format_cell(4.0) == "4" and format_cell(float("nan")) == ""
@@ -0,0 +1,278 @@
+'''
+This file load tests the streaming ask endpoints without calling OpenAI or MongoDB Atlas.
+
+The Flask app from app.py is booted in-process on a local port with deterministic stand-ins (see standIns.py):
+fake embeddings, in-memory vector search and a scripted token streaming chat model with configurable latency.
+User and session documents live in mongomock unless --mongo-uri points at a local MongoDB.
+It then drives N concurrent streaming sessions per endpoint and reports time to first token (TTFT),
+tokens/sec, p50/p95/p99 latency and error rates.
+
+Run from the saas-backend directory (requires `pip install mongomock` when --mongo-uri is not given):
+
+    python test/loadTest.py --sessions 50 --questions 3 --first-token-latency 0.5 --token-latency 0.02
+
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(TEST_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, TEST_DIR)
+
+ENDPOINTS = ['/chat/ask', '/chat/askGuest', '/courseEvaluation/ask']
+
+QUESTION_POOL = [
+    "What is the single responsibility principle?",
+    "Explain the observer pattern with an example.",
+    "How does Rails implement MVC?",
+    "What are common code smells?",
+    "When should I use the strategy pattern?",
+    "What is dependency inversion?",
+    "How does test driven development work?",
+    "What is the Liskov substitution principle?",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the streaming ask endpoints against local stand-ins.")
+    parser.add_argument('--sessions', type=int, default=20, help="Concurrent streaming sessions per endpoint")
+    parser.add_argument('--questions', type=int, default=3, help="Questions asked one after another in each session")
+    parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument('--question-pool', type=int, default=len(QUESTION_POOL),
+                        help="Number of distinct questions to draw from (smaller pools exercise the caches)")
+    parser.add_argument('--tokens', type=int, default=200, help="Tokens in each scripted answer")
+    parser.add_argument('--first-token-latency', type=float, default=0.3, help="Seconds before the first token")
+    parser.add_argument('--token-latency', type=float, default=0.02, help="Seconds between tokens")
+    parser.add_argument('--embedding-latency', type=float, default=0.05, help="Seconds per embedding call")
+    parser.add_argument('--search-latency', type=float, default=0.05, help="Seconds per vector search")
+    parser.add_argument('--no-answer-cache', action='store_true', help="Disable the semantic answer cache")
+    parser.add_argument('--mongo-uri', help="Use a real (local) MongoDB instead of mongomock")
+    parser.add_argument('--port', type=int, default=0, help="Port for the in-process server (0 picks a free one)")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """Point every module at harmless settings before app.py is imported."""
+    os.environ.update({
+        'MONGODB_URI': args.mongo_uri or 'mongodb://localhost:27017',
+        'MONGODB_DATABASE': 'loadtest',
+        'MONGODB_USERS': 'users',
+        'MONGODB_SUGGESTIONS': 'suggestions',
+        'MONGODB_TEMPUSER': 'tempusers',
+        'MONGODB_WHITELIST_USERS': 'whitelist',
+        'MONGODB_ACCESSCODES': 'accesscodes',
+        'MONGODB_VECTORS': 'vectors',
+        'MONGODB_VECTOR_INDEX': 'vector_index',
+        'MONGODB_VECTORS_COURSEEVAL': 'ce_vectors',
+        'MONGODB_VECTOR_INDEX_COURSEEVAL': 'ce_vector_index',
+        'MONGODB_VECTORS_COURSEEVALUATION_DOCS': 'ce_docs',
+        'MONGODB_VECTOR_INDEX_TEMPUSER_DOC': 'ce_docs_index',
+        'MONGODB_VECTORS_COURSEWEBSITE': 'ce_website',
+        'MONGODB_VECTOR_INDEX_WEBSITE': 'ce_website_index',
+        'OPENAI_API_KEY': 'sk-loadtest',
+        'EMBEDDING_CACHE_PATH': '',
+        'LOCAL_INDEX_ENABLED': 'false',
+        'ANSWER_CACHE_ENABLED': 'false' if args.no_answer_cache else 'true',
+    })
+
+    import langfuse.callback
+    from standIns import NoopCallbackHandler
+    langfuse.callback.CallbackHandler = NoopCallbackHandler
+
+    if not args.mongo_uri:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required without --mongo-uri: pip install mongomock")
+        import pymongo
+        shared_store = mongomock.store.ServerStore()
+
+        class SharedMongoClient(mongomock.MongoClient):
+            """Every module gets its own client, but they all see the same in-memory data."""
+            def __init__(self, *client_args, **client_kwargs):
+                client_kwargs.setdefault('_store', shared_store)
+                super().__init__(*client_args, **client_kwargs)
+
+        pymongo.MongoClient = SharedMongoClient
+
+
+def install_stand_ins(args):
+    """Replace the OpenAI and Atlas calls of both query managers with the local stand-ins."""
+    import vectorsMongoDB.queryManager as ta_query_manager
+    import vectorsMongoDB.CEqueryManager as ce_query_manager
+    from vectorsMongoDB.embeddingCache import CachedEmbeddings
+    from standIns import FakeEmbeddings, InMemoryVectorIndex, ScriptedChatModel
+
+    fake_embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    embeddings = CachedEmbeddings(fake_embeddings, "fake-embedding", disk_path=None)
+    chat_model = ScriptedChatModel(args.tokens, args.first_token_latency, args.token_latency)
+
+    ta_query_manager.embeddings = embeddings
+    ta_query_manager.text_index = InMemoryVectorIndex(fake_embeddings, latency=args.search_latency)
+    ta_query_manager.rag_chain = chat_model
+
+    ce_query_manager.embeddings = embeddings
+    ce_query_manager.eval_index = InMemoryVectorIndex(fake_embeddings, latency=args.search_latency)
+    ce_query_manager.textbook_index = InMemoryVectorIndex(fake_embeddings, latency=args.search_latency)
+    ce_query_manager.website_index = InMemoryVectorIndex(fake_embeddings, latency=args.search_latency)
+    ce_query_manager.rag_chain = chat_model
+
+
+def start_server(flask_app, port):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+
+    def json_request(self, method, path, payload=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        body = json.dumps(payload) if payload is not None else None
+        connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response.status, json.loads(data) if data else None
+
+    def stream(self, path, payload):
+        """POST a question and read the streamed answer, returning one measurement."""
+        started = time.perf_counter()
+        first_token_at = None
+        received = []
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            connection.request('POST', path, body=json.dumps(payload), headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            while True:
+                chunk = response.read1(4096)
+                if not chunk:
+                    break
+                if first_token_at is None and chunk.strip():
+                    first_token_at = time.perf_counter()
+                received.append(chunk)
+            finished = time.perf_counter()
+            text = b"".join(received).decode('utf-8', errors='replace')
+            error = None
+            if response.status != 200:
+                error = f"HTTP {response.status}"
+            elif text.startswith("Error:"):
+                error = text[:200]
+            return {
+                "ok": error is None,
+                "error": error,
+                "ttft": (first_token_at or finished) - started,
+                "latency": finished - started,
+                "tokens": len(text.split()),
+                "answer": text,
+            }
+        except Exception as e:
+            return {"ok": False, "error": str(e), "ttft": None, "latency": time.perf_counter() - started, "tokens": 0,
+                    "answer": ""}
+        finally:
+            connection.close()
+
+
+def pick_question(args):
+    return random.choice(QUESTION_POOL[:max(1, args.question_pool)])
+
+
+def run_session(client, endpoint, index, args):
+    """Ask --questions questions in one session. The server keeps the conversation, so requests stay the same size."""
+    results = []
+    payload = {}
+    if endpoint == '/chat/ask':
+        payload['email'] = f"loadtest{index}@example.com"
+        status, body = client.json_request('POST', '/chat/ask', {**payload, "question": pick_question(args)})
+        if status != 200:
+            return [{"ok": False, "error": f"session setup HTTP {status}", "ttft": None, "latency": 0, "tokens": 0}]
+        payload['sessionKey'] = body['sessionKey']
+    elif endpoint == '/chat/askGuest':
+        payload['sessionKey'] = f"loadtest-guest-{index}"
+    else:
+        status, body = client.json_request('GET', '/courseEvaluation/start_session')
+        if status != 200:
+            return [{"ok": False, "error": f"session setup HTTP {status}", "ttft": None, "latency": 0, "tokens": 0}]
+        payload['session_id'] = body['session_id']
+
+    for _ in range(args.questions):
+        question = pick_question(args)
+        result = client.stream(endpoint, {**payload, "question": question})
+        result.pop("answer", None)
+        results.append(result)
+    return results
+
+
+def seed_users(sessions):
+    import controller.chatRoutes as chat_routes
+    for index in range(sessions):
+        chat_routes.user_collection.update_one(
+            {"email": f"loadtest{index}@example.com"},
+            {"$setOnInsert": {"first_name": "Load", "last_name": f"Test{index}", "savedChats": {}}},
+            upsert=True
+        )
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def report(endpoint, results, wall_time):
+    ok = [r for r in results if r["ok"]]
+    ttfts = [r["ttft"] for r in ok]
+    latencies = [r["latency"] for r in ok]
+    tokens_per_second = [r["tokens"] / (r["latency"] - r["ttft"]) for r in ok if r["latency"] > r["ttft"]]
+    errors = len(results) - len(ok)
+    print(f"\n{endpoint}")
+    print(f"  requests {len(results)}  errors {errors} ({errors / len(results):.1%})  wall time {wall_time:.2f}s")
+    if ok:
+        print(f"  TTFT     p50 {percentile(ttfts, .50):.3f}s  p95 {percentile(ttfts, .95):.3f}s  "
+              f"p99 {percentile(ttfts, .99):.3f}s")
+        print(f"  latency  p50 {percentile(latencies, .50):.3f}s  p95 {percentile(latencies, .95):.3f}s  "
+              f"p99 {percentile(latencies, .99):.3f}s")
+        if tokens_per_second:
+            print(f"  tokens/sec per stream {statistics.mean(tokens_per_second):.1f}  "
+                  f"aggregate {sum(r['tokens'] for r in ok) / wall_time:.1f}")
+    for error in sorted({r["error"] for r in results if r["error"]})[:5]:
+        print(f"  error: {error}")
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    from app import app as flask_app
+    install_stand_ins(args)
+    seed_users(args.sessions)
+
+    server = start_server(flask_app, args.port)
+    client = Client(server.server_port)
+    print(f"Serving on 127.0.0.1:{server.server_port}, {args.sessions} concurrent sessions per endpoint")
+
+    try:
+        for endpoint in args.endpoints:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+                futures = [pool.submit(run_session, client, endpoint, i, args) for i in range(args.sessions)]
+                results = [result for future in futures for result in future.result()]
+            report(endpoint, results, time.perf_counter() - started)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+This file contains deterministic local stand-ins for OpenAI and MongoDB Atlas used by the load test harness.
+
+- FakeEmbeddings: hash seeded vectors, no network
+- InMemoryVectorIndex: cosine similarity search over a small in-memory corpus, same interface as AtlasVectorIndex
+- ScriptedChatModel: replaces a RAG chain and streams a scripted answer token by token with configurable latency
+
+'''
+import hashlib
+import time
+from typing import List
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+SAMPLE_CORPUS = [
+    "Object-oriented design organizes software as a collection of objects that combine state and behavior.",
+    "The single responsibility principle states that a class should have only one reason to change.",
+    "The open/closed principle says software entities should be open for extension but closed for modification.",
+    "Liskov substitution requires that objects of a subclass can replace objects of the superclass.",
+    "Interface segregation prefers many small client specific interfaces over one general purpose interface.",
+    "Dependency inversion means high level modules depend on abstractions rather than concrete classes.",
+    "The observer pattern lets subjects notify registered observers when their state changes.",
+    "The strategy pattern encapsulates interchangeable algorithms behind a common interface.",
+    "Ruby on Rails follows the model view controller architecture and convention over configuration.",
+    "Refactoring improves the internal structure of code without changing its external behavior.",
+    "Test driven development writes a failing test before writing the code that makes it pass.",
+    "Code smells such as long methods and feature envy hint that a refactoring may be needed.",
+]
+
+
+class NoopCallbackHandler(BaseCallbackHandler):
+    """Replaces the Langfuse callback handler so no traces are sent while load testing."""
+
+    def auth_check(self):
+        return True
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings: the same text always maps to the same unit vector."""
+
+    def __init__(self, dimension=1536, latency=0.0):
+        self.dimension = dimension
+        self.latency = latency
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._vector(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+
+class InMemoryVectorIndex:
+    """Cosine similarity search over in-memory chunks with an artificial round trip latency."""
+
+    def __init__(self, embeddings, texts=SAMPLE_CORPUS, source=None, latency=0.0):
+        self.latency = latency
+        self.documents = [Document(page_content=text, metadata={"source": source or "sample"}) for text in texts]
+        self.matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+    def search(self, query_vector, k=10, pre_filter=None, version=None):
+        time.sleep(self.latency)
+        similarities = self.matrix @ np.asarray(query_vector, dtype=np.float32)
+        order = np.argsort(-similarities)[:k]
+        return [(self.documents[i], (1.0 + float(similarities[i])) / 2.0) for i in order]
+
+    def stats(self):
+        return {"inMemory": True, "documents": len(self.documents)}
+
+
+class ScriptedChatModel:
+    """
+    Stands in for a RAG chain. stream() yields a scripted answer after first_token_latency seconds,
+    then one token every token_latency seconds.
+    """
+
+    def __init__(self, tokens=200, first_token_latency=0.3, token_latency=0.02):
+        self.tokens = [f"token{i} " for i in range(tokens)]
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+
+    def stream(self, inputs, config=None):
+        time.sleep(self.first_token_latency)
+        for token in self.tokens:
+            yield token
+            time.sleep(self.token_latency)
@@ -9,17 +9,26 @@ IMPORTANT: Be sure to generate the embeddings using the generateVectorDB.py scri
 
 '''
 import os
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from pymongo import MongoClient
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from repository.mongo_connection import get_database
+from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
-from langchain_mongodb import MongoDBAtlasVectorSearch
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from dotenv import load_dotenv
 from langfuse.callback import CallbackHandler
 from tqdm import tqdm
+from vectorsMongoDB.embeddingCache import get_cached_embeddings
+from vectorsMongoDB.vectorSearch import AtlasVectorIndex
+from vectorsMongoDB.corpusVersion import CorpusVersionTracker
+from vectorsMongoDB.retrievalCache import CachedVectorIndex, retrieval_cache
+from vectorsMongoDB.sessionIndex import SessionVectorIndex, session_index_cache
+from vectorsMongoDB.contextPacker import pack_context
+from service.conversation_history import budget_window, format_history
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -46,8 +55,6 @@ vector_search_idx_textbook=os.getenv('MONGODB_VECTOR_INDEX_COURSEEVAL')
 collection_name_website= os.getenv('MONGODB_VECTORS_COURSEWEBSITE')
 vector_search_idx_website=os.getenv('MONGODB_VECTOR_INDEX_WEBSITE')
 
-# Connect to MongoDB
-client = MongoClient(MONGODB_URI)
 langfuse_handler = CallbackHandler()
 langfuse_handler.auth_check()
 
@@ -57,7 +64,7 @@ langfuse_handler.auth_check()
 if db_name is None or collection_name_website is None:
     raise ValueError("Database name or collection name is not set.")
 
-db = client[db_name]
+db = get_database(db_name)
 
 
 eval_collection = db[collection_name_eval]
@@ -70,31 +77,33 @@ if vector_search_idx_website is None:
 
 
 
-vector_search_eval = MongoDBAtlasVectorSearch(
-    embedding=OpenAIEmbeddings(disallowed_special=()),
-    collection=eval_collection,
-    index_name=vector_search_idx_eval,
-)
-
-vector_search_website = MongoDBAtlasVectorSearch(
-    embedding=OpenAIEmbeddings(disallowed_special=()),
-    collection=website_collection,
-    index_name=vector_search_idx_website,
-)
+# One cached embedding model for all three stores, so a question is embedded at most once
+embeddings = get_cached_embeddings()
 
-
-vector_search_textbook = MongoDBAtlasVectorSearch(
-    embedding=OpenAIEmbeddings(disallowed_special=()),
-    collection=textbook_collection,
-    index_name=vector_search_idx_textbook,
-)
-# Configure the retriever
+# Configure the retrievers once; process_query searches all three with the same question embedding
 # STEP 2
-
-# retriever = vector_search.as_retriever(
-#     search_type="similarity",
-#     search_kwargs={"k": 10, "score_threshold": 0.8}
-# )
+eval_atlas = AtlasVectorIndex(eval_collection, vector_search_idx_eval)
+website_atlas = AtlasVectorIndex(website_collection, vector_search_idx_website)
+textbook_atlas = AtlasVectorIndex(textbook_collection, vector_search_idx_textbook)
+# The textbook and website corpora are the same for every session, so their results are cached per corpus version.
+# Uploaded evaluations change within a session and are searched in the per-session index of sessionIndex.py.
+website_index = CachedVectorIndex(website_atlas, retrieval_cache, collection_name_website,
+                                  CorpusVersionTracker(db, collection_name_website))
+textbook_index = CachedVectorIndex(textbook_atlas, retrieval_cache, collection_name_textbook,
+                                   CorpusVersionTracker(db, collection_name_textbook))
+eval_index = SessionVectorIndex(eval_atlas, session_index_cache)
+RETRIEVER_K = 10
+
+# Token budgets of the three context sections of the prompt
+CE_CONTEXT_BUDGET_EVALUATION = int(os.getenv('CE_CONTEXT_BUDGET_EVALUATION', '2000'))
+CE_CONTEXT_BUDGET_TEXTBOOK = int(os.getenv('CE_CONTEXT_BUDGET_TEXTBOOK', '1500'))
+CE_CONTEXT_BUDGET_WEBSITE = int(os.getenv('CE_CONTEXT_BUDGET_WEBSITE', '1000'))
+
+# The three searches of a question run concurrently, so time to first token is bounded by the slowest one
+retrieval_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv('CE_RETRIEVAL_WORKERS', '12')),
+    thread_name_prefix="ce-retrieval"
+)
 
 
 # Define the template for the language model
@@ -133,6 +142,19 @@ llm = ChatOpenAI(
     model="gpt-4o",
 )
 
+rag_chain = (
+    {
+        "context1": lambda x: x.get('context1', ''),
+        "context2": lambda x: x.get('context2', ''),
+        "context3": lambda x: x.get('context3', ''),
+        "question": lambda x: x.get('question', ''),
+        "history": lambda x: x.get('history', '')
+    }
+    | custom_rag_prompt
+    | llm
+    | StrOutputParser()
+)
+
 # Function to format documents
 # STEP 3
 def format_docs(docs):
@@ -165,66 +187,53 @@ def format_response(response, context):
 
 # Function to process a query
 
-def process_query(question, session_id, history: List[dict]):
+def process_query(question, session_id, history: List[dict], metadata: dict | None = None, evaluation_version=None):
     '''
     This function processes a query by invoking the RAG chain with the given question.
     It returns a generator that yields the response in chunks.
     The function iterates over stream_response and yields each chunk of the response
+    If a metadata dict is passed, retrieval timing and chunk counts are written into it before the first chunk is yielded.
+    evaluation_version is the stamp of the session document, the session's chunks are read again when it changes.
     '''
     if not isinstance(question, str):
         raise ValueError("The question must be a string.")
-    
-    history_formatted = ""
-    for chat in history:
-        chat_sender = chat.get("sender", "User")
-        chat_message = chat.get("text", '-')
-        history_formatted += f"{chat_sender}: {chat_message}\n"
+    if metadata is None:
+        metadata = {}
+    history_formatted = format_history(budget_window(history))
 
     try:
-        # Retrieve the relevant documents
-        retriever_eval = vector_search_eval.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": 10, "score_threshold": 0.8},
-            pre_filter={"source": {"$eq": session_id}}
-        )
-
-        #Texbook vectors
-        retriever_website = vector_search_website.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": 10, "score_threshold": 0.8},
-            pre_filter={"source": {"$eq": session_id}}
-        )
+        retrieval_started = time.perf_counter()
+        query_embedding = embeddings.embed_query(question)
 
-        #Website vectors
-        retriever_tb = vector_search_textbook.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": 10, "score_threshold": 0.8},
-            pre_filter={"source": {"$eq": session_id}}
+        # Retrieve the relevant documents
+        # Uploaded evaluations are filtered to this session; the textbook and website corpora are shared
+        eval_future = retrieval_pool.submit(
+            eval_index.search, query_embedding, RETRIEVER_K, {"source": {"$eq": session_id}}, evaluation_version
         )
-
-        context_ce = format_docs(retriever_eval.invoke(question))
-        context_tb = format_docs(retriever_tb.invoke(question))
-        context_website = format_docs(retriever_website.invoke(question))
-        
-        rag_chain = (
-            {
-                "context1": lambda x: x.get('context1', ''),
-                "context2": lambda x: x.get('context2', ''),
-                "context3": lambda x: x.get('context3', ''),
-                "question": lambda x: x.get('question', ''),
-                "history": lambda x: x.get('history', '')
+        textbook_future = retrieval_pool.submit(textbook_index.search, query_embedding, RETRIEVER_K)
+        website_future = retrieval_pool.submit(website_index.search, query_embedding, RETRIEVER_K)
+
+        eval_results = eval_future.result()
+        textbook_results = textbook_future.result()
+        website_results = website_future.result()
+        context_ce, eval_docs = pack_context(eval_results, CE_CONTEXT_BUDGET_EVALUATION)
+        context_tb, textbook_docs = pack_context(textbook_results, CE_CONTEXT_BUDGET_TEXTBOOK)
+        context_website, website_docs = pack_context(website_results, CE_CONTEXT_BUDGET_WEBSITE)
+        metadata.update({
+            "retrievalMs": (time.perf_counter() - retrieval_started) * 1000,
+            "sources": {
+                "evaluation": len(eval_docs),
+                "textbook": len(textbook_docs),
+                "website": len(website_docs)
             }
-            | custom_rag_prompt
-            | llm
-            | StrOutputParser()
-        )
+        })
 
         stream_response = rag_chain.stream({
             "question": question,
             "context1": context_tb,
             "context2": context_website,
             "context3": context_ce,
-            "history": history
+            "history": history_formatted
             }, config={"callbacks":[langfuse_handler]})
 
 
@@ -235,7 +244,39 @@ def process_query(question, session_id, history: List[dict]):
     except Exception as e:
         raise RuntimeError(f"An error occurred while processing the query: {e}")
 
-def make_query(input_text: str | None, session_id: str | None, history: List[dict] | None = None):
+async def aprocess_query(question, session_id, history: List[dict], evaluation_version=None):
+    '''
+    Async version of process_query used by the ASGI server (asgi.py).
+    The three searches are awaited together and the answer is streamed with rag_chain.astream.
+    '''
+    if not isinstance(question, str):
+        raise ValueError("The question must be a string.")
+
+    try:
+        query_embedding = await embeddings.aembed_query(question)
+
+        eval_results, textbook_results, website_results = await asyncio.gather(
+            eval_index.asearch(query_embedding, RETRIEVER_K, {"source": {"$eq": session_id}}, evaluation_version),
+            textbook_index.asearch(query_embedding, RETRIEVER_K),
+            website_index.asearch(query_embedding, RETRIEVER_K),
+        )
+
+        stream_response = rag_chain.astream({
+            "question": question,
+            "context1": pack_context(textbook_results, CE_CONTEXT_BUDGET_TEXTBOOK)[0],
+            "context2": pack_context(website_results, CE_CONTEXT_BUDGET_WEBSITE)[0],
+            "context3": pack_context(eval_results, CE_CONTEXT_BUDGET_EVALUATION)[0],
+            "history": format_history(budget_window(history))
+            }, config={"callbacks":[langfuse_handler]})
+
+        async for chunk in stream_response:
+            yield chunk
+
+    except Exception as e:
+        raise RuntimeError(f"An error occurred while processing the query: {e}")
+
+def make_query(input_text: str | None, session_id: str | None, history: List[dict] | None = None,
+               metadata: dict | None = None, evaluation_version: str | None = None):
     '''
     This is the entry function that processes a given query from payload
     '''
@@ -246,11 +287,24 @@ def make_query(input_text: str | None, session_id: str | None, history: List[dic
         history = []
 
     try:
-        response_generator = process_query(input_text, session_id, history)
+        response_generator = process_query(input_text, session_id, history, metadata, evaluation_version)
         return response_generator
     except Exception as e:
         raise RuntimeError(f"An error occurred while processing the query: {e}")
 
+def amake_query(input_text: str | None, session_id: str | None, history: List[dict] | None = None,
+                evaluation_version: str | None = None):
+    '''
+    Async entry point for the ASGI server, returns an async generator of response chunks
+    '''
+    if input_text is None or not isinstance(input_text, str):
+        raise ValueError("No valid input provided")
+
+    if history is None:
+        history = []
+
+    return aprocess_query(input_text, session_id, history, evaluation_version)
+
 '''
 STEPS THAT OCCUR IN THE BACKGROUND when .invoke() is called on the rag_chain instance 
 Please email me skverma@ncsu.edu if you have any further questions
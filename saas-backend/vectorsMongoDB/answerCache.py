@@ -0,0 +1,150 @@
+'''
+@file answerCache.py
+This file contains a semantic answer cache that sits in front of the RAG chain.
+
+A question whose embedding is close enough to a question that was already answered against the same corpus version
+gets the stored answer replayed as a stream, skipping retrieval and the LLM call.
+Entries are evicted least recently used first, expire after a time to live and are bounded by an approximate memory cap.
+
+'''
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv('ANSWER_CACHE_SIMILARITY_THRESHOLD', '0.95'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '1000'))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv('ANSWER_CACHE_TTL_SECONDS', str(6 * 60 * 60)))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv('ANSWER_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Splits a stored answer back into word sized pieces so a replay still streams like the model output
+_REPLAY_PATTERN = re.compile(r"\S+\s*|\s+")
+
+
+class _CacheEntry:
+    def __init__(self, question, vector, answer, corpus_version, created_at):
+        self.question = question
+        self.vector = vector
+        self.answer = answer
+        self.corpus_version = corpus_version
+        self.created_at = created_at
+        self.size = vector.nbytes + len(answer.encode('utf-8')) + len(question.encode('utf-8'))
+
+
+class SemanticAnswerCache:
+    """
+    Thread safe LRU + TTL cache of answers keyed by question embedding and corpus version.
+    """
+
+    def __init__(self, similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds=ANSWER_CACHE_TTL_SECONDS, max_bytes=ANSWER_CACHE_MAX_BYTES):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._bytes = 0
+        self._active_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _drop_other_versions(self, corpus_version):
+        stale = [key for key, entry in self._entries.items()
+                 if corpus_version is None or entry.corpus_version != corpus_version]
+        for key in stale:
+            self._remove(key)
+        self.invalidations += len(stale)
+        self._active_version = corpus_version
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl_seconds]
+        for key in expired:
+            self._remove(key)
+            self.evictions += 1
+
+    def lookup(self, embedding, corpus_version):
+        """
+        Return the cached answer for the closest question above the similarity threshold, or None on a miss.
+        """
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            # A new corpus version means generateVectorDB.py re-ingested the collection
+            if corpus_version != self._active_version:
+                self._drop_other_versions(corpus_version)
+            self._expire(now)
+            candidates = list(self._entries.items())
+            if candidates:
+                similarities = np.stack([entry.vector for _, entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    key, entry = candidates[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.answer
+            self.misses += 1
+            return None
+
+    def store(self, question, embedding, answer, corpus_version):
+        """Store a fully generated answer, evicting old entries until the cache fits its limits again."""
+        if not answer:
+            return
+        entry = _CacheEntry(question, self._normalize(embedding), answer, corpus_version, time.monotonic())
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if corpus_version != self._active_version:
+                return
+            self._entries[self._next_key] = entry
+            self._next_key += 1
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, corpus_version=None):
+        """Drop every entry that was not answered against corpus_version (or everything when it is None)."""
+        with self._lock:
+            self._drop_other_versions(corpus_version)
+
+    @staticmethod
+    def replay(answer):
+        """Yield a stored answer in small chunks, the same way the LLM stream would."""
+        for match in _REPLAY_PATTERN.finditer(answer):
+            yield match.group(0)
+
+    def stats(self):
+        """Return hit/miss counters and current usage."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "similarityThreshold": self.similarity_threshold,
+            }
@@ -0,0 +1,90 @@
+'''
+@file contextPacker.py
+This file assembles the retrieved chunks into the context of a RAG prompt under a token budget.
+
+The splitter in generateVectorDB.py gives neighbouring chunks 100 characters of overlap, and the same passage is
+often indexed more than once. Chunks are taken in order of similarity score; duplicates and chunks contained in an
+already selected chunk are dropped, text overlapping a selected chunk is trimmed, and chunks are packed greedily
+until the budget is spent. A smaller lower scoring chunk can still fill the room a large one did not fit in.
+
+'''
+import hashlib
+import os
+import re
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+from langchain.schema import Document
+
+from service.conversation_history import count_tokens
+
+load_dotenv()
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+# Overlaps shorter than this are treated as coincidence, longer than the maximum are not searched for
+CONTEXT_MIN_OVERLAP_CHARS = int(os.getenv('CONTEXT_MIN_OVERLAP_CHARS', '30'))
+CONTEXT_MAX_OVERLAP_CHARS = int(os.getenv('CONTEXT_MAX_OVERLAP_CHARS', '400'))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _fingerprint(text):
+    return hashlib.sha1(_WHITESPACE.sub(" ", text).strip().lower().encode("utf-8")).hexdigest()
+
+
+def _overlap(left, right, min_chars=CONTEXT_MIN_OVERLAP_CHARS, max_chars=CONTEXT_MAX_OVERLAP_CHARS):
+    """Return the length of the longest suffix of left that is also a prefix of right."""
+    tail = left[-max_chars:]
+    probe = right[:min_chars]
+    if len(probe) < min_chars:
+        return 0
+    # Only positions where the start of right occurs can begin an overlap; the first one is the longest
+    start = tail.find(probe)
+    while start != -1:
+        if right.startswith(tail[start:]):
+            return len(tail) - start
+        start = tail.find(probe, start + 1)
+    return 0
+
+
+def _trim(text, selected):
+    """Remove the parts of text that are repeated at the edges of the already selected chunks."""
+    for other in selected:
+        head = _overlap(other, text)
+        if head:
+            text = text[head:]
+        tail = _overlap(text, other)
+        if tail:
+            text = text[:-tail]
+    return text.strip()
+
+
+def pack_context(results: List[Tuple[Document, float]], token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Pack search results (document, score) into a context string of at most token_budget tokens.
+    Returns the context and the documents it was built from, highest score first.
+    """
+    selected_texts = []
+    packed = []
+    seen = set()
+    used = 0
+    for doc, _ in sorted(results, key=lambda result: result[1], reverse=True):
+        text = doc.page_content.strip()
+        fingerprint = _fingerprint(text)
+        if not text or fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        if any(text in other for other in selected_texts):
+            continue
+
+        text = _trim(text, selected_texts)
+        if not text:
+            continue
+        tokens = count_tokens(text)
+        if used + tokens > token_budget:
+            continue
+        used += tokens
+        selected_texts.append(text)
+        packed.append(doc)
+
+    return "\n\n".join(selected_texts), packed
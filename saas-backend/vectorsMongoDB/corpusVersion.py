@@ -0,0 +1,87 @@
+'''
+@file corpusVersion.py
+This file keeps track of a version stamp for every vector collection.
+
+Ingestion scripts call bump_corpus_version() after they finish writing vectors into a collection. The query managers
+read the stamp through CorpusVersionTracker so that anything cached against an older version of the corpus
+(answers, retrieval results, local indexes) can be thrown away.
+
+'''
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Collection that stores one version document per vector collection
+CORPUS_VERSIONS_COLLECTION = os.getenv('MONGODB_CORPUS_VERSIONS', 'MONGODB_CORPUS_VERSIONS')
+
+# How long (seconds) a version read from MongoDB is trusted before it is read again
+CORPUS_VERSION_REFRESH_SECONDS = float(os.getenv('CORPUS_VERSION_REFRESH_SECONDS', '60'))
+
+
+def bump_corpus_version(db, collection_name):
+    """
+    Write a new version stamp for the given vector collection and return it.
+    Call this after every ingestion run that changes the collection.
+    """
+    version = f"{int(time.time())}-{secrets.token_hex(4)}"
+    db[CORPUS_VERSIONS_COLLECTION].update_one(
+        {"collection": collection_name},
+        {"$set": {"version": version, "updatedAt": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    return version
+
+
+def read_corpus_version(db, collection_name):
+    """
+    Read the current version stamp for a vector collection straight from MongoDB.
+    Collections that were ingested before versioning existed report "initial".
+    """
+    document = db[CORPUS_VERSIONS_COLLECTION].find_one({"collection": collection_name}, {"_id": 0, "version": 1})
+    if document and document.get("version"):
+        return document["version"]
+    return "initial"
+
+
+class CorpusVersionTracker:
+    """
+    Caches the version stamp of one vector collection for a short interval so the hot query path
+    does not pay a MongoDB round trip on every question.
+    """
+
+    def __init__(self, db, collection_name, refresh_seconds=CORPUS_VERSION_REFRESH_SECONDS):
+        self.db = db
+        self.collection_name = collection_name
+        self.refresh_seconds = refresh_seconds
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """Return the cached version, reading it again from MongoDB once the refresh interval has passed."""
+        now = time.monotonic()
+        with self._lock:
+            if self._version is not None and now - self._checked_at < self.refresh_seconds:
+                return self._version
+        try:
+            version = read_corpus_version(self.db, self.collection_name)
+        except Exception:
+            # Keep serving with the last known version if MongoDB is unreachable
+            if self._version is not None:
+                return self._version
+            raise
+        with self._lock:
+            self._version = version
+            self._checked_at = now
+        return version
+
+    def refresh(self):
+        """Force the next call to current() to read the version from MongoDB."""
+        with self._lock:
+            self._checked_at = 0.0
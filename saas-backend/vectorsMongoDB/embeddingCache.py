@@ -0,0 +1,270 @@
+'''
+@file embeddingCache.py
+This file contains a two tier cache for OpenAI embeddings that is shared by every retriever in the process.
+
+Embeddings are keyed on the normalized text and the embedding model name. Lookups go to an in-process LRU first,
+then to an on-disk SQLite file that survives restarts and is shared by all workers on the machine, and only then to
+the OpenAI API. Concurrent requests for the same text wait for the first request instead of calling the API again.
+
+'''
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+load_dotenv()
+logger = logging.getLogger()
+
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '10000'))
+EMBEDDING_CACHE_PATH = os.getenv(
+    'EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'embeddings.sqlite3')
+)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Normalize text so that trivially different spellings of a question share one cache entry."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class _DiskTier:
+    """SQLite backed store of float32 vectors. One connection per thread, WAL so several workers can share the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        placeholders = ",".join("?" for _ in keys)
+        rows = self._connection().execute(
+            f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", list(keys)
+        ).fetchall()
+        return {key: array('f', blob).tolist() for key, blob in rows}
+
+    def put_many(self, items):
+        if not items:
+            return
+        connection = self._connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(key, array('f', vector).tobytes()) for key, vector in items]
+        )
+        connection.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that answers from the memory and disk tiers before calling the wrapped model.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+                 disk_path=EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.disk = None
+        if disk_path:
+            try:
+                self.disk = _DiskTier(disk_path)
+            except sqlite3.Error as e:
+                logger.warning(f"Embedding disk cache disabled: {e}")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        # Caller holds self._lock
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, keys):
+        if self.disk is None:
+            return {}
+        try:
+            return self.disk.get_many(keys)
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding disk cache read failed: {e}")
+            return {}
+
+    def _write_disk(self, items):
+        if self.disk is None:
+            return
+        try:
+            self.disk.put_many(items)
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding disk cache write failed: {e}")
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = Future()
+                self._inflight[key] = pending
+        if not owner:
+            # Another request is already embedding the same text
+            return pending.result()
+
+        try:
+            vector = self._read_disk([key]).get(key)
+            if vector is not None:
+                with self._lock:
+                    self.disk_hits += 1
+            else:
+                vector = self.embeddings.embed_query(text)
+                self._write_disk([(key, vector)])
+                with self._lock:
+                    self.misses += 1
+            with self._lock:
+                self._remember(key, vector)
+            pending.set_result(vector)
+            return vector
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = Future()
+                self._inflight[key] = pending
+        if not owner:
+            return await asyncio.wrap_future(pending)
+
+        try:
+            # SQLite blocks for up to its busy timeout, it runs off the event loop (connections are per thread)
+            vector = (await asyncio.to_thread(self._read_disk, [key])).get(key)
+            if vector is not None:
+                with self._lock:
+                    self.disk_hits += 1
+            else:
+                vector = await self.embeddings.aembed_query(text)
+                await asyncio.to_thread(self._write_disk, [(key, vector)])
+                with self._lock:
+                    self.misses += 1
+            with self._lock:
+                self._remember(key, vector)
+            pending.set_result(vector)
+            return vector
+        except BaseException as e:
+            # Also release waiters when the request is cancelled
+            pending.set_exception(e if isinstance(e, Exception) else RuntimeError("Embedding request cancelled"))
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+        on_disk = self._read_disk([key for key in set(keys) if key not in found])
+        found.update(on_disk)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._write_disk(new_items)
+            found.update(new_items)
+
+        with self._lock:
+            self.disk_hits += len(on_disk)
+            self.misses += len(missing)
+            for key in keys:
+                self._remember(key, found[key])
+        return [found[key] for key in keys]
+
+    def stats(self):
+        """Return hit/miss counters for both tiers."""
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "memoryEntries": len(self._memory),
+                "memoryHits": self.memory_hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_cached_embeddings(model: str = None) -> CachedEmbeddings:
+    """
+    Return the process wide cached OpenAI embeddings for a model, so every retriever shares one cache.
+    """
+    with _shared_lock:
+        cache_key = model or "default"
+        if cache_key not in _shared:
+            if model:
+                openai_embeddings = OpenAIEmbeddings(model=model, disallowed_special=())
+            else:
+                openai_embeddings = OpenAIEmbeddings(disallowed_special=())
+            _shared[cache_key] = CachedEmbeddings(openai_embeddings, openai_embeddings.model)
+        return _shared[cache_key]
@@ -0,0 +1,232 @@
+'''
+@file embeddingScheduler.py
+This file contains the scheduler that bulk embedding calls (ingestion and evaluation uploads) go through.
+
+Texts are packed into batches of at most EMBEDDING_BATCH_TOKENS tokens and EMBEDDING_BATCH_MAX_INPUTS texts, and up to
+EMBEDDING_MAX_CONCURRENCY batches are sent at the same time. Every request first takes its share of a process wide
+budget of EMBEDDING_RPM_LIMIT requests and EMBEDDING_TPM_LIMIT tokens per minute, so concurrent uploads and ingestion
+runs together stay under the limits of the OpenAI account instead of each running into 429s. Rate limited, timed out
+and failed requests are retried with exponential backoff and full jitter; a 429 also pauses the budget for every
+other request in the process, honouring Retry-After when OpenAI sends it.
+
+'''
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+from service.conversation_history import count_tokens
+
+try:
+    import openai
+    _RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                         openai.InternalServerError)
+except ImportError:  # openai ships with langchain_openai, status codes are checked without it
+    openai = None
+    _RETRYABLE_ERRORS = ()
+
+load_dotenv()
+logger = logging.getLogger()
+
+EMBEDDING_RPM_LIMIT = int(os.getenv('EMBEDDING_RPM_LIMIT', '3000'))
+EMBEDDING_TPM_LIMIT = int(os.getenv('EMBEDDING_TPM_LIMIT', '1000000'))
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', '20000'))
+# LangChain splits calls into requests of 1000 texts, staying below that keeps one batch in one request
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv('EMBEDDING_BATCH_MAX_INPUTS', '1000'))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', '4'))
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', '6'))
+EMBEDDING_BACKOFF_BASE_SECONDS = float(os.getenv('EMBEDDING_BACKOFF_BASE_SECONDS', '1'))
+EMBEDDING_BACKOFF_MAX_SECONDS = float(os.getenv('EMBEDDING_BACKOFF_MAX_SECONDS', '60'))
+
+
+def _status_code(error):
+    return getattr(error, "status_code", None)
+
+
+def _is_rate_limit(error):
+    return _status_code(error) == 429
+
+
+def _is_retryable(error):
+    # Out of credits is reported as a 429 but waiting does not help
+    if getattr(error, "code", None) == "insufficient_quota":
+        return False
+    return isinstance(error, _RETRYABLE_ERRORS) or _status_code(error) in (429, 500, 502, 503, 504)
+
+
+def _retry_after(error):
+    """Seconds from the Retry-After header of a failed OpenAI request, if there is one."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingBudget:
+    """
+    Requests and tokens per minute as two token buckets that refill continuously, plus a cap on the number of
+    requests in flight. Shared by every scheduler of the process.
+    """
+
+    def __init__(self, rpm=EMBEDDING_RPM_LIMIT, tpm=EMBEDDING_TPM_LIMIT, max_concurrency=EMBEDDING_MAX_CONCURRENCY):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.requests = 0
+        self.tokens = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self, now):
+        # Caller holds self._condition
+        elapsed = now - self._updated
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+        self._updated = now
+
+    def acquire(self, tokens):
+        """Block until a request of the given size fits in the budget, then take it."""
+        # A batch larger than the whole bucket would never fit, it waits for a full bucket instead
+        tokens = min(tokens, self.tpm)
+        started = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    wait = max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+                    if wait <= 0:
+                        self._requests -= 1
+                        self._tokens -= tokens
+                        self.requests += 1
+                        self.tokens += tokens
+                        self.wait_seconds += now - started
+                        return
+                self._condition.wait(wait)
+
+    def pause(self, seconds):
+        """Hold every request of the process back, after OpenAI reported that the limit was hit."""
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # The limit was reached earlier than the budget assumed, start again from an empty bucket
+            self._requests = 0.0
+            self._tokens = 0.0
+
+    def slot(self):
+        """Context manager that holds one of the max_concurrency request slots."""
+        return self._slots
+
+    def stats(self):
+        with self._condition:
+            return {
+                "rpmLimit": self.rpm,
+                "tpmLimit": self.tpm,
+                "requests": self.requests,
+                "tokens": self.tokens,
+                "waitSeconds": round(self.wait_seconds, 2),
+            }
+
+
+class EmbeddingScheduler(Embeddings):
+    """
+    Embeddings wrapper that sends embed_documents in token sized batches within the shared budget.
+    Give the wrapped OpenAIEmbeddings max_retries=0 so retries are only done here.
+    """
+
+    def __init__(self, embeddings: Embeddings, budget: EmbeddingBudget = None, batch_tokens=EMBEDDING_BATCH_TOKENS,
+                 batch_max_inputs=EMBEDDING_BATCH_MAX_INPUTS, max_retries=EMBEDDING_MAX_RETRIES,
+                 backoff_base=EMBEDDING_BACKOFF_BASE_SECONDS, backoff_max=EMBEDDING_BACKOFF_MAX_SECONDS):
+        self.embeddings = embeddings
+        self.budget = budget or embedding_budget
+        self.batch_tokens = batch_tokens
+        self.batch_max_inputs = batch_max_inputs
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._executor = ThreadPoolExecutor(max_workers=self.budget.max_concurrency, thread_name_prefix="embedding")
+        self.retries = 0
+        self.rate_limited = 0
+
+    def pack(self, texts):
+        """Split texts into batches of (start index, texts, tokens), keeping their order."""
+        batches = []
+        start, batch, tokens = 0, [], 0
+        for index, text in enumerate(texts):
+            size = count_tokens(text)
+            if batch and (tokens + size > self.batch_tokens or len(batch) >= self.batch_max_inputs):
+                batches.append((start, batch, tokens))
+                start, batch, tokens = index, [], 0
+            batch.append(text)
+            tokens += size
+        if batch:
+            batches.append((start, batch, tokens))
+        return batches
+
+    def _call(self, request, tokens):
+        """Run one request within the budget, retrying failures that are worth retrying."""
+        attempt = 0
+        while True:
+            with self.budget.slot():
+                self.budget.acquire(tokens)
+                try:
+                    return request()
+                except Exception as e:
+                    if not _is_retryable(e) or attempt >= self.max_retries:
+                        raise
+                    error = e
+            attempt += 1
+            self.retries += 1
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            if _is_rate_limit(error):
+                self.rate_limited += 1
+                delay = max(delay, _retry_after(error) or 0)
+                self.budget.pause(delay)
+            logger.warning(f"Embedding request failed ({error}), retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = self.pack(texts)
+        if len(batches) == 1:
+            _, batch, tokens = batches[0]
+            return self._call(lambda: self.embeddings.embed_documents(batch), tokens)
+
+        futures = [self._executor.submit(self._call, lambda batch=batch: self.embeddings.embed_documents(batch), tokens)
+                   for _, batch, tokens in batches]
+        vectors = []
+        try:
+            for future in futures:
+                vectors.extend(future.result())
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call(lambda: self.embeddings.embed_query(text), count_tokens(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+    def stats(self):
+        return {**self.budget.stats(), "retries": self.retries, "rateLimited": self.rate_limited}
+
+
+embedding_budget = EmbeddingBudget()
@@ -0,0 +1,133 @@
+'''
+@file evaluationChunker.py
+This file turns the rows of a course evaluation spreadsheet into chunks for embedding.
+
+df.to_string() padded every column with spaces and the text was then split at a fixed number of characters, so the
+padding took up a good part of the embedding and prompt tokens and comments were cut in the middle. Here every row is
+a unit: its non-empty cells are joined with " | " and rows are packed into chunks of at most EVALUATION_CHUNK_TOKENS
+tokens. Each chunk starts with one line naming the columns (and the question, for exports that have a question
+column) instead of repeating them on every row; they are also kept in the chunk metadata with the rows it covers.
+Since empty cells are left out, the values of a row with empty cells no longer line up with that line by position.
+That header is left out of the text when it would take more than EVALUATION_HEADER_FRACTION of a chunk, as with
+exports whose column names are whole questions. Only a row that is longer than a whole chunk is split.
+
+Rows are consumed as an iterable, so a spreadsheet does not have to be in memory as a whole, and rows of one question
+are expected next to each other, as evaluation exports list them.
+
+'''
+import math
+import os
+
+from dotenv import load_dotenv
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from service.conversation_history import count_tokens
+
+load_dotenv()
+
+EVALUATION_CHUNK_TOKENS = int(os.getenv('EVALUATION_CHUNK_TOKENS', '300'))
+# Largest share of a chunk the question and column header may take, the rest is left for rows
+EVALUATION_HEADER_FRACTION = float(os.getenv('EVALUATION_HEADER_FRACTION', '0.3'))
+
+
+def is_question_column(name):
+    return "question" in str(name).lower()
+
+
+def _column_name(name):
+    # pandas names header cells that are blank "Unnamed: 3"
+    name = str(name).strip()
+    return "" if name.startswith("Unnamed:") else name
+
+
+def format_cell(value):
+    """Text of a spreadsheet cell, or "" for an empty one. Whole numbers read as floats lose their ".0"."""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    return str(value).strip()
+
+
+class _Chunk:
+    def __init__(self, header, question, first_row):
+        self.header = header
+        self.question = question
+        self.first_row = first_row
+        self.last_row = first_row
+        self.lines = []
+        self.tokens = count_tokens(header) if header else 0
+
+
+def _header(question, columns_line, max_tokens):
+    """The header lines of a chunk that fit in max_tokens; the column line is left out first, then the question."""
+    lines = [f"Question: {question}"] if question else []
+    lines.append(columns_line)
+    while lines and count_tokens("\n".join(lines)) > max_tokens:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def chunk_rows(columns, rows, source_name, token_budget=EVALUATION_CHUNK_TOKENS,
+               header_fraction=EVALUATION_HEADER_FRACTION):
+    """
+    Yield Documents for the rows of a sheet. columns are the header cells and rows an iterable of sequences of cell
+    values in the same order. Row numbers in the metadata count data rows from 1.
+    """
+    columns = [_column_name(column) for column in columns]
+    question_index = next((index for index, name in enumerate(columns) if is_question_column(name)), None)
+    value_columns = [index for index in range(len(columns)) if index != question_index]
+    columns_line = "Columns: " + " | ".join(columns[index] for index in value_columns)
+    max_header_tokens = int(token_budget * header_fraction)
+
+    def to_document(chunk):
+        metadata = {
+            "source": source_name,
+            "columns": [columns[index] for index in value_columns],
+            "firstRow": chunk.first_row,
+            "lastRow": chunk.last_row,
+        }
+        if chunk.question:
+            metadata["question"] = chunk.question
+        return Document(page_content="\n".join(([chunk.header] if chunk.header else []) + chunk.lines),
+                        metadata=metadata)
+
+    chunk = None
+    for row_number, row in enumerate(rows, start=1):
+        question = format_cell(row[question_index]) if question_index is not None and question_index < len(row) else ""
+        # Empty cells are left out instead of spending tokens on separators around nothing
+        cells = (format_cell(row[index]) for index in value_columns if index < len(row))
+        line = " | ".join(cell for cell in cells if cell)
+        if not line:
+            continue
+        tokens = count_tokens(line)
+
+        if chunk is not None and (question != chunk.question or chunk.tokens + tokens > token_budget):
+            yield to_document(chunk)
+            chunk = None
+        if chunk is None:
+            chunk = _Chunk(_header(question, columns_line, max_header_tokens), question, row_number)
+
+        if chunk.tokens + tokens > token_budget:
+            # Only reached by a row that does not fit in an empty chunk, it is split on sentences and words into
+            # parts that fit next to the header, which takes at most header_fraction of the budget
+            splitter = RecursiveCharacterTextSplitter(chunk_size=token_budget - chunk.tokens, chunk_overlap=0,
+                                                      length_function=count_tokens)
+            for part in splitter.split_text(line):
+                if chunk.lines:
+                    yield to_document(chunk)
+                    chunk = _Chunk(chunk.header, question, row_number)
+                chunk.lines.append(part)
+                chunk.tokens += count_tokens(part)
+            chunk.last_row = row_number
+            continue
+        chunk.lines.append(line)
+        chunk.tokens += tokens
+        chunk.last_row = row_number
+
+    if chunk is not None and chunk.lines:
+        yield to_document(chunk)
@@ -5,20 +5,26 @@ This file is responsible for generating the embeddings for on the fly course eva
 @Author: Sanjit Verma
 """
 import logging
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from pymongo import MongoClient
 from dotenv import load_dotenv
 from langchain_openai import OpenAIEmbeddings
-from langchain_mongodb import MongoDBAtlasVectorSearch
 import os
 import datetime
+import secrets
 import time
-from langchain.schema import Document
+from itertools import islice
+from vectorsMongoDB.embeddingScheduler import EmbeddingScheduler
+from repository.mongo_connection import get_database
 
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
+
+# Shared by every upload so they are batched and rate limited together (see embeddingScheduler.py)
+evaluation_embeddings = EmbeddingScheduler(OpenAIEmbeddings(disallowed_special=(), max_retries=0))
+# Chunks embedded and inserted at a time; progress is reported after each batch
+EVALUATION_EMBED_BATCH_SIZE = int(os.getenv('EVALUATION_EMBED_BATCH_SIZE', '256'))
+
 class GenerateEvaluation:
     def __init__(self):
         self.OPENAI_KEY = os.getenv("OPENAI_API_KEY")
@@ -27,53 +33,71 @@ class GenerateEvaluation:
         self.user_collection_name = os.getenv('MONGODB_VECTORS_COURSEEVALUATION_DOCS')
         self.vector_index_name = os.getenv('MONGODB_VECTOR_INDEX_TEMPUSER_DOC')
         
-        self.client = MongoClient(self.MONGODB_URI)
-        # self.db = self.client[self.db_name]
-        # self.user_collection = self.db[self.user_collection_name]
-        self.embedding_model = OpenAIEmbeddings(disallowed_special=())
-        self.MONGODB_COLLECTION = self.client[self.db_name][self.user_collection_name]
-
-        self.vector_store = MongoDBAtlasVectorSearch(
-            collection=self.MONGODB_COLLECTION,
-            embedding=self.embedding_model,
-            index_name=self.vector_index_name,
-            relevance_score_fn="cosine",
-        )
+        # Shared connection and embeddings, creating a GenerateEvaluation per upload costs nothing
+        self.embedding_model = evaluation_embeddings
+        self.MONGODB_COLLECTION = get_database(self.db_name)[self.user_collection_name]
 
-    def generate_embeddings(self, session_id, documents):
+    def generate_embeddings(self, session_id, documents, progress=None):
+        """
+        Embed the documents, already chunked by LoadEvaluation, and store them for the session.
+        documents may be a generator; it is read EVALUATION_EMBED_BATCH_SIZE chunks at a time, so the file can still be
+        parsed while the first batches are embedded. Errors raised by the generator reach the caller.
+        progress(parsed, embedded, stored) is called after every batch is parsed, embedded and stored.
+        An upload is stored whole or not at all: if a batch or the generator fails, the batches already inserted are
+        deleted again, so a retried upload does not store its chunks twice.
+        """
+        created_at = datetime.datetime.utcnow()
+        # Tells the chunks of this upload apart from earlier uploads of the session
+        upload_id = secrets.token_hex(8)
+        documents = iter(documents)
+        parsed = embedded = stored = 0
         try:
-            if not documents:
-                logger.warning("No documents provided for embedding generation.")
-                return False
-
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=2000,
-                chunk_overlap=20,
-                length_function=len,
-                is_separator_regex=False,
-            )
-
-            all_docs = []
-            for doc in documents:
-                # Split each document's content
-                splits = text_splitter.split_text(doc.page_content)
-                for split_content in splits:
-                    new_doc = Document(
-                        page_content=split_content,
-                        metadata={
-                            "source": session_id,
-                            "createdAt": datetime.datetime.utcnow()
-                        }
-                    )
-                    all_docs.append(new_doc)
+            while True:
+                batch = []
+                for doc in islice(documents, EVALUATION_EMBED_BATCH_SIZE):
+                    # Retrieval filters the session's chunks on source, the name of the uploaded file is kept as file
+                    metadata = {**doc.metadata, "file": doc.metadata.get("source"), "source": session_id,
+                                "createdAt": created_at, "uploadId": upload_id}
+                    batch.append((doc.page_content, metadata))
+                if not batch:
+                    break
+                parsed += len(batch)
+                if progress:
+                    progress(parsed, embedded, stored)
+                try:
+                    vectors = self.embedding_model.embed_documents([text for text, _ in batch])
+                    embedded += len(batch)
+                    if progress:
+                        progress(parsed, embedded, stored)
+                    # Same layout as MongoDBAtlasVectorSearch: text, embedding and the metadata as top level fields
+                    self.MONGODB_COLLECTION.insert_many([
+                        {"text": text, "embedding": vector, **metadata}
+                        for (text, metadata), vector in zip(batch, vectors)
+                    ])
+                except Exception as e:
+                    logger.exception(f"Failed to create or store embeddings: {str(e)}")
+                    self._remove_upload(session_id, upload_id, parsed)
+                    return False
+                stored += len(batch)
+                if progress:
+                    progress(parsed, embedded, stored)
+        except BaseException:
+            # The file could not be read to the end
+            self._remove_upload(session_id, upload_id, parsed)
+            raise
 
-            self.vector_store.add_documents(documents=all_docs)
-            logger.info(f"Embeddings stored for session {session_id}")
-
-            return True
-
-        except Exception as e:
-            logger.exception(f"Failed to create or store embeddings: {str(e)}")
+        if not parsed:
+            logger.warning("No documents provided for embedding generation.")
             return False
+        logger.info(f"Embeddings stored for session {session_id}")
+        return True
 
-        
\ No newline at end of file
+    def _remove_upload(self, session_id, upload_id, parsed):
+        """Delete the chunks a failed upload already stored."""
+        if not parsed:
+            return
+        try:
+            removed = self.MONGODB_COLLECTION.delete_many({"source": session_id, "uploadId": upload_id}).deleted_count
+            logger.info(f"Removed {removed} chunks of a failed upload for session {session_id}")
+        except Exception as e:
+            logger.exception(f"Failed to remove the chunks of a failed upload: {str(e)}")
@@ -1,124 +1,124 @@
 '''
-This file is responsible for generating the vector database from the text chunks. 
+This file is responsible for generating the vector database from the text chunks.
 
-Needs to be run once to load the DB with embeddings and text chunks.
+Needs to be run once to load the DB with embeddings and text chunks. It runs without prompts, so it can be
+scheduled or run on a server:
 
-Run this script from the command line using python generateVectorDB.py
+    python vectorsMongoDB/generateVectorDB.py --collection MONGODB_VECTORS --source pdf
+    python vectorsMongoDB/generateVectorDB.py --collection MONGODB_VECTORS_WEBSITE --source json --path scraped.json
 
-***IMPORTANT*** You can't query your index yet. You must create a vector search index in MongoDB's UI now. 
+--collection takes the name of a MONGODB_VECTORS* environment variable or a collection name. PDFs are read from
+saas-backend/pdfData unless --path is given. The work is done by the staged pipeline in ingestPipeline.py; if a run
+stops part way through, running the same command again resumes it (use --restart to start over). Running it again on
+changed input only embeds the new chunks and deletes the ones that are gone. Files that were removed from the input
+are only deleted from the collection with --prune-missing, which deletes every source of the same type that is not in
+this run's input. The first run on a website collection built by an older version should use --replace-legacy, which
+deletes the old chunks that have no source field instead of keeping them next to the new ones.
+
+***IMPORTANT*** You can't query your index yet. You must create a vector search index in MongoDB's UI now.
 See Create the Atlas Vector Search Index in https://www.mongodb.com/docs/atlas/atlas-vector-search/ai-integrations/langchain/"""
 
 @Author: Sanjit Verma
 '''
+import argparse
+import json
 import os
-from langchain_mongodb import MongoDBAtlasVectorSearch
+import sys
 from langchain_openai import OpenAIEmbeddings
-from pymongo import MongoClient
 from dotenv import load_dotenv
-import loadDocuments
 import logging
-from tqdm import tqdm
+
+# Make the vectorsMongoDB package importable when this file is run as a script from its own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vectorsMongoDB import ingestPipeline
+from vectorsMongoDB.embeddingScheduler import EmbeddingScheduler
+from repository.mongo_connection import get_database
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-# Retrieve environment variables 
+# Retrieve environment variables
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 MONGODB_URI = os.getenv('MONGODB_URI')
 db_name = os.getenv('MONGODB_DATABASE')
 
 vector_collection_vars = {key: value for key, value in os.environ.items() if 'MONGODB_VECTORS' in key and value.strip()}
-vector_index_vars = {key: value for key, value in os.environ.items() if 'MONGODB_VECTOR_INDEX' in key and value.strip()}
-
-if not all([OPENAI_KEY, MONGODB_URI, db_name, vector_collection_vars, vector_index_vars]):
-    logger.error("One or more environment variables are missing or empty.")
-    exit(1)
-
-def display_menu():
-    print("1) Generate Vector DB")
-    print("2) Exit")
-    choice = input("Select an option: ")
-    return choice
-
-def select_collection_name():
-    print("\nSelect collection name:")
-    for idx, (key, name) in enumerate(vector_collection_vars.items(), start=1):
-        print(f"{idx}) {name}")
-    selected_idx = int(input("Enter your choice: ")) - 1
-    selected_key = list(vector_collection_vars.keys())[selected_idx]
-    return vector_collection_vars[selected_key]
-
-def select_vector_search_idx():
-    print("\nSelect vector search index:")
-    for idx, (key, name) in enumerate(vector_index_vars.items(), start=1):
-        print(f"{idx}) {name}")
-    selected_idx = int(input("Enter your choice: ")) - 1
-    selected_key = list(vector_index_vars.keys())[selected_idx]
-    return vector_index_vars[selected_key]
-
-def get_file_type():
-    print("Enter the type of input data:")
-    print("1) PDF")
-    print("2) JSON")
-    file_type = input("Select 1 for PDF or 2 for JSON: ")
-    return file_type
-
-# Menu loop
-while True:
-    choice = display_menu()
-    if choice == '1':
-        collection_name = select_collection_name()
-        vector_search_idx = select_vector_search_idx()
-        break
-    elif choice == '2':
-        print("Exiting...")
-        exit(0)
-    else:
-        print("Invalid option. Please try again.")
-
-# Connect to db
-client = MongoClient(MONGODB_URI)
-db = client[db_name]
-collection = db[collection_name]
-
-# Get the file type
-file_type = get_file_type()
 
-# Loading documents based on file type (PDF or JSON)
-docs = []
-if file_type == '1':  # PDF selected
-    current_script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_dir = os.path.dirname(current_script_dir)
-    pdf_directory = os.path.join(base_dir, 'pdfData')  # Directory containing PDF files
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Extract, chunk, embed and store documents in a vector collection.")
+    parser.add_argument("--collection", required=True,
+                        help=f"One of {', '.join(vector_collection_vars)} or a collection name")
+    parser.add_argument("--source", choices=["pdf", "json"], default="pdf", help="Type of the input data")
+    parser.add_argument("--path", help="PDF directory (defaults to saas-backend/pdfData) or JSON file")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoints of an unfinished run")
+    parser.add_argument("--batch-size", type=int, default=ingestPipeline.INGEST_EMBED_BATCH_SIZE,
+                        help="Chunks handed to the embedding scheduler at a time")
+    parser.add_argument("--queue-size", type=int, default=ingestPipeline.INGEST_QUEUE_SIZE,
+                        help="Capacity of the queues between stages")
+    parser.add_argument("--prune-missing", action="store_true",
+                        help="Delete the sources of the same type that are not in this run's input")
+    parser.add_argument("--replace-legacy", action="store_true",
+                        help="Delete the chunks without a source field stored by older versions (first JSON run)")
+    return parser.parse_args()
+
+
+def main():
+    if not all([OPENAI_KEY, MONGODB_URI, db_name, vector_collection_vars]):
+        logger.error("One or more environment variables are missing or empty.")
+        exit(1)
+
+    args = parse_args()
+    collection_name = vector_collection_vars.get(args.collection, args.collection)
+
+    if args.source == 'pdf':
+        current_script_dir = os.path.dirname(os.path.abspath(__file__))
+        base_dir = os.path.dirname(current_script_dir)
+        pdf_directory = args.path or os.path.join(base_dir, 'pdfData')  # Directory containing PDF files
+
+        logging.getLogger('pypdf._reader').setLevel(logging.ERROR)
+        sources = ingestPipeline.pdf_sources(pdf_directory)
+    else:
+        if not args.path:
+            logger.error("--path is required for JSON input")
+            exit(1)
+        sources = ingestPipeline.json_sources(args.path)
     logging.getLogger('httpx').setLevel(logging.WARNING)
-    logging.getLogger('pypdf._reader').setLevel(logging.ERROR)
-
-    docs =  loadDocuments.load_pdfs(pdf_directory)
-    print(f"Total PDF chunks loaded: {len(docs)}\n")
-
-elif file_type == '2':  # JSON selected
-    json_file_path = input("Enter the full path to the JSON file: ")
-    docs = loadDocuments.load_json(json_file_path)
-    print(f"Total JSON documents loaded: {len(docs)}\n")
-else:
-    print("Invalid file type selected. Exiting.")
-    exit(1)
-
-# Initialize the vector store object and create the embeddings
-try:
-    with tqdm(total=len(docs), desc="Creating Embeddings") as progress_bar:
-        vector_search = MongoDBAtlasVectorSearch.from_documents(
-            documents=docs,
-            embedding=OpenAIEmbeddings(disallowed_special=()),
-            collection=collection,
-            index_name=vector_search_idx,
-        )
-        progress_bar.update(len(docs))
-
-    print("\n")
+
+    # Connect to db
+    db = get_database(db_name)
+
+    # The scheduler splits each embed batch into concurrent requests within the RPM/TPM limits and owns the retries
+    embeddings = EmbeddingScheduler(OpenAIEmbeddings(disallowed_special=(), max_retries=0))
+    pipeline = ingestPipeline.IngestPipeline(
+        db,
+        collection_name,
+        embeddings,
+        queue_size=args.queue_size,
+        embed_batch_size=args.batch_size,
+        prune_missing=args.prune_missing,
+        replace_legacy=args.replace_legacy,
+    )
+    logger.info(f"Ingesting {len(sources)} sources into {collection_name}")
+    try:
+        stats = pipeline.run(sources, restart=args.restart)
+    except Exception as e:
+        logger.error(f"Failed to create embeddings: {str(e)}. Run the same command again to resume.")
+        exit(1)
+
+    stats["embeddings"] = embeddings.stats()
+    print(json.dumps(stats, indent=2))
+    changes = stats["changes"]
+    logger.info(f"{changes['added']} chunks added, {changes['updated']} updated, {changes['removed']} removed "
+                f"({changes['sourcesRemoved']} sources removed), {changes['unchanged']} unchanged")
+    if stats["sources"]["failed"]:
+        logger.warning(f"Sources that failed and will be retried on the next run: {', '.join(stats['sources']['failed'])}")
+        exit(1)
     logger.info(f"Successfully created embeddings in {collection_name}")
     logger.info("""***IMPORTANT*** You can't query your index yet. You must create a vector search index in MongoDB's UI now. See Create the Atlas Vector Search Index in https://www.mongodb.com/docs/atlas/atlas-vector-search/ai-integrations/langchain/""")
-except Exception as e:
-    logger.error(f"Failed to create embeddings: {str(e)}")
+
+
+# The PDF extraction pool starts worker processes that import this module, which must not run the ingestion again
+if __name__ == '__main__':
+    main()
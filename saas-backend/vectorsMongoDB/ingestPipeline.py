@@ -0,0 +1,482 @@
+'''
+@file ingestPipeline.py
+This file contains the streaming ingestion pipeline used by generateVectorDB.py.
+
+Ingestion runs as four stages, each on its own thread and connected by bounded queues:
+
+    extract (pages of a source) -> chunk (text splitter) -> embed (OpenAI, in batches) -> upsert (bulk_write)
+
+Only a queue's worth of pages, chunks and vectors is in memory at any time, whatever the size of the corpus, and a
+slow stage pushes back on the ones before it. Once every chunk of a source is in MongoDB the source is checkpointed;
+a run that stops part way through is resumed by running it again, which skips the checkpointed sources. Checkpoints
+are removed when a run finishes without failures.
+
+Re-ingestion is incremental. A chunk's _id is derived from the hash of its text, and a manifest per source records
+the chunks stored for it with a hash of their metadata. Only chunks that are not in the manifest are embedded;
+chunks that only moved (a new page number) get their metadata updated, and chunks that disappeared from a source are
+deleted from the collection; a source that yields no chunks at all is counted as failed and left as it is. Sources
+that disappeared from the input are only deleted with prune_missing, since the manifests of a collection also list
+the sources of runs over other directories or files. With replace_legacy, the first run of a JSON source also
+deletes the chunks stored by older versions of the script without a "source" field, which load_json did not set and
+which would otherwise stay next to their re-embedded copies.
+
+'''
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from pymongo import ReplaceOne, UpdateOne
+
+from vectorsMongoDB import loadDocuments
+from vectorsMongoDB.corpusVersion import bump_corpus_version
+
+load_dotenv()
+logger = logging.getLogger()
+
+# Collection that stores one document per source ingested by an unfinished run
+INGEST_CHECKPOINTS_COLLECTION = os.getenv('MONGODB_INGEST_CHECKPOINTS', 'MONGODB_INGEST_CHECKPOINTS')
+# Collection that stores the chunk manifest of every ingested source
+INGEST_MANIFEST_COLLECTION = os.getenv('MONGODB_INGEST_MANIFEST', 'MONGODB_INGEST_MANIFEST')
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '256'))
+# Chunks handed to the embeddings at once; the embedding scheduler sends them as several concurrent requests
+INGEST_EMBED_BATCH_SIZE = int(os.getenv('INGEST_EMBED_BATCH_SIZE', '512'))
+INGEST_PROGRESS_SECONDS = float(os.getenv('INGEST_PROGRESS_SECONDS', '10'))
+
+# Markers that travel through the queues behind the items of a source
+_END_OF_SOURCE = "end"
+_SOURCE_FAILED = "failed"
+_END_OF_STREAM = object()
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when another stage failed and the run is being stopped."""
+
+
+class Source:
+    """One unit of ingestion and checkpointing: a PDF file or a JSON file."""
+
+    def __init__(self, name, kind, load_pages):
+        self.name = name
+        # With prune_missing, sources of one kind that are gone from the input are removed from the collection
+        self.kind = kind
+        self._load_pages = load_pages
+
+    def pages(self):
+        """Yield the Documents of the source before splitting."""
+        return self._load_pages()
+
+
+def pdf_sources(directory):
+    """One Source per PDF in a directory, yielding a Document per page."""
+    return [Source(filename, "pdf", lambda path=os.path.join(directory, filename): loadDocuments.iter_pdf_pages(path))
+            for filename in loadDocuments.list_pdfs(directory)]
+
+
+def json_sources(json_file_path):
+    """
+    A single Source for a scraped website JSON file. load_json already splits the content, the chunk stage leaves
+    chunks that are within the chunk size as they are.
+    """
+    return [Source(os.path.basename(json_file_path), "json", lambda: iter(loadDocuments.load_json(json_file_path)))]
+
+
+def _hash(value):
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+
+def chunk_key(text, occurrence):
+    """
+    Key of a chunk within its source: the hash of its text and how many identical chunks came before it. Editing one
+    part of a document leaves the keys of the other chunks unchanged.
+    """
+    return f"{_hash(text)[:24]}-{occurrence}"
+
+
+def chunk_id(source_name, key):
+    """_id of a chunk in the vector collection."""
+    return f"{source_name}:{key}"
+
+
+def metadata_hash(metadata):
+    return _hash(json.dumps(metadata, sort_keys=True, default=str))[:16]
+
+
+class StageMetrics:
+    """Counters of one stage. busy is the time spent working, as opposed to waiting on a queue."""
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def add(self, items, busy):
+        self.items += items
+        self.busy += busy
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.items / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "unit": self.unit,
+            "seconds": round(self.elapsed(), 2),
+            "busySeconds": round(self.busy, 2),
+            "perSecond": round(self.rate(), 2),
+        }
+
+
+class IngestPipeline:
+    def __init__(self, db, collection_name, embeddings, queue_size=INGEST_QUEUE_SIZE,
+                 embed_batch_size=INGEST_EMBED_BATCH_SIZE, progress_seconds=INGEST_PROGRESS_SECONDS,
+                 prune_missing=False, replace_legacy=False):
+        """
+        Initialize a pipeline that writes into db[collection_name].
+        embeddings is a LangChain Embeddings object; embed_documents is called once per batch of chunks.
+        prune_missing deletes the sources of the same kind that are not in the input of a run, replace_legacy deletes
+        the chunks without a source field when a JSON source is ingested for the first time.
+        """
+        self.db = db
+        self.collection_name = collection_name
+        self.collection = db[collection_name]
+        self.checkpoints = db[INGEST_CHECKPOINTS_COLLECTION]
+        self.manifests = db[INGEST_MANIFEST_COLLECTION]
+        self.embeddings = embeddings
+        self.embed_batch_size = embed_batch_size
+        self.progress_seconds = progress_seconds
+        self.prune_missing = prune_missing
+        self.replace_legacy = replace_legacy
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=loadDocuments.CHUNK_SIZE,
+                                                            chunk_overlap=loadDocuments.CHUNK_OVERLAP)
+        self._pages = queue.Queue(maxsize=queue_size)
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._vectors = queue.Queue(maxsize=max(1, queue_size // embed_batch_size))
+        self._stop = threading.Event()
+        self._errors = []
+        self.metrics = {
+            "extract": StageMetrics("extract", "pages"),
+            "chunk": StageMetrics("chunk", "chunks"),
+            "embed": StageMetrics("embed", "chunks"),
+            "upsert": StageMetrics("upsert", "chunks"),
+        }
+        self.sources_total = 0
+        self.sources_done = 0
+        self.sources_skipped = 0
+        self.failed_sources = []
+        self.changes = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "sourcesRemoved": 0}
+
+    # Checkpoints
+
+    def completed_sources(self):
+        return {document["source"] for document in
+                self.checkpoints.find({"collection": self.collection_name}, {"source": 1})}
+
+    def _checkpoint(self, source_name, chunks):
+        self.checkpoints.update_one(
+            {"collection": self.collection_name, "source": source_name},
+            {"$set": {"chunks": chunks, "completedAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def clear_checkpoints(self):
+        self.checkpoints.delete_many({"collection": self.collection_name})
+
+    # Manifests
+
+    def load_manifest(self, source_name):
+        """Return {chunk key: metadata hash} of the chunks stored for a source, or None if it was never ingested."""
+        manifest = self.manifests.find_one({"collection": self.collection_name, "source": source_name}, {"chunks": 1})
+        return manifest["chunks"] if manifest else None
+
+    def _save_manifest(self, source_name, kind, chunks):
+        self.manifests.update_one(
+            {"collection": self.collection_name, "source": source_name},
+            {"$set": {"kind": kind, "chunks": chunks, "updatedAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def remove_missing_sources(self, sources):
+        """Delete the vectors and manifests of sources of the same kind that are no longer in the input."""
+        names = {source.name for source in sources}
+        for kind in {source.kind for source in sources}:
+            for manifest in self.manifests.find({"collection": self.collection_name, "kind": kind}, {"source": 1}):
+                if manifest["source"] in names:
+                    continue
+                deleted = self.collection.delete_many({"source": manifest["source"]}).deleted_count
+                self.manifests.delete_one({"_id": manifest["_id"]})
+                self.changes["removed"] += deleted
+                self.changes["sourcesRemoved"] += 1
+                logger.info(f"{manifest['source']}: source is gone, removed {deleted} chunks")
+
+    # Queue helpers, so a stage blocked on a full or empty queue notices when another stage failed
+
+    def _put(self, target, item):
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                target.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source):
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    # Stages
+
+    def _extract(self, sources):
+        metrics = self.metrics["extract"]
+        for source in sources:
+            started = time.monotonic()
+            try:
+                for page in source.pages():
+                    metrics.add(1, time.monotonic() - started)
+                    self._put(self._pages, ("page", source.name, page))
+                    started = time.monotonic()
+            except PipelineStopped:
+                raise
+            except Exception as e:
+                # A broken file is skipped and left without a checkpoint, the next run tries it again
+                logger.error(f"Failed to extract {source.name}: {e}")
+                self._put(self._pages, (_SOURCE_FAILED, source.name, source.kind))
+                continue
+            self._put(self._pages, (_END_OF_SOURCE, source.name, source.kind))
+        self._put(self._pages, _END_OF_STREAM)
+
+    def _chunk(self):
+        metrics = self.metrics["chunk"]
+        # Diff of the source being chunked against its manifest; sources arrive one after the other
+        current = None
+
+        def start(source_name):
+            manifest = self.load_manifest(source_name)
+            return {"name": source_name, "manifest": manifest or {}, "new": manifest is None, "chunks": {},
+                    "occurrences": {}, "added": 0, "updated": 0, "unchanged": 0}
+
+        while True:
+            item = self._get(self._pages)
+            if item is _END_OF_STREAM:
+                self._put(self._chunks, item)
+                return
+            kind, source_name, value = item
+            if current is None or current["name"] != source_name:
+                current = start(source_name)
+            if kind != "page":
+                current["kind"] = value
+                current["removed"] = len(set(current["manifest"]) - set(current["chunks"]))
+                self._put(self._chunks, (kind, source_name, current))
+                current = None
+                continue
+
+            started = time.monotonic()
+            chunks = self.text_splitter.split_documents([value])
+            metrics.add(len(chunks), time.monotonic() - started)
+            for chunk in chunks:
+                chunk.metadata.setdefault("source", source_name)
+                occurrence = current["occurrences"].get(chunk.page_content, 0)
+                current["occurrences"][chunk.page_content] = occurrence + 1
+                key = chunk_key(chunk.page_content, occurrence)
+                chunk.metadata["_id"] = chunk_id(source_name, key)
+                meta = metadata_hash(chunk.metadata)
+                current["chunks"][key] = meta
+                stored = current["manifest"].get(key)
+                if stored is None:
+                    current["added"] += 1
+                    self._put(self._chunks, ("chunk", source_name, chunk))
+                elif stored != meta:
+                    current["updated"] += 1
+                    self._put(self._chunks, ("metadata", source_name, chunk))
+                else:
+                    current["unchanged"] += 1
+
+    def _embed(self):
+        metrics = self.metrics["embed"]
+        batch = []
+        # Source markers wait for the batch holding the last chunks of their source
+        markers = []
+
+        def flush():
+            if batch:
+                started = time.monotonic()
+                vectors = self.embeddings.embed_documents([chunk.page_content for chunk in batch])
+                metrics.add(len(batch), time.monotonic() - started)
+                self._put(self._vectors, ("batch", list(zip(batch, vectors))))
+                batch.clear()
+            for marker in markers:
+                self._put(self._vectors, marker)
+            markers.clear()
+
+        while True:
+            item = self._get(self._chunks)
+            if item is _END_OF_STREAM:
+                flush()
+                self._put(self._vectors, item)
+                return
+            kind, source_name, value = item
+            if kind == "chunk":
+                batch.append(value)
+                if len(batch) >= self.embed_batch_size:
+                    flush()
+            elif batch:
+                markers.append(item)
+            else:
+                self._put(self._vectors, item)
+
+    def _upsert(self):
+        metrics = self.metrics["upsert"]
+        while True:
+            item = self._get(self._vectors)
+            if item is _END_OF_STREAM:
+                return
+            if item[0] == "batch":
+                started = time.monotonic()
+                operations = []
+                for chunk, vector in item[1]:
+                    document = {**chunk.metadata, "text": chunk.page_content, "embedding": vector}
+                    operations.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+                self.collection.bulk_write(operations, ordered=False)
+                metrics.add(len(operations), time.monotonic() - started)
+                continue
+            kind, source_name, value = item
+            if kind == "metadata":
+                metadata = {key: field for key, field in value.metadata.items() if key != "_id"}
+                self.collection.bulk_write([UpdateOne({"_id": value.metadata["_id"]}, {"$set": metadata})])
+            elif kind == _END_OF_SOURCE:
+                self._finish_source(source_name, value)
+            else:
+                self.failed_sources.append(source_name)
+
+    def _finish_source(self, source_name, diff):
+        """Delete the chunks that are gone from a source, then record its manifest and checkpoint."""
+        if not diff["chunks"]:
+            # No text at all is far more likely a broken read than a source emptied on purpose, nothing is deleted
+            logger.warning(f"{source_name}: no chunks were read, keeping its vectors and retrying it on the next run")
+            self.failed_sources.append(source_name)
+            return
+        if diff["removed"] or diff["new"]:
+            # A source without a manifest may have vectors from before manifests existed, which are replaced too
+            ids = [chunk_id(source_name, key) for key in diff["chunks"]]
+            diff["removed"] = self.collection.delete_many(
+                {"source": source_name, "_id": {"$nin": ids}}
+            ).deleted_count
+        if diff["new"] and diff["kind"] == "json" and self.replace_legacy:
+            # load_json only set document_number before manifests existed, those chunks cannot be told apart by source
+            legacy = self.collection.delete_many({"source": {"$exists": False}}).deleted_count
+            diff["removed"] += legacy
+            if legacy:
+                logger.info(f"{source_name}: removed {legacy} chunks stored without a source by an older version")
+        self._save_manifest(source_name, diff["kind"], diff["chunks"])
+        self._checkpoint(source_name, len(diff["chunks"]))
+        for change in ("added", "updated", "unchanged", "removed"):
+            self.changes[change] += diff[change]
+        self.sources_done += 1
+        if diff["added"] or diff["updated"] or diff["removed"]:
+            logger.info(f"{source_name}: {diff['added']} added, {diff['updated']} updated, "
+                        f"{diff['removed']} removed, {diff['unchanged']} unchanged")
+
+    def _run_stage(self, name, target, *args):
+        metrics = self.metrics[name]
+        metrics.started = time.monotonic()
+        try:
+            target(*args)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            logger.error(f"Ingestion stage {name} failed: {e}")
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            metrics.finished = time.monotonic()
+
+    # Progress
+
+    def progress_line(self):
+        stages = " | ".join(
+            f"{metrics.name} {metrics.items} {metrics.unit} ({metrics.rate():.1f}/s)" for metrics in self.metrics.values()
+        )
+        return (f"{self.sources_done + self.sources_skipped}/{self.sources_total} sources | {stages} | "
+                f"queued {self._pages.qsize()} pages, {self._chunks.qsize()} chunks, {self._vectors.qsize()} batches")
+
+    def stats(self):
+        return {
+            "collection": self.collection_name,
+            "sources": {
+                "total": self.sources_total,
+                "done": self.sources_done,
+                "skipped": self.sources_skipped,
+                "failed": list(self.failed_sources),
+            },
+            "changes": dict(self.changes),
+            "stages": {name: metrics.as_dict() for name, metrics in self.metrics.items()},
+        }
+
+    def run(self, sources, restart=False):
+        """
+        Ingest the sources. Sources checkpointed by an earlier unfinished run are skipped unless restart is set.
+        Returns stats(); raises the error of the first failing stage after the other stages have stopped.
+        """
+        if restart:
+            self.clear_checkpoints()
+        completed = self.completed_sources()
+        pending = [source for source in sources if source.name not in completed]
+        self.sources_total = len(sources)
+        self.sources_skipped = len(sources) - len(pending)
+        if self.sources_skipped:
+            logger.info(f"Resuming: {self.sources_skipped} sources were ingested by an earlier run")
+
+        threads = [
+            threading.Thread(target=self._run_stage, args=("extract", self._extract, pending), name="ingest-extract"),
+            threading.Thread(target=self._run_stage, args=("chunk", self._chunk), name="ingest-chunk"),
+            threading.Thread(target=self._run_stage, args=("embed", self._embed), name="ingest-embed"),
+            threading.Thread(target=self._run_stage, args=("upsert", self._upsert), name="ingest-upsert"),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(self.progress_seconds)
+                    if thread.is_alive():
+                        logger.info(self.progress_line())
+        except KeyboardInterrupt:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+        logger.info(self.progress_line())
+
+        if self.prune_missing and not self._errors and not self.failed_sources:
+            self.remove_missing_sources(sources)
+        if self.changes["added"] or self.changes["updated"] or self.changes["removed"]:
+            # Stamp a new corpus version so the query managers drop answers cached against the old vectors
+            version = bump_corpus_version(self.db, self.collection_name)
+            logger.info(f"Corpus version of {self.collection_name} is now {version}")
+        if self._errors:
+            raise self._errors[0]
+        if not self.failed_sources:
+            self.clear_checkpoints()
+        return self.stats()
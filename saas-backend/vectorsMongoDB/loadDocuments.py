@@ -5,11 +5,15 @@ This file is used to load documents from the file system into the Vector generat
 @Author: Dinesh Kannan (dkannan)
 '''
 import os
-import pdfplumber
 import json
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 from tqdm import tqdm
+from vectorsMongoDB.pdfExtraction import extract_text_from_page, iter_page_texts
+
+# Chunk size and overlap in characters, shared by every loader and by ingestPipeline.py
+CHUNK_SIZE = 1048
+CHUNK_OVERLAP = 100
 
 '''def load_pdfs(directory):
     """
@@ -48,39 +52,33 @@ from tqdm import tqdm
             tqdm.write(f"Failed to process {filename}: {e}")
     return documents'''
 
-def extract_text_from_page(page):
-    text = page.extract_text() or ""  # Ensure text is a string
-    tables = page.extract_tables() or []
+def list_pdfs(directory):
+    """Return the names of the PDF files in a directory, sorted so runs process them in the same order."""
+    return sorted(f for f in os.listdir(directory) if f.endswith('.pdf'))
 
-    table_texts = []
-    for table in tables:
-        if table:
-            table_text = "\n".join(["\t".join(cell or "" for cell in row) for row in table])
-            table_texts.append(table_text)
-    
-    return text + "\n\n" + "\n\n".join(table_texts)
+def iter_pdf_pages(pdf_path):
+    """
+    Yield one Document per page of a PDF, in page order. Large files are extracted by a process pool
+    (see pdfExtraction.py); pages are released as soon as their text is extracted.
+    """
+    filename = os.path.basename(pdf_path)
+    for page_num, text in iter_page_texts(pdf_path):
+        yield Document(page_content=text, metadata={"page_number": page_num, "source": filename})
 
 def load_pdfs(directory):
     """
     Load all PDFs from a directory, split them into chunks, and return the chunks.
     """
     documents = []
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1048, chunk_overlap=100)
-    
-    # List all PDF files in the directory, filter out non-PDF files
-    pdf_files = [f for f in os.listdir(directory) if f.endswith('.pdf')]
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     
     #loop over all the PDF files in the directory, tqdm is a progress bar
-    for filename in tqdm(pdf_files, desc="Processing PDFs", unit="file"):
+    for filename in tqdm(list_pdfs(directory), desc="Processing PDFs", unit="file"):
         pdf_path = os.path.join(directory, filename)
         
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages, start=1):
-                    text = extract_text_from_page(page)
-                    doc = Document(page_content=text, metadata={"page_number": page_num, "source": filename})
-                    docs = text_splitter.split_documents([doc])
-                    documents.extend(docs)
+            docs = text_splitter.split_documents(list(iter_pdf_pages(pdf_path)))
+            documents.extend(docs)
             tqdm.write(f"Loaded and processed {len(docs)} chunks from {filename}.")
         except Exception as e:
             tqdm.write(f"Failed to process {filename}: {e}")
@@ -89,7 +87,7 @@ def load_pdfs(directory):
 
 def load_json(directory):
     documents = []
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1048, chunk_overlap=100)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     unique_contents = set()  # To track unique document content
 
     try:
@@ -128,6 +126,8 @@ def load_json(directory):
 
     except Exception as e:
         tqdm.write(f"Failed to process {directory}: {e}")
+        # An unreadable file must fail its source, returning no documents would delete its vectors
+        raise
 
     return documents
 
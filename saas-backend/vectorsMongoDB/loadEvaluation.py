@@ -2,15 +2,39 @@
 @file loadEvaluation.py
 This file is responsible for chunking the course evaluation for on the fly course evaluations
 
+Files are read as a stream: CSV files EVALUATION_CSV_ROWS_PER_READ rows at a time and xlsx files row by row from a
+read-only workbook, and chunks are yielded as soon as they are full, so the memory an upload takes does not grow with
+the size of the export.
+
 @Author: Sanjit Verma
 """
+import codecs
+import io
 import os
+from itertools import chain
+
 import pandas as pd
-import pdfplumber
-from io import BytesIO
+from dotenv import load_dotenv
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-from tqdm import tqdm
+from openpyxl import load_workbook
+from vectorsMongoDB import pdfExtraction
+from vectorsMongoDB.evaluationChunker import chunk_rows
+
+load_dotenv()
+
+EVALUATION_CSV_ROWS_PER_READ = int(os.getenv('EVALUATION_CSV_ROWS_PER_READ', '5000'))
+# Uploads are extracted in the calling thread, a process pool would import the server again in every worker
+EVALUATION_PDF_EXTRACT_WORKERS = int(os.getenv('EVALUATION_PDF_EXTRACT_WORKERS', '0'))
+
+
+def _decode_as_latin1(error):
+    # Bytes that are not valid in the detected encoding are read as latin1 instead of failing the whole upload
+    return error.object[error.start:error.end].decode('latin1'), error.end
+
+
+codecs.register_error('evaluation_latin1', _decode_as_latin1)
+
 
 class LoadEvaluation:
     def __init__(self, chunk_size=1048, chunk_overlap=100):
@@ -20,13 +44,17 @@ class LoadEvaluation:
 
     def load_from_stream(self, file_stream, file_type, encoding='utf-8'):
         """Handle different file types with better error handling"""
+        return list(self.iter_from_stream(file_stream, file_type, encoding=encoding))
+
+    def iter_from_stream(self, file_stream, file_type, encoding='utf-8'):
+        """Like load_from_stream, but yields the chunks while the file is read"""
         try:
             if file_type == 'pdf':
-                return self.extract_text_from_pdf(file_stream)
+                yield from self.extract_text_from_pdf(file_stream)
             elif file_type == 'csv':
-                return self.load_csv(file_stream, encoding=encoding)
+                yield from self.load_csv(file_stream, encoding=encoding)
             elif file_type in ['xlsx', 'xls']:
-                return self.load_excel(file_stream, file_type)
+                yield from self.load_excel(file_stream, file_type)
             else:
                 raise ValueError(f"Unsupported file format: {file_type}")
         except Exception as e:
@@ -34,39 +62,33 @@ class LoadEvaluation:
             raise
 
     def extract_text_from_pdf(self, file_stream):
-        documents = []
-        with pdfplumber.open(file_stream) as pdf:
-            for page_num, page in enumerate(pdf.pages):
-                text = self.extract_text_from_page(page)
-                doc = Document(page_content=text, metadata={"page_number": page_num + 1, "source": "uploaded.pdf"})
-                docs = self.text_splitter.split_documents([doc])
-                documents.extend(docs)
-        return documents
+        """Split an uploaded PDF into chunks, extracted page by page with pdfExtraction.py"""
+        # Not kept in the page cache, the text of an evaluation must not outlive its session (see session_retention.py)
+        for page_num, text in pdfExtraction.iter_page_texts(file_stream, workers=EVALUATION_PDF_EXTRACT_WORKERS,
+                                                            use_cache=False):
+            doc = Document(page_content=text, metadata={"page_number": page_num, "source": "uploaded.pdf"})
+            yield from self.text_splitter.split_documents([doc])
 
     @staticmethod
     def extract_text_from_page(page):
-        text = page.extract_text() or ""
-        tables = page.extract_tables() or []
-        table_texts = ['\n'.join(['\t'.join(str(cell) if cell is not None else '' for cell in row) for row in table]) for table in tables]
-        return text + '\n\n' + '\n\n'.join(table_texts)
+        return pdfExtraction.extract_text_from_page(page)
 
     def load_csv(self, file_stream, encoding='utf-8'):
         """Load and process CSV files"""
         try:
             # Reset stream position
             file_stream.seek(0)
-            df = pd.read_csv(file_stream, encoding=encoding)
-            if df.empty:
-                raise ValueError("The CSV file appears to be empty")
-            return self._chunk_dataframe(df, "uploaded.csv")
-        except UnicodeDecodeError:
-            # Try with different encodings if the specified one fails
+            text = io.TextIOWrapper(file_stream, encoding=encoding, errors='evaluation_latin1', newline='')
             try:
-                file_stream.seek(0)
-                df = pd.read_csv(file_stream, encoding='latin1')
-                return self._chunk_dataframe(df, "uploaded.csv")
-            except Exception as e:
-                raise ValueError(f"Could not read CSV file with any encoding: {str(e)}")
+                frames = pd.read_csv(text, chunksize=EVALUATION_CSV_ROWS_PER_READ)
+                first = next(frames, None)
+                if first is None or first.empty:
+                    raise ValueError("The CSV file appears to be empty")
+                rows = chain.from_iterable(frame.itertuples(index=False, name=None) for frame in chain([first], frames))
+                yield from chunk_rows(list(first.columns), rows, "uploaded.csv")
+            finally:
+                # The job closes the upload itself
+                text.detach()
         except Exception as e:
             raise ValueError(f"Error reading CSV file: {str(e)}")
 
@@ -75,33 +97,50 @@ class LoadEvaluation:
         try:
             # Reset stream position
             file_stream.seek(0)
-            
-            # Try different engines based on file type
+
             if file_type == 'xlsx':
                 try:
-                    df = pd.read_excel(file_stream, engine='openpyxl')
+                    workbook = load_workbook(file_stream, read_only=True, data_only=True)
                 except Exception as e:
                     print(f"openpyxl failed: {str(e)}")
                     file_stream.seek(0)
-                    df = pd.read_excel(file_stream, engine='odf')
-            else:  # xls
-                try:
-                    df = pd.read_excel(file_stream, engine='xlrd')
-                except Exception as e:
-                    print(f"xlrd failed: {str(e)}")
-                    file_stream.seek(0)
-                    # Try openpyxl as fallback
-                    df = pd.read_excel(file_stream, engine='openpyxl')
+                    yield from self._chunk_dataframe(pd.read_excel(file_stream, engine='odf'), "uploaded.xlsx")
+                    return
+                yield from self._chunk_workbook(workbook, "uploaded.xlsx")
+                return
 
-            if df.empty:
-                raise ValueError("The Excel file appears to be empty")
-
-            return self._chunk_dataframe(df, f"uploaded.{file_type}")
+            # xls files are at most 65536 rows, xlrd reads them whole
+            try:
+                df = pd.read_excel(file_stream, engine='xlrd')
+            except Exception as e:
+                print(f"xlrd failed: {str(e)}")
+                file_stream.seek(0)
+                # Try openpyxl as fallback
+                df = pd.read_excel(file_stream, engine='openpyxl')
+            yield from self._chunk_dataframe(df, f"uploaded.{file_type}")
 
         except Exception as e:
             raise ValueError(f"Could not read Excel file: {str(e)}")
 
+    def _chunk_workbook(self, workbook, source_name):
+        """Chunk the first sheet of a read-only workbook, one row in memory at a time"""
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                raise ValueError("The Excel file appears to be empty")
+            found = False
+            for document in chunk_rows(["" if cell is None else cell for cell in header], rows, source_name):
+                found = True
+                yield document
+            if not found:
+                raise ValueError("The Excel file appears to be empty")
+        finally:
+            # A read-only workbook keeps the file open until it is closed
+            workbook.close()
+
     def _chunk_dataframe(self, df, source_name):
-        text = df.to_string(header=True, index=False)
-        doc = Document(page_content=text, metadata={"source": source_name})
-        return self.text_splitter.split_documents([doc])
\ No newline at end of file
+        """One pass over the rows, packed into token sized chunks by evaluationChunker.py"""
+        if df.empty:
+            raise ValueError("The Excel file appears to be empty")
+        return chunk_rows(list(df.columns), df.itertuples(index=False, name=None), source_name)
@@ -0,0 +1,224 @@
+'''
+@file localIndex.py
+This file contains the local FAISS serving tier for the TA textbook vectors (MONGODB_VECTORS).
+
+MongoDB Atlas stays the source of truth. A snapshot of the collection's embeddings is written to disk as a FAISS index
+plus a JSON file with the chunk text and metadata. Each worker memory maps the snapshot at startup and answers
+similarity search in-process. Searches fall back to Atlas when the snapshot is missing, was built from an older
+corpus version, or the query needs a metadata filter.
+
+Build or refresh the snapshot after running generateVectorDB.py:
+
+    python vectorsMongoDB/localIndex.py
+
+'''
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.schema import Document
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu is optional at runtime, Atlas is used without it
+    faiss = None
+
+load_dotenv()
+logger = logging.getLogger()
+
+LOCAL_INDEX_ENABLED = os.getenv('LOCAL_INDEX_ENABLED', 'true').lower() == 'true'
+LOCAL_INDEX_DIR = os.getenv(
+    'LOCAL_INDEX_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'localIndex')
+)
+LOCAL_INDEX_NPROBE = int(os.getenv('LOCAL_INDEX_NPROBE', '16'))
+# Collections smaller than this are served from an exact flat index, larger ones from IVF
+LOCAL_INDEX_IVF_MIN_VECTORS = int(os.getenv('LOCAL_INDEX_IVF_MIN_VECTORS', '10000'))
+
+
+def snapshot_paths(collection_name, directory=LOCAL_INDEX_DIR):
+    """Return the (index, metadata) file paths of a collection's snapshot."""
+    base = os.path.join(directory, collection_name)
+    return base + ".faiss", base + ".meta.json"
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def build_snapshot(collection, collection_name, corpus_version, directory=LOCAL_INDEX_DIR,
+                   text_key="text", embedding_key="embedding"):
+    """
+    Copy every embedding of a collection into a FAISS index on disk and return the number of vectors written.
+    Vectors are normalized so inner product equals cosine similarity, matching the Atlas index.
+    """
+    if faiss is None:
+        raise RuntimeError("faiss-cpu is not installed.")
+
+    vectors = []
+    documents = []
+    for record in collection.find({embedding_key: {"$exists": True}}):
+        vectors.append(np.asarray(record.pop(embedding_key), dtype=np.float32))
+        text = record.pop(text_key, "")
+        record["_id"] = str(record["_id"])
+        documents.append({"text": text, "metadata": record})
+
+    if not vectors:
+        raise ValueError(f"Collection {collection_name} has no embeddings to snapshot.")
+
+    matrix = _normalize_rows(np.vstack(vectors))
+    dimension = matrix.shape[1]
+
+    if len(matrix) >= LOCAL_INDEX_IVF_MIN_VECTORS:
+        nlist = int(4 * math.sqrt(len(matrix)))
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(matrix)
+    else:
+        index = faiss.IndexFlatIP(dimension)
+    index.add(matrix)
+
+    os.makedirs(directory, exist_ok=True)
+    index_path, meta_path = snapshot_paths(collection_name, directory)
+    # Write to temporary files first so running workers never see a half written snapshot
+    faiss.write_index(index, index_path + ".tmp")
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump({
+            "collection": collection_name,
+            "corpusVersion": corpus_version,
+            "dimension": dimension,
+            "count": len(documents),
+            "builtAt": time.time(),
+            "documents": documents,
+        }, f, default=str)
+    os.replace(index_path + ".tmp", index_path)
+    os.replace(meta_path + ".tmp", meta_path)
+    return len(documents)
+
+
+class LocalVectorIndex:
+    """
+    A memory mapped FAISS snapshot of one collection.
+    """
+
+    def __init__(self, index, documents, corpus_version, nprobe=LOCAL_INDEX_NPROBE):
+        self.index = index
+        self.documents = documents
+        self.corpus_version = corpus_version
+        if hasattr(index, "nprobe"):
+            index.nprobe = nprobe
+
+    @classmethod
+    def load(cls, collection_name, directory=LOCAL_INDEX_DIR):
+        """Load a snapshot from disk, or return None when there is none (or faiss is not installed)."""
+        if faiss is None:
+            return None
+        index_path, meta_path = snapshot_paths(collection_name, directory)
+        if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Not every index type can be memory mapped, read it into memory instead
+            index = faiss.read_index(index_path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return cls(index, meta["documents"], meta["corpusVersion"])
+
+    def search(self, query_vector, k=10):
+        """Return the k most similar chunks with Atlas compatible cosine scores in [0, 1]."""
+        query = _normalize_rows(np.asarray([query_vector], dtype=np.float32))
+        similarities, positions = self.index.search(query, k)
+        results = []
+        for similarity, position in zip(similarities[0], positions[0]):
+            if position < 0:
+                continue
+            document = self.documents[position]
+            results.append((
+                Document(page_content=document["text"], metadata=dict(document["metadata"])),
+                (1.0 + float(similarity)) / 2.0
+            ))
+        return results
+
+
+class LocalFirstVectorIndex:
+    """
+    Serves searches from the local snapshot while it matches the current corpus version, otherwise from Atlas.
+    """
+
+    def __init__(self, atlas_index, local_index, corpus_version_tracker):
+        self.atlas_index = atlas_index
+        self.local_index = local_index
+        self.corpus_version = corpus_version_tracker
+        self.local_searches = 0
+        self.atlas_searches = 0
+        self._warned_version = None
+
+    def _local_is_fresh(self):
+        if self.local_index is None:
+            return False
+        try:
+            current = self.corpus_version.current()
+        except Exception:
+            # Atlas is unreachable, the snapshot is the best answer we have
+            return True
+        if current == self.local_index.corpus_version:
+            return True
+        if self._warned_version != current:
+            self._warned_version = current
+            logger.warning(f"Local vector index is at corpus version {self.local_index.corpus_version}, "
+                           f"collection is at {current}. Serving from Atlas until the snapshot is rebuilt.")
+        return False
+
+    def search(self, query_vector, k=10, pre_filter=None):
+        if not pre_filter and self._local_is_fresh():
+            try:
+                results = self.local_index.search(query_vector, k)
+                self.local_searches += 1
+                return results
+            except Exception as e:
+                logger.warning(f"Local vector search failed, falling back to Atlas: {e}")
+        self.atlas_searches += 1
+        return self.atlas_index.search(query_vector, k, pre_filter)
+
+    async def asearch(self, query_vector, k=10, pre_filter=None):
+        # The freshness check may read the corpus version from MongoDB, keep it off the event loop
+        if not pre_filter and await asyncio.to_thread(self._local_is_fresh):
+            try:
+                results = self.local_index.search(query_vector, k)
+                self.local_searches += 1
+                return results
+            except Exception as e:
+                logger.warning(f"Local vector search failed, falling back to Atlas: {e}")
+        self.atlas_searches += 1
+        return await self.atlas_index.asearch(query_vector, k, pre_filter)
+
+    def stats(self):
+        return {
+            "localLoaded": self.local_index is not None,
+            "localCorpusVersion": self.local_index.corpus_version if self.local_index else None,
+            "localSearches": self.local_searches,
+            "atlasSearches": self.atlas_searches,
+        }
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from repository.mongo_connection import get_database
+    from vectorsMongoDB.corpusVersion import read_corpus_version
+
+    logging.basicConfig(level=logging.INFO)
+    collection_name = os.getenv('MONGODB_VECTORS')
+    db = get_database()
+    # Read the version before copying so a concurrent ingestion leaves the snapshot marked stale
+    version = read_corpus_version(db, collection_name)
+    count = build_snapshot(db[collection_name], collection_name, version)
+    logger.info(f"Wrote local index for {collection_name} with {count} vectors (corpus version {version})")
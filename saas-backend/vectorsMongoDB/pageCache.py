@@ -0,0 +1,195 @@
+'''
+@file pageCache.py
+This file contains an on-disk cache of the text extracted from PDF pages.
+
+Parsing pages with pdfplumber is the slowest part of loading a PDF, and its result only depends on the file and on
+the extraction code. Pages are stored zlib compressed in a SQLite file, keyed by the SHA-256 of the file, the page
+number and EXTRACTOR_VERSION of pdfExtraction.py. A file is served from the cache once all of its pages were stored,
+so runs that only change the chunking or re-embed a collection, and repeated uploads of the same evaluation, skip
+parsing. The least recently used files are dropped once the cache holds more than PDF_PAGE_CACHE_MAX_FILES files, and
+files not used for PDF_PAGE_CACHE_MAX_AGE_SECONDS (by default the course evaluation session retention) are dropped
+when the cache is opened and whenever a file is added.
+
+'''
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger()
+
+PDF_PAGE_CACHE_ENABLED = os.getenv('PDF_PAGE_CACHE_ENABLED', 'true').lower() == 'true'
+PDF_PAGE_CACHE_PATH = os.getenv(
+    'PDF_PAGE_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'pdfPages.sqlite3')
+)
+PDF_PAGE_CACHE_MAX_FILES = int(os.getenv('PDF_PAGE_CACHE_MAX_FILES', '1000'))
+PDF_PAGE_CACHE_MAX_AGE_SECONDS = float(os.getenv(
+    'PDF_PAGE_CACHE_MAX_AGE_SECONDS', os.getenv('CE_SESSION_RETENTION_SECONDS', str(7 * 24 * 60 * 60))
+))
+
+# Pages are committed in groups while a file is extracted
+_COMMIT_EVERY = 32
+
+
+def file_hash(pdf):
+    """SHA-256 of a PDF given as a path or a binary file object (which is rewound afterwards)."""
+    digest = hashlib.sha256()
+    if isinstance(pdf, (str, os.PathLike)):
+        with open(pdf, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    pdf.seek(0)
+    for block in iter(lambda: pdf.read(1 << 20), b""):
+        digest.update(block)
+    pdf.seek(0)
+    return digest.hexdigest()
+
+
+class PageWriter:
+    """Stores the pages of one file as they are extracted; complete() makes the file available to readers."""
+
+    def __init__(self, cache, digest, version):
+        self.cache = cache
+        self.digest = digest
+        self.version = version
+        self._rows = []
+        self._pages = 0
+        self.failed = False
+
+    def add(self, page_number, text):
+        if self.failed:
+            return
+        self._rows.append((self.digest, self.version, page_number, zlib.compress(text.encode("utf-8"))))
+        self._pages += 1
+        if len(self._rows) >= _COMMIT_EVERY:
+            try:
+                self._flush()
+            except sqlite3.Error as e:
+                # Extraction goes on without the cache, the file is parsed again next time
+                logger.warning(f"PDF page cache write failed: {e}")
+                self.failed = True
+
+    def _flush(self):
+        if not self._rows:
+            return
+        connection = self.cache._connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO pages (hash, version, page, text) VALUES (?, ?, ?, ?)", self._rows
+        )
+        connection.commit()
+        self._rows = []
+
+    def complete(self):
+        if self.failed:
+            return
+        try:
+            self._flush()
+            connection = self.cache._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO files (hash, version, pages, used_at) VALUES (?, ?, ?, ?)",
+                (self.digest, self.version, self._pages, time.time())
+            )
+            connection.commit()
+            self.cache._prune()
+        except sqlite3.Error as e:
+            logger.warning(f"PDF page cache write failed: {e}")
+
+
+class PageCache:
+    """SQLite store of extracted pages. One connection per thread, WAL so several workers can share the file."""
+
+    def __init__(self, path=PDF_PAGE_CACHE_PATH, max_files=PDF_PAGE_CACHE_MAX_FILES,
+                 max_age_seconds=PDF_PAGE_CACHE_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_files = max_files
+        self.max_age_seconds = max_age_seconds
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS files "
+                           "(hash TEXT, version TEXT, pages INTEGER, used_at REAL, PRIMARY KEY (hash, version))")
+        connection.execute("CREATE TABLE IF NOT EXISTS pages "
+                           "(hash TEXT, version TEXT, page INTEGER, text BLOB, PRIMARY KEY (hash, version, page))")
+        connection.commit()
+        # Pages older than the retention window go even if no file is added again
+        self._prune()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+
+    def pages(self, digest, version):
+        """
+        Return an iterator of (page number, text) in page order if every page of the file is cached, else None.
+        """
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT pages FROM files WHERE hash = ? AND version = ?",
+                                     (digest, version)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE files SET used_at = ? WHERE hash = ? AND version = ?",
+                               (time.time(), digest, version))
+            connection.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"PDF page cache read failed: {e}")
+            return None
+        self.hits += 1
+        return self._read(digest, version)
+
+    def _read(self, digest, version):
+        # A separate connection so the caller can write to the cache from this thread while it reads
+        connection = sqlite3.connect(self.path, timeout=5)
+        try:
+            rows = connection.execute("SELECT page, text FROM pages WHERE hash = ? AND version = ? ORDER BY page",
+                                      (digest, version))
+            for page_number, text in rows:
+                yield page_number, zlib.decompress(text).decode("utf-8")
+        finally:
+            connection.close()
+
+    def writer(self, digest, version):
+        return PageWriter(self, digest, version)
+
+    def _prune(self):
+        connection = self._connection()
+        stale = connection.execute("SELECT hash, version FROM files ORDER BY used_at DESC LIMIT -1 OFFSET ?",
+                                   (self.max_files,)).fetchall()
+        stale += connection.execute("SELECT hash, version FROM files WHERE used_at < ?",
+                                    (time.time() - self.max_age_seconds,)).fetchall()
+        if not stale:
+            return
+        connection.executemany("DELETE FROM files WHERE hash = ? AND version = ?", stale)
+        connection.executemany("DELETE FROM pages WHERE hash = ? AND version = ?", stale)
+        connection.commit()
+
+    def stats(self):
+        return {"path": self.path, "hits": self.hits, "misses": self.misses}
+
+
+def open_page_cache():
+    """Return the shared page cache, or None when it is disabled or the file can not be opened."""
+    if not PDF_PAGE_CACHE_ENABLED:
+        return None
+    try:
+        return PageCache()
+    except sqlite3.Error as e:
+        logger.warning(f"PDF page cache disabled: {e}")
+        return None
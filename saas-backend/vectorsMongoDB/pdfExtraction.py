@@ -0,0 +1,172 @@
+'''
+@file pdfExtraction.py
+This file extracts the text of PDF pages, in parallel for large files.
+
+pdfplumber's extract_text and extract_tables are CPU bound and run one page at a time. Files with at least
+PDF_EXTRACT_MIN_PAGES pages are split into page ranges that are extracted by a pool of worker processes; each worker
+opens the file itself and returns only the text of its pages. Results come back in page order, so callers see the
+same pages with the same page numbers as with serial extraction. Smaller files, and all files when
+PDF_EXTRACT_WORKERS is 0 or 1, are extracted in the calling process. Extracted pages are kept in the on-disk cache of
+pageCache.py, so a file that was parsed before is not parsed again.
+
+The pool is started on first use with the "spawn" start method, so worker processes do not inherit the threads,
+locks and MongoDB connections of the ingestion pipeline. A spawned worker imports the __main__ module of the parent
+again (as __mp_main__), so scripts that extract PDFs must keep their top level code under
+if __name__ == '__main__', and a server started with `python app.py` would import the whole Flask app, with its
+connections and background threads, in every worker. The server therefore does not use the pool: uploads are
+extracted in the upload job thread (EVALUATION_PDF_EXTRACT_WORKERS in loadEvaluation.py), and the pool is meant for
+generateVectorDB.py.
+
+'''
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pdfplumber
+from dotenv import load_dotenv
+
+from vectorsMongoDB.pageCache import file_hash, open_page_cache
+
+load_dotenv()
+logger = logging.getLogger()
+
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+PDF_EXTRACT_MIN_PAGES = int(os.getenv('PDF_EXTRACT_MIN_PAGES', '16'))
+PDF_EXTRACT_PAGES_PER_TASK = int(os.getenv('PDF_EXTRACT_PAGES_PER_TASK', '8'))
+PDF_EXTRACT_START_METHOD = os.getenv('PDF_EXTRACT_START_METHOD', 'spawn')
+
+# Bump when extract_text_from_page changes, so pages cached by the previous version are parsed again
+EXTRACTOR_VERSION = "1"
+
+_pool = None
+_pool_lock = threading.Lock()
+# Opened on first use, worker processes import this module but never touch the cache
+_page_cache = None
+_page_cache_opened = False
+
+
+def extract_text_from_page(page):
+    """Return the text of a pdfplumber page followed by its tables, one tab separated line per row."""
+    text = page.extract_text() or ""
+    tables = page.extract_tables() or []
+    table_texts = ['\n'.join(['\t'.join(str(cell) if cell is not None else '' for cell in row) for row in table])
+                   for table in tables if table]
+    return text + '\n\n' + '\n\n'.join(table_texts)
+
+
+def _extract_range(pdf_path, first_page, last_page):
+    """Worker task: return [(page number, text)] for pages first_page..last_page (1-based, inclusive)."""
+    results = []
+    with pdfplumber.open(pdf_path, pages=list(range(first_page, last_page + 1))) as pdf:
+        for page in pdf.pages:
+            results.append((page.page_number, extract_text_from_page(page)))
+            page.close()
+    return results
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context(PDF_EXTRACT_START_METHOD))
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def get_page_cache():
+    global _page_cache, _page_cache_opened
+    with _pool_lock:
+        if not _page_cache_opened:
+            _page_cache = open_page_cache()
+            _page_cache_opened = True
+        return _page_cache
+
+
+def page_count(pdf_path):
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def _iter_serial(pdf_path, first_page=1):
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages[first_page - 1:]:
+            text = extract_text_from_page(page)
+            page.close()
+            yield page.page_number, text
+
+
+def iter_page_texts(pdf, workers=PDF_EXTRACT_WORKERS, pages_per_task=PDF_EXTRACT_PAGES_PER_TASK, use_cache=True):
+    """
+    Yield (page number, text) for every page of a PDF, in page order. pdf is a path or a binary file object; file
+    objects are copied to a temporary file when the pages are extracted by the pool.
+    """
+    page_cache = get_page_cache() if use_cache else None
+    if page_cache is None:
+        yield from _extract(pdf, workers, pages_per_task)
+        return
+
+    digest = file_hash(pdf)
+    cached = page_cache.pages(digest, EXTRACTOR_VERSION)
+    if cached is not None:
+        yield from cached
+        return
+    writer = page_cache.writer(digest, EXTRACTOR_VERSION)
+    for page_number, text in _extract(pdf, workers, pages_per_task):
+        writer.add(page_number, text)
+        yield page_number, text
+    # Only files whose every page was extracted are served from the cache
+    writer.complete()
+
+
+def _extract(pdf, workers, pages_per_task):
+    if isinstance(pdf, (str, os.PathLike)):
+        yield from _iter_path(pdf, workers, pages_per_task)
+        return
+
+    if workers <= 1:
+        pdf.seek(0)
+        yield from _iter_serial(pdf)
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as spooled:
+        pdf.seek(0)
+        shutil.copyfileobj(pdf, spooled)
+        spooled.flush()
+        yield from _iter_path(spooled.name, workers, pages_per_task)
+
+
+def _iter_path(pdf_path, workers, pages_per_task):
+    pages = page_count(pdf_path) if workers > 1 else 0
+    if pages < max(PDF_EXTRACT_MIN_PAGES, 2):
+        yield from _iter_serial(pdf_path)
+        return
+
+    # Enough tasks to keep every worker busy, but not so small that reopening the file dominates
+    per_task = max(1, min(pages_per_task, math.ceil(pages / workers)))
+    ranges = [(first, min(first + per_task - 1, pages)) for first in range(1, pages + 1, per_task)]
+    next_page = 1
+    try:
+        pool = _get_pool(workers)
+        futures = [pool.submit(_extract_range, pdf_path, first, last) for first, last in ranges]
+        for future in futures:
+            for page_number, text in future.result():
+                yield page_number, text
+                next_page = page_number + 1
+    except (BrokenProcessPool, OSError) as e:
+        # A worker died (out of memory, killed); finish the file in this process and start a new pool next time
+        logger.warning(f"PDF extraction pool failed on {pdf_path} at page {next_page}, continuing serially: {e}")
+        _reset_pool()
+        yield from _iter_serial(pdf_path, next_page)
@@ -1,7 +1,7 @@
 '''
 @file queryManager.py
 This file contains the code to perform vector search on a MongoDB collection using the OpenAI embeddings and the MongoDB Atlas Vector Search.
-The code uses the langchain_openai, langchain_mongodb, langchain_core libraries to perform the vector search and retrieve the most relevant documents.
+The code uses the langchain_openai and langchain_core libraries to perform the vector search and retrieve the most relevant documents.
 
 IMPORTANT: Be sure to generate the embeddings using the generateVectorDB.py script before and be sure to intialize the MongoDB Atlas Vector Search index before running this script.
 
@@ -10,18 +10,27 @@ IMPORTANT: Be sure to generate the embeddings using the generateVectorDB.py scri
 
 '''
 import os
+import asyncio
 import logging
+import time
 from typing import List
-from pymongo import MongoClient
+from repository.mongo_connection import get_database
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain.prompts import PromptTemplate
-from langchain_mongodb import MongoDBAtlasVectorSearch
 from langchain.schema.runnable import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from dotenv import load_dotenv
 from langfuse.callback import CallbackHandler
 from tqdm import tqdm
 from datetime import date
+from vectorsMongoDB.vectorSearch import AtlasVectorIndex
+from vectorsMongoDB.corpusVersion import CorpusVersionTracker
+from vectorsMongoDB.answerCache import SemanticAnswerCache, ANSWER_CACHE_ENABLED
+from vectorsMongoDB.embeddingCache import get_cached_embeddings
+from vectorsMongoDB.localIndex import LocalVectorIndex, LocalFirstVectorIndex, LOCAL_INDEX_ENABLED
+from vectorsMongoDB.retrievalCache import CachedVectorIndex, retrieval_cache
+from vectorsMongoDB.contextPacker import pack_context, CONTEXT_TOKEN_BUDGET
+from service.conversation_history import budget_window, format_history
 
 
 load_dotenv()
@@ -36,33 +45,42 @@ collection_name = os.getenv('MONGODB_VECTORS')
 vector_search_idx = os.getenv('MONGODB_VECTOR_INDEX')
 
 
-# Connect to MongoDB
-client = MongoClient(MONGODB_URI)
 langfuse_handler = CallbackHandler()
 langfuse_handler.auth_check()
 
 if db_name is None or collection_name is None:
     raise ValueError("Database name or collection name is not set.")
 
-db = client[db_name]
+db = get_database(db_name)
 collection = db[collection_name]
 
 if vector_search_idx is None:
     raise ValueError("Vector search index is not set.")
 
-# Setup MongoDB Atlas Vector Search
-vector_search = MongoDBAtlasVectorSearch(
-    embedding=OpenAIEmbeddings(disallowed_special=()),
-    collection=collection,
-    index_name=vector_search_idx,
-)
+# Shared with CEqueryManager so a question is only sent to OpenAI once per process (and once per machine on disk)
+embeddings = get_cached_embeddings()
 
 # Configure the retriever
 # STEP 2
-retriever = vector_search.as_retriever(
-    search_type="similarity",
-    search_kwargs={"k": 10, "score_threshold": 0.8}
+# The question is embedded once in process_query and the same vector is used for the answer cache and the search
+# Answers and the local snapshot are only used while the textbook collection keeps the same version stamp
+corpus_version = CorpusVersionTracker(db, collection_name)
+atlas_index = AtlasVectorIndex(collection, vector_search_idx)
+# Searches are answered in-process from the FAISS snapshot (see localIndex.py) with Atlas as the fallback,
+# and repeated searches from the retrieval cache (see retrievalCache.py)
+text_index = CachedVectorIndex(
+    LocalFirstVectorIndex(
+        atlas_index,
+        LocalVectorIndex.load(collection_name) if LOCAL_INDEX_ENABLED else None,
+        corpus_version
+    ),
+    retrieval_cache,
+    collection_name,
+    corpus_version
 )
+RETRIEVER_K = 10
+
+answer_cache = SemanticAnswerCache()
 
 # Define the template for the language model
 template = """
@@ -141,48 +159,115 @@ rag_chain = (
     | StrOutputParser() # STEP 7
 )
 
+def prompt_inputs(question, context, history: List[dict]):
+    '''
+    Build the input for the RAG chain from the question, the retrieved context and the conversation so far.
+    Only the most recent messages that fit in the history token budget are included.
+    '''
+    today = date.today()
+    human_readable_date = today.strftime("%B %d, %Y")
+
+    return {
+        "question" : question,
+        "context": context,
+        "history": format_history(budget_window(history)),
+        "date": human_readable_date
+    }
+
 # Function to process a query
 
-def process_query(question, history: List[dict]):
+def describe_sources(docs):
+    '''
+    Summarize retrieved chunks for the metadata sent to SSE clients.
+    '''
+    return [{"source": doc.metadata.get("source"), "page": doc.metadata.get("page_number")} for doc in docs]
+
+def process_query(question, history: List[dict], metadata: dict | None = None):
     '''
     This function processes a query by invoking the RAG chain with the given question.
     It returns a generator that yields the response in chunks.
     The function iterates over stream_response and yields each chunk of the response
+    If a metadata dict is passed, retrieval timing and sources are written into it before the first chunk is yielded.
     '''
     if not isinstance(question, str):
         raise ValueError("The question must be a string.")
+    if metadata is None:
+        metadata = {}
 
     try:
-        # Retrieve the relevant documents
-        context_docs = retriever.invoke(question)
-        context = format_docs(context_docs)
-        history_formatted = ""
-        
-
-        today = date.today()
-        human_readable_date = today.strftime("%B %d, %Y")
-
-        for chat in history:
-            chat_sender = chat.get("sender", "User")
-            chat_message = chat.get("text", '-')
-            history_formatted += f"{chat_sender}: {chat_message}\n"
+        retrieval_started = time.perf_counter()
+        query_embedding = embeddings.embed_query(question)
+
+        # Follow up questions depend on the conversation, so only standalone questions go through the answer cache
+        use_cache = ANSWER_CACHE_ENABLED and not history
+        if use_cache:
+            version = corpus_version.current()
+            cached_answer = answer_cache.lookup(query_embedding, version)
+            if cached_answer is not None:
+                metadata.update({"cached": True, "retrievalMs": (time.perf_counter() - retrieval_started) * 1000,
+                                 "sources": []})
+                yield from answer_cache.replay(cached_answer)
+                return
+
+        # Retrieve the relevant documents and pack the best of them into the context token budget
+        context, context_docs = pack_context(text_index.search(query_embedding, k=RETRIEVER_K), CONTEXT_TOKEN_BUDGET)
+        metadata.update({"cached": False, "retrievalMs": (time.perf_counter() - retrieval_started) * 1000,
+                         "sources": describe_sources(context_docs)})
 
         stream_response = rag_chain.stream(
-                    {
-                        "question" : question,
-                        "context": context,
-                        "history": history_formatted,
-                        "date": human_readable_date
-                    }, 
+            prompt_inputs(question, context, history),
             config={"callbacks":[langfuse_handler]})
 
+        answer_chunks = []
         for chunk in stream_response: #chunking allows user to see response as processed,  
+            answer_chunks.append(chunk)
+            yield chunk
+
+        # Only answers that streamed to completion are cached
+        if use_cache:
+            answer_cache.store(question, query_embedding, "".join(answer_chunks), version)
+
+    except Exception as e:
+        raise RuntimeError(f"An error occurred while processing the query: {e}")
+
+async def aprocess_query(question, history: List[dict]):
+    '''
+    Async version of process_query used by the ASGI server (asgi.py).
+    The embedding, the vector search and the LLM stream are awaited, so no thread is held while tokens stream.
+    '''
+    if not isinstance(question, str):
+        raise ValueError("The question must be a string.")
+
+    try:
+        query_embedding = await embeddings.aembed_query(question)
+
+        use_cache = ANSWER_CACHE_ENABLED and not history
+        if use_cache:
+            version = await asyncio.to_thread(corpus_version.current)
+            cached_answer = answer_cache.lookup(query_embedding, version)
+            if cached_answer is not None:
+                for chunk in answer_cache.replay(cached_answer):
+                    yield chunk
+                return
+
+        context, _ = pack_context(await text_index.asearch(query_embedding, k=RETRIEVER_K), CONTEXT_TOKEN_BUDGET)
+
+        stream_response = rag_chain.astream(
+            prompt_inputs(question, context, history),
+            config={"callbacks":[langfuse_handler]})
+
+        answer_chunks = []
+        async for chunk in stream_response:
+            answer_chunks.append(chunk)
             yield chunk
 
+        if use_cache:
+            answer_cache.store(question, query_embedding, "".join(answer_chunks), version)
+
     except Exception as e:
         raise RuntimeError(f"An error occurred while processing the query: {e}")
 
-def make_query(input_text: str | None, history: List[dict] | None = None):
+def make_query(input_text: str | None, history: List[dict] | None = None, metadata: dict | None = None):
     '''
     This is the entry function that processes a given query from payload
     '''
@@ -193,11 +278,23 @@ def make_query(input_text: str | None, history: List[dict] | None = None):
         history = []
 
     try:
-        response_generator = process_query(input_text, history)
+        response_generator = process_query(input_text, history, metadata)
         return response_generator
     except Exception as e:
         raise RuntimeError(f"An error occurred while processing the query: {e}")
 
+def amake_query(input_text: str | None, history: List[dict] | None = None):
+    '''
+    Async entry point for the ASGI server, returns an async generator of response chunks
+    '''
+    if input_text is None or not isinstance(input_text, str):
+        raise ValueError("No valid input provided")
+
+    if history is None:
+        history = []
+
+    return aprocess_query(input_text, history)
+
 '''
 STEPS THAT OCCUR IN THE BACKGROUND when .invoke() is called on the rag_chain instance 
 Please email me skverma@ncsu.edu if you have any further questions
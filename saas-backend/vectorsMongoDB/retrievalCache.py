@@ -0,0 +1,153 @@
+'''
+@file retrievalCache.py
+This file contains a cache of vector search results that sits in front of a vector index.
+
+Results (chunk ids, text, metadata and scores) are keyed by collection, the normalized query vector, k and the
+metadata filter, and tagged with the corpus version of the collection. Follow-up questions, regenerated answers and
+the course evaluation textbook/website lookups, which are the same for every session, are then answered without a
+round trip to Atlas. Entries are evicted least recently used first, expire after a time to live and are dropped as
+soon as ingestion writes a new corpus version.
+
+'''
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.schema import Document
+
+load_dotenv()
+
+RETRIEVAL_CACHE_ENABLED = os.getenv('RETRIEVAL_CACHE_ENABLED', 'true').lower() == 'true'
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv('RETRIEVAL_CACHE_MAX_ENTRIES', '5000'))
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv('RETRIEVAL_CACHE_TTL_SECONDS', str(60 * 60)))
+
+
+def query_key(collection_name, query_vector, k, pre_filter):
+    """
+    Hash a search request. The vector is normalized and rounded to float16 so that embeddings of the same text
+    that differ in the last bits share one entry.
+    """
+    vector = np.asarray(query_vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector = vector / norm
+    digest = hashlib.sha1(vector.astype(np.float16).tobytes())
+    digest.update(f"\0{collection_name}\0{k}\0{json.dumps(pre_filter, sort_keys=True, default=str)}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class RetrievalCache:
+    """
+    Thread safe LRU + TTL cache of search results shared by every cached index of the process.
+    """
+
+    def __init__(self, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, ttl_seconds=RETRIEVAL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self, collection_name, corpus_version):
+        # Caller holds self._lock
+        if self._versions.get(collection_name) == corpus_version:
+            return
+        stale = [key for key, entry in self._entries.items() if entry[0] == collection_name]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+        self._versions[collection_name] = corpus_version
+
+    def get(self, collection_name, corpus_version, key):
+        """Return the cached results of a search, or None."""
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(collection_name, corpus_version)
+            entry = self._entries.get(key)
+            if entry is None or now - entry[1] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            results = entry[2]
+        # Fresh documents every time, so callers can not change what is cached
+        return [(Document(page_content=text, metadata=dict(metadata)), score) for text, metadata, score in results]
+
+    def put(self, collection_name, corpus_version, key, results):
+        stored = [(doc.page_content, dict(doc.metadata), score) for doc, score in results]
+        with self._lock:
+            self._check_version(collection_name, corpus_version)
+            self._entries[key] = (collection_name, time.monotonic(), stored)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class CachedVectorIndex:
+    """
+    Wraps a vector index (AtlasVectorIndex or LocalFirstVectorIndex) and answers repeated searches from the cache.
+    """
+
+    def __init__(self, index, cache: RetrievalCache, collection_name, corpus_version_tracker,
+                 enabled=RETRIEVAL_CACHE_ENABLED):
+        self.index = index
+        self.cache = cache
+        self.collection_name = collection_name
+        self.corpus_version = corpus_version_tracker
+        self.enabled = enabled
+
+    def search(self, query_vector, k=10, pre_filter=None):
+        if not self.enabled:
+            return self.index.search(query_vector, k, pre_filter)
+        version = self.corpus_version.current()
+        key = query_key(self.collection_name, query_vector, k, pre_filter)
+        results = self.cache.get(self.collection_name, version, key)
+        if results is None:
+            results = self.index.search(query_vector, k, pre_filter)
+            self.cache.put(self.collection_name, version, key, results)
+        return results
+
+    async def asearch(self, query_vector, k=10, pre_filter=None):
+        if not self.enabled:
+            return await self.index.asearch(query_vector, k, pre_filter)
+        # The version may be read from MongoDB, keep it off the event loop
+        version = await asyncio.to_thread(self.corpus_version.current)
+        key = query_key(self.collection_name, query_vector, k, pre_filter)
+        results = self.cache.get(self.collection_name, version, key)
+        if results is None:
+            results = await self.index.asearch(query_vector, k, pre_filter)
+            self.cache.put(self.collection_name, version, key, results)
+        return results
+
+    def stats(self):
+        """Stats of the wrapped index; the cache reports its own through retrieval_cache.stats()."""
+        return self.index.stats() if hasattr(self.index, "stats") else {}
+
+
+retrieval_cache = RetrievalCache()
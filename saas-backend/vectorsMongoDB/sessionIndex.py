@@ -0,0 +1,250 @@
+'''
+@file sessionIndex.py
+This file contains the in-process index of the course evaluations uploaded to each session.
+
+An uploaded evaluation is a few hundred chunks, but every course evaluation question searched it in Atlas with a
+source filter over the shared MONGODB_VECTORS_COURSEEVALUATION_DOCS collection. The chunks of a session are now read
+once into a NumPy matrix, by the upload job when it finishes or on the first question a worker gets for the session,
+and searched with one matrix product. The session document carries an evaluation_version stamp that every upload
+changes, so a worker that holds an older copy of a session reloads it. Sessions are evicted least recently used first,
+after SESSION_INDEX_TTL_SECONDS without a question, and once the worker holds more than SESSION_INDEX_MAX_MB of vectors.
+
+'''
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.schema import Document
+
+load_dotenv()
+logger = logging.getLogger()
+
+SESSION_INDEX_ENABLED = os.getenv('SESSION_INDEX_ENABLED', 'true').lower() == 'true'
+SESSION_INDEX_MAX_MB = float(os.getenv('SESSION_INDEX_MAX_MB', '256'))
+SESSION_INDEX_TTL_SECONDS = float(os.getenv('SESSION_INDEX_TTL_SECONDS', str(60 * 60)))
+
+
+def session_of(pre_filter):
+    """Return the session id of a {"source": session_id} or {"source": {"$eq": session_id}} filter, else None."""
+    if not pre_filter or list(pre_filter) != ["source"]:
+        return None
+    source = pre_filter["source"]
+    if isinstance(source, dict):
+        return source.get("$eq") if list(source) == ["$eq"] else None
+    return source
+
+
+class SessionIndex:
+    """The chunks of one session as a matrix of normalized vectors."""
+
+    def __init__(self, version, documents, vectors):
+        self.version = version
+        self.documents = documents
+        if vectors:
+            matrix = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self.matrix = matrix / norms
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.nbytes = self.matrix.nbytes + sum(len(text) for text, _ in documents)
+        self.used_at = time.monotonic()
+
+    def search(self, query_vector, k=10):
+        """Return the k most similar chunks with Atlas compatible cosine scores in [0, 1]."""
+        count = len(self.documents)
+        if not count or k <= 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        similarities = self.matrix @ query
+        k = min(k, count)
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [
+            (Document(page_content=self.documents[position][0], metadata=dict(self.documents[position][1])),
+             (1.0 + float(similarities[position])) / 2.0)
+            for position in top
+        ]
+
+
+class SessionIndexCache:
+    """
+    Thread safe LRU + TTL store of the session indexes of the process, bounded by the bytes they hold.
+    """
+
+    def __init__(self, max_bytes=int(SESSION_INDEX_MAX_MB * 1024 * 1024), ttl_seconds=SESSION_INDEX_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.too_large = 0
+
+    def _remove(self, session_id):
+        # Caller holds self._lock
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+
+    def get(self, session_id, version, count=True):
+        """Return the index of a session if it is held at the given version, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.version != version or now - entry.used_at > self.ttl_seconds:
+                if entry is not None:
+                    self._remove(session_id)
+                    self.evictions += 1
+                if count:
+                    self.misses += 1
+                return None
+            entry.used_at = now
+            self._entries.move_to_end(session_id)
+            if count:
+                self.hits += 1
+            return entry
+
+    def put(self, session_id, index):
+        """Keep an index, evicting the least recently used ones until it fits. Returns False if it never fits."""
+        with self._lock:
+            self._remove(session_id)
+            if index.nbytes > self.max_bytes:
+                self.too_large += 1
+                return False
+            self._entries[session_id] = index
+            self._bytes += index.nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            return True
+
+    def drop(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "tooLarge": self.too_large,
+            }
+
+
+class SessionVectorIndex:
+    """
+    Serves searches filtered to one session from the session's in-process index, every other search from Atlas.
+    """
+
+    def __init__(self, atlas_index, cache: SessionIndexCache, enabled=SESSION_INDEX_ENABLED):
+        self.atlas_index = atlas_index
+        self.cache = cache
+        self.enabled = enabled
+        # session id -> [lock, number of loads holding or waiting for it]
+        self._load_locks = {}
+        self._locks_lock = threading.Lock()
+        # (session id, version) of sessions too large for the cache, searched in Atlas instead of loaded every time
+        self._too_large = set()
+        self.loads = 0
+        self.atlas_searches = 0
+
+    def load(self, session_id, version):
+        """Read the chunks of a session from MongoDB into the cache and return the index, or None if it does not fit."""
+        with self._locks_lock:
+            entry = self._load_locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+        lock = entry[0]
+        try:
+            # One load per session at a time, the questions that wait for it use its result
+            with lock:
+                index = self.cache.get(session_id, version, count=False)
+                if index is not None or (session_id, version) in self._too_large:
+                    return index
+                documents, vectors = [], []
+                embedding_key = self.atlas_index.embedding_key
+                for record in self.atlas_index.collection.find({"source": session_id}):
+                    vector = record.pop(embedding_key, None)
+                    if vector is None:
+                        continue
+                    document = self.atlas_index.to_document(record)
+                    documents.append((document.page_content, document.metadata))
+                    vectors.append(vector)
+                index = SessionIndex(version, documents, vectors)
+                self.loads += 1
+                if not self.cache.put(session_id, index):
+                    if len(self._too_large) >= 1000:
+                        self._too_large.clear()
+                    self._too_large.add((session_id, version))
+                    return None
+                return index
+        finally:
+            with self._locks_lock:
+                # Kept while other loads wait on it, a new lock would let the next question load the session again
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._load_locks[session_id]
+
+    def preload(self, session_id, version):
+        """Load a session that was just uploaded; a failure only means the first question loads it instead."""
+        if not self.enabled:
+            return
+        try:
+            self.load(session_id, version)
+        except Exception as e:
+            logger.warning(f"Could not preload the session index of {session_id}: {e}")
+
+    def search(self, query_vector, k=10, pre_filter=None, version=None):
+        """
+        Search like AtlasVectorIndex.search. version is the evaluation_version of the session document; chunks
+        loaded at another version are read again.
+        """
+        session_id = session_of(pre_filter)
+        if self.enabled and session_id is not None:
+            try:
+                index = self.cache.get(session_id, version) or self.load(session_id, version)
+                if index is not None:
+                    return index.search(query_vector, k)
+            except Exception as e:
+                logger.warning(f"Session index search failed, falling back to Atlas: {e}")
+        self.atlas_searches += 1
+        return self.atlas_index.search(query_vector, k, pre_filter)
+
+    async def asearch(self, query_vector, k=10, pre_filter=None, version=None):
+        session_id = session_of(pre_filter)
+        if self.enabled and session_id is not None:
+            try:
+                index = self.cache.get(session_id, version)
+                if index is None:
+                    # Loading reads MongoDB, keep it off the event loop
+                    index = await asyncio.to_thread(self.load, session_id, version)
+                if index is not None:
+                    return index.search(query_vector, k)
+            except Exception as e:
+                logger.warning(f"Session index search failed, falling back to Atlas: {e}")
+        self.atlas_searches += 1
+        return await self.atlas_index.asearch(query_vector, k, pre_filter)
+
+    def stats(self):
+        return {"enabled": self.enabled, "loads": self.loads, "atlasSearches": self.atlas_searches,
+                **self.cache.stats()}
+
+
+session_index_cache = SessionIndexCache()
@@ -0,0 +1,73 @@
+'''
+@file vectorSearch.py
+This file runs MongoDB Atlas Vector Search with a query embedding that has already been computed.
+
+The LangChain retrievers embed the question themselves on every call. Searching by vector lets the query managers
+embed a question once and reuse that embedding for caching and for every collection they search.
+The documents use the same layout that MongoDBAtlasVectorSearch writes: the chunk text in "text",
+the vector in "embedding" and the metadata as top level fields.
+
+'''
+import asyncio
+from typing import List, Optional, Tuple
+
+from langchain.schema import Document
+
+
+class AtlasVectorIndex:
+    """
+    Thin wrapper around the $vectorSearch aggregation stage for one collection and search index.
+    """
+
+    def __init__(self, collection, index_name, text_key="text", embedding_key="embedding", num_candidates_factor=10,
+                 async_collection=None):
+        self.collection = collection
+        # Optional Motor collection used by asearch() when serving through asgi.py
+        self.async_collection = async_collection
+        self.index_name = index_name
+        self.text_key = text_key
+        self.embedding_key = embedding_key
+        self.num_candidates_factor = num_candidates_factor
+
+    def build_pipeline(self, query_vector, k=10, pre_filter: Optional[dict] = None):
+        """Build the aggregation pipeline for a similarity search."""
+        vector_stage = {
+            "index": self.index_name,
+            "path": self.embedding_key,
+            "queryVector": list(query_vector),
+            "numCandidates": k * self.num_candidates_factor,
+            "limit": k,
+        }
+        if pre_filter:
+            vector_stage["filter"] = pre_filter
+        return [
+            {"$vectorSearch": vector_stage},
+            {"$set": {"score": {"$meta": "vectorSearchScore"}}},
+            {"$project": {self.embedding_key: 0}},
+        ]
+
+    def to_document(self, record):
+        """Convert a raw MongoDB record into a LangChain Document, keeping the chunk id in the metadata."""
+        record = dict(record)
+        text = record.pop(self.text_key, "")
+        record.pop("score", None)
+        record["_id"] = str(record.get("_id"))
+        return Document(page_content=text, metadata=record)
+
+    def search(self, query_vector, k=10, pre_filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """Return the k most similar chunks with their similarity scores."""
+        results = []
+        for record in self.collection.aggregate(self.build_pipeline(query_vector, k, pre_filter)):
+            score = record.get("score", 0.0)
+            results.append((self.to_document(record), score))
+        return results
+
+    async def asearch(self, query_vector, k=10, pre_filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """Async version of search(), runs on Motor when an async collection is set and in a thread otherwise."""
+        if self.async_collection is None:
+            return await asyncio.to_thread(self.search, query_vector, k, pre_filter)
+        results = []
+        async for record in self.async_collection.aggregate(self.build_pipeline(query_vector, k, pre_filter)):
+            score = record.get("score", 0.0)
+            results.append((self.to_document(record), score))
+        return results
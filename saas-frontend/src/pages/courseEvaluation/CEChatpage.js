@@ -136,6 +136,23 @@ const ChatPage = () => {
     }
   }, [location.search, currentSessionId]);
 
+  const waitForUploadJob = async (job, onProgress) => {
+    let status = job;
+    while (status.state !== "ready" && status.state !== "failed") {
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      const response = await fetch(`${apiUrl}/courseEvaluation/upload/${job.job_id}`);
+      if (!response.ok) {
+        return { state: "failed", error: `Status request failed (${response.status})` };
+      }
+      status = await response.json();
+      if (status.chunksParsed > 0) {
+        // Keep below 100 until the job is ready, 100 enables the question input
+        onProgress(Math.min(99, Math.round((status.chunksStored / status.chunksParsed) * 100)));
+      }
+    }
+    return status;
+  };
+
   const handleFileUpload = async (file) => {
     setIsUploading(true);
     const formData = new FormData();
@@ -166,7 +183,18 @@ const ChatPage = () => {
 
       if (response.ok) {
         const data = await response.json();
-        console.log("Upload success:", data);
+        console.log("Upload accepted:", data);
+        // The file is parsed and embedded in the background, poll the job until it is ready
+        const job = await waitForUploadJob(data, (progress) =>
+          setUploadingFiles((prevFiles) =>
+            prevFiles.map((f) => (f.name === newFile.name ? { ...f, progress } : f))
+          )
+        );
+        if (job.state === "failed") {
+          console.error("Upload failed:", job.error);
+          alert(`Upload failed: ${job.error}`);
+          return;
+        }
         setUploadingFiles((prevFiles) =>
           prevFiles.map((f) =>
             f.name === newFile.name ? { ...f, progress: 100 } : f
@@ -273,7 +301,6 @@ const ChatPage = () => {
         body: JSON.stringify({
           question: question,
           session_id: currentSessionId,
-          history: messages.slice(-10),
         }),
       });
 
@@ -411,7 +411,7 @@ const ChatPage = () => {
                     body: JSON.stringify({ email: email, question: _question, chatTitle: _question })
                 });
             } else {
-                payload = { email, sessionKey: currentSessionKey, question: _question, history: messages.slice(-10) };
+                payload = { email, sessionKey: currentSessionKey, question: _question };
                 response = await fetch(`${apiUrl}/chat/ask`, {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },